@@ -17,36 +17,52 @@ import matplotlib.ticker as tck
 from cycler import cycler 
 
 from photutils.detection import DAOStarFinder
-from photutils import detect_threshold, detect_sources, deblend_sources, segmentation
+from photutils import detect_sources, deblend_sources, segmentation
 from photutils.aperture import ApertureStats, CircularAperture, CircularAnnulus
-from astropy.stats import sigma_clipped_stats, SigmaClip, gaussian_fwhm_to_sigma
-from astropy.convolution import Gaussian2DKernel, convolve
+from astropy.stats import SigmaClip, gaussian_fwhm_to_sigma
+from astropy.convolution import Gaussian1DKernel, Gaussian2DKernel, convolve, convolve_fft
+from scipy.ndimage import convolve1d, center_of_mass
+from scipy import ndimage
 
 from pyBIA import data_processing, data_augmentation
-from pyBIA.image_moments import make_moments_table
+from pyBIA.image_moments import batch_moments, moment_names
+from pyBIA.stats import sigma_clipped_stats
+from pyBIA.photometry import aperture_photometry, ApertureMatrix
+from pyBIA.spatial import SpatialIndex
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
 from pathlib import Path
 from progress import bar
+import hashlib
+import time
+import os
 
 class Catalog:
     """
     Creates catalog object.
 
     Args:
-        data (ndarray): 2D array.
+        data (ndarray, str): 2D array, or the path to a FITS file. FITS files are opened with memory 
+            mapping, so when the positions are input only the sections around each source are read
+            from disk, see the load_fits function.
         x (ndarray, optional): 1D array or list containing the x-pixel position.
             Can contain one position or multiple samples.
         y (ndarray, optional): 1D array or list containing the y-pixel position.
             Can contain one position or multiple samples.
         bkg (None, optional): If bkg=0 the data is assumed to be background-subtracted.
             The other optional is bkg=None, in which case the background will be
-            automatically calculated for local regions.
+            automatically calculated for local regions. A 2D background map of the same 
+            shape as the data can also be input, such as the bkg_map attribute saved 
+            by a previous run on the same field, in which case it is subtracted from the data.
         zp (float, optional): Zeropoint of the instrument, used to compute the apparent
             magnitude from the flux. Defaults to None.
         exptime (float, optional): Exposure time, used to set the units to counts/sec. This allows
             for self-consistency when performing the image segmentation across different fields with 
             varying exposure times. Defaults to None, in which case the segmentation is performed
             on the raw input image.
-        error (ndarray, optional): 2D array containing the rms error map.
+        error (ndarray, str, optional): 2D array containing the rms error map, or the path to a FITS file
+            containing the rms map, which will also be memory-mapped.
         morph_params (bool, optional): If True, image segmentation is performed and
             morphological parameters are computed. Defaults to True. 
         kernel_size (int): The size length of the square Gaussian filter kernel used to convolve 
@@ -56,9 +72,12 @@ class Catalog:
         threshold (float): Segmentation detection threshold. If during image segmentation no central source
             is located within a circular mask of radius = threshold, then the object is
             flagged as non-detection. Defaults to 10 pixels.
-        deblend (bool, optional): If True, the objects are deblended during the segmentation
+        deblend (bool, str, dict, optional): If True, the objects are deblended during the segmentation
             procedure, thus deblending the objects before the morphological features
-            are computed. Defaults to False so as to keep blobs as one segmentation object.
+            are computed. As only the central object of each source is measured, deblend='central'
+            deblends only that segment, while deblend='selective' deblends only the segments that pass
+            area, peak, and flux ratio thresholds, see the deblend_segments function. Defaults to False
+            so as to keep blobs as one segmentation object.
         obj_name (ndarray, str, optional): 1D array containing the name of each object
             corresponding to the x & y position. This will be appended to the first
             column of the output catalog. Defaults to None.
@@ -78,11 +97,53 @@ class Catalog:
         cat (Dataframe): Pandas dataframe, use if the catalog has been creted. The objects
             in this catalog must reside within the data array, therefore if subfields
             need individual class instance. Defaults to None.
+        tile_size (int, optional): If set and no positions are input, the source detection is
+            performed on overlapping square tiles of this length instead of on the whole frame,
+            see the tiled_source_detection function. Defaults to None, which disables tiling.
+        tile_overlap (int): The number of pixels by which neighboring tiles overlap, only applicable
+            if tile_size is set. Defaults to 100.
+        n_jobs (int): The number of worker processes to use during the tiled source detection
+            and when computing the morphological parameters. Defaults to 1.
+        n_threads (int): The number of threads each process uses to extract the contours of the segments 
+            for the Fourier descriptors, see the morph_parameters function. Defaults to 1.
+        zernike_order (int, optional): If set, the magnitudes of the Zernike moments of each segment up to this 
+            order are added to the morphological features, as the zernike_n_m columns, see the morph_parameters 
+            function. Defaults to None.
+        field_convolve (bool): If True the data is convolved and thresholded only once for the entire
+            field when computing the morphological parameters, see the morph_parameters function.
+            Defaults to False.
+        conv_method (str): The convolution backend used during the segmentation, either 'separable', 
+            'fft', 'direct', or 'auto'. See the convolve_data function. Defaults to 'auto'.
+        ext (int, str): The FITS extension containing the image, only applicable if data and/or 
+            error are input as file paths. Defaults to 0.
+        phot_method (str, ApertureMatrix): The aperture photometry engine, either 'photutils', which computes the exact
+            aperture overlap with photutils' ApertureStats, or 'stencil', which gathers the pixels of all the
+            sources at once and is much faster for large catalogs, see the photometry.aperture_photometry
+            function. Can also be a photometry.ApertureMatrix built for these positions on the same pixel grid,
+            e.g. when cataloging several filters or epochs of the same field, in which case its radii are used.
+            Defaults to 'photutils'.
+        min_size (int, optional): If set, the segmentation of each source starts on a central crop of the stamp
+            of this size, which only grows when the central segment reaches its edges, see the morph_parameters 
+            function. Defaults to None, in which case the whole stamps are segmented.
+        binning (int, optional): If set and no positions are input, the background-subtracted frame is block-binned
+            by this factor (e.g. 2 or 4) and the extended sources are found on the binned frame, after which only 
+            the regions around them are segmented at full resolution, see the coarse_source_detection function.
+            If tile_size is also set every tile is binned, see the tiled_source_detection function. Compact 
+            sources not detected in the binned frame are not cataloged. Defaults to None.
+        noise (str, float, ndarray, optional): The noise model of the field from which the segmentation thresholds
+            of the stamps are read, either 'global', 'mesh', 'error' to use the rms error map, a single rms value, or a 
+            2D rms map, see the morph_parameters function. Defaults to None, in which case the noise is estimated in every stamp.
     """
 
     def __init__(self, data, x=None, y=None, bkg=None, error=None, zp=None, exptime=None, morph_params=True, nsig=0.7, threshold=10, 
         deblend=False, obj_name=None, field_name=None, flag=None, aperture=15, annulus_in=20, annulus_out=35, 
-        kernel_size=21, invert=False, cat=None):
+        kernel_size=21, invert=False, cat=None, tile_size=None, tile_overlap=100, n_jobs=1, field_convolve=False, conv_method='auto', ext=0, phot_method='photutils',
+        min_size=None, binning=None, noise=None, n_threads=1, zernike_order=None):
+
+        if isinstance(data, (str, Path)):
+            data = load_fits(data, ext=ext)
+        if isinstance(error, (str, Path)):
+            error = load_fits(error, ext=ext)
 
         self.data = data 
         self.x = x
@@ -102,6 +163,20 @@ class Catalog:
         self.kernel_size = kernel_size
         self.invert = invert 
         self.cat = cat
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.zernike_order = zernike_order
+        self.field_convolve = field_convolve
+        self.conv_method = conv_method
+        self.phot_method = phot_method
+        self.min_size = min_size
+        self.binning = binning
+        self.noise = noise
+
+        if not isinstance(phot_method, ApertureMatrix) and phot_method not in ('photutils', 'stencil'):
+            raise ValueError("Invalid phot_method, options are 'photutils', 'stencil', or an ApertureMatrix.")
 
         #if bool(self.zp) != bool(self.exptime):
         #    raise ValueError('Both zp and exptime must be provided or not provided simultaneously!')
@@ -141,7 +216,7 @@ class Catalog:
         if isinstance(flag, np.ndarray) is False and flag is not None:
             self.flag = np.array(flag)
 
-    def create(self, save_file=True, path=None, filename=None):
+    def create(self, save_file=True, path=None, filename=None, file_format='csv', checkpoint=None, checkpoint_interval=300, keep_catalog=True):
         """
         Creates a photometric and morphological catalog containing the object(s) in 
         the given position(s) at the given order. The parameters x and y should be 1D 
@@ -159,6 +234,19 @@ class Catalog:
             path (str, optional): By default the text file containing the photometry will be
                 saved to the local directory, unless an absolute path to a directory is entered here.
             filename (str, optional): Name of the output catalog. Default name is 'pyBIA_catalog'.
+            file_format (str): The format of the saved catalog, either 'csv', 'npy', 'parquet', or 'feather'.
+                When computing the morphological parameters the rows are appended to the file in chunks
+                as they are processed, see the CatalogWriter class. Defaults to 'csv'.
+            checkpoint (str, optional): Path to a directory where the progress of the run will be checkpointed.
+                The detected positions and background map, as well as the features of the sources processed thus far
+                are saved, and if the run is interrupted calling create again with the same checkpoint directory resumes
+                from the last checkpoint. The checkpoint file is keyed by the input image, background and error maps, positions,
+                and parameters, see the checkpoint_key function, and is deleted once the catalog is complete. Defaults to None.
+            checkpoint_interval (float): The minimum number of seconds between checkpoints. Defaults to 300.
+            keep_catalog (bool): If False the rows of the morphological catalog are only written to the file, chunk
+                by chunk, and are not held in memory, so the memory does not grow with the number of sources. The cat 
+                attribute is then set to None, and the catalog can be read with the load_catalog function. Requires 
+                save_file=True. Defaults to True.
 
         Note:
             As Lyman-alpha nebulae are diffuse sources with
@@ -171,6 +259,14 @@ class Catalog:
             annulus may yield more robust background measurements. This
             is especially important when extracting photometry in crowded fields
             where surrounding sources may skew the median background.
+
+            When no positions are input and bkg=None, the background map that was 
+            subtracted prior to the source detection is saved as the bkg_map attribute,
+            which can be input as the bkg argument of later runs on the same field.
+
+            When the morphological parameters are computed, the number of segmented objects
+            whose Fourier descriptors could not all be computed is saved as the contour_counts 
+            attribute, a Counter with the 'no_contour' and 'short_contour' keys, and printed if non-zero.
                     
         Returns:
             A pandas dataframe of all objects input (or automatically detected if there were no position arguments), 
@@ -178,115 +274,156 @@ class Catalog:
             will also be saved to the local directory, unless an absolute path argument is specified.
         """
 
-        if self.bkg is not None and self.bkg != 0:
-            raise ValueError('Invalid background input -- if data is background subtracted set bkg=0, otherwise if bkg=None the background will be approximated.')
-        if self.error is not None:
-            if self.data.shape != self.error.shape:
-                raise ValueError("The rms error map must be the same shape as the data array.")
-        if self.aperture > self.annulus_in or self.annulus_in > self.annulus_out:
-            raise ValueError('The radius of the inner and out annuli must be larger than the aperture radius.')
-        if self.x is not None:
-            try: #If position array is a single number it will be converted to a list of unit length
-                __ = len(self.x)
-            except:
-                self.x, self.y = [self.x], [self.y]
-            if len(self.x) != len(self.y):
-                raise ValueError("The two position arrays (x & y) must be the same size.")
+        if not keep_catalog and not save_file:
+            raise ValueError('The catalog must be saved (save_file=True) if it is not kept in memory (keep_catalog=False).')
+        if save_file:
+            _check_file_format(file_format)
+        image, bkg = _band_image(self.data, bkg=self.bkg, error=self.error)
+        self.bkg_map = self.bkg if isinstance(self.bkg, np.ndarray) else None
+        if isinstance(self.noise, str) and self.noise == 'error' and self.error is None:
+            raise ValueError("The noise can only be set to 'error' if the rms error map is input.")
+        self.x, self.y = _check_positions(self)
         #if self.invert == False:
         #    print('WARNING: If data is from .fits file you may need to set invert=True if (x,y) = (0,0) is at the top left corner of the image instead of the bottom left corner.')
-        
-        Ny, Nx = self.data.shape
+
+        _open_checkpoint(self, checkpoint, image, bkg=self.bkg, error=self.error)
 
         if self.x is None: #Background subtraction and source detection
-            if self.nsig < 1 and self.deblend == False:
-                warn('Low nsig warning, for proper source detection do an initial run with a higher nsig, or set deblend=True.')
-            print('Running source detection...')
-            length = self.annulus_out*2*2. #The sub-array when padding will be be a square encapsulating the outer annuli
-            if Nx < length or Ny < length: #Small image, no need to pad, just take robust median
-                if self.bkg is None:
-                    data = self.data - sigma_clipped_stats(self.data)[1] #Sigma clipped median
-                elif self.bkg == 0:
-                    data = self.data
+            if 'x' in self._checkpoint: #Resume with the sources detected during the interrupted run
+                self.x, self.y = self._checkpoint['x'], self._checkpoint['y']
+                if bkg is None:
+                    self.bkg_map = self._checkpoint['bkg_map']
+                    data = image - self.bkg_map
+                else:
+                    data = image
             else:
-                if self.bkg is None:
-                    data = subtract_background(self.data, length=length)
-                elif self.bkg == 0:
-                    data = self.data 
-       
-            segm, convolved_data = segm_find(data, nsig=self.nsig, kernel_size=self.kernel_size, deblend=self.deblend)
-            props = segmentation.SourceCatalog(data, segm, convolved_data=convolved_data)
-            try:
-                self.x, self.y = props.centroid[:,0], props.centroid[:,1]
-            except:
-                self.x, self.y = props.centroid[0], props.centroid[1]
+                self.x, self.y, data, bkg_map = _detect_sources(self, image, bkg=bkg)
+                if bkg is None:
+                    self.bkg_map = bkg_map
             print('{} sources detected!'.format(len(self.x)))
+            _checkpoint_detection(self, {'bkg_map':self.bkg_map} if bkg is None else {})
+
+            flux, flux_err = self._photometry(image, annulus=False)[:2]
+
+            if self.morph_params == True:
+                self._morph_catalog(data, flux=flux, flux_err=flux_err, median_bkg=None, threshold=10,
+                    save_file=save_file, path=path, filename=filename, file_format=file_format, checkpoint_interval=checkpoint_interval,
+                    keep_catalog=keep_catalog)
 
-            positions = []
-            for i in range(len(self.x)):
-                positions.append((self.x[i], self.y[i]))
+                return
+
+            self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag,
+                flux=flux, flux_err=flux_err, median_bkg=None, save=save_file, path=path, filename=filename, file_format=file_format)
 
-            aper_stats = ApertureStats(self.data, CircularAperture(positions, r=self.aperture), error=self.error)
+            return 
 
-            flux_err = None if self.error is None else aper_stats.sum_err
+        flux, flux_err, background, area = self._photometry(image, annulus=bkg is None)
+        if bkg is None:
+            flux = flux - (background * area)
 
+        if self.error is None:
             if self.morph_params == True:
-                prop_list, moment_list, self.segm_map = morph_parameters(data, self.x, self.y, exptime=self.exptime, nsig=self.nsig, kernel_size=self.kernel_size, median_bkg=None, 
-                    invert=self.invert, deblend=self.deblend)
-                tbl = make_table(prop_list, moment_list)
-                self.cat = make_dataframe(table=tbl, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag,
-                    flux=aper_stats.sum, flux_err=flux_err, median_bkg=None, save=save_file, path=path, filename=filename)
-                
-                return 
+                self._morph_catalog(image, flux=flux, flux_err=None, median_bkg=background, threshold=self.threshold,
+                    save_file=save_file, path=path, filename=filename, file_format=file_format, checkpoint_interval=checkpoint_interval,
+                    keep_catalog=keep_catalog)
+                return
 
-            self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag, 
-                flux=aper_stats.sum, flux_err=flux_err, median_bkg=None, save=save_file, path=path, filename=filename)
-            
+            self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag,
+                flux=flux, median_bkg=background, save=save_file, path=path, filename=filename, file_format=file_format)
             return 
+           
+        if self.morph_params == True:
+            try:
+                self._morph_catalog(image, flux=flux, flux_err=flux_err, median_bkg=background, threshold=self.threshold,
+                    save_file=save_file, path=path, filename=filename, file_format=file_format, checkpoint_interval=checkpoint_interval,
+                    keep_catalog=keep_catalog)
+            except AttributeError:
+                raise ValueError(f'Could not compute morphological parameters with nsig={self.nsig}, as no segmentation patch could be generated. Reduce the value of nsig and try again.')
+            return
+
+        self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag, flux=flux,
+            flux_err=flux_err, median_bkg=background, save=save_file, path=path, filename=filename, file_format=file_format)
+        return
+
+    def _photometry(self, image, annulus=True):
+        """
+        Computes the aperture sums of the sources and, if annulus=True, the sigma-clipped
+        median background in the annuli, with the engine set by the phot_method attribute.
+
+        Returns:
+            The aperture sums, their uncertainties (None if there is no error map),
+            the median background per pixel (None if annulus=False), and the aperture area.
+        """
+
+        if isinstance(self.phot_method, ApertureMatrix):
+            if len(self.phot_method.x) != len(self.x):
+                raise ValueError('The ApertureMatrix contains {} sources but there are {} positions.'.format(len(self.phot_method.x), len(self.x)))
+            flux, flux_err = self.phot_method.flux(image, error=self.error)
+            background = self.phot_method.background(image) if annulus else None
+            return flux, flux_err, background, np.pi * self.phot_method.aperture**2
+
+        if self.phot_method == 'stencil':
+            return aperture_photometry(image, self.x, self.y, aperture=self.aperture, annulus_in=self.annulus_in if annulus else None,
+                annulus_out=self.annulus_out, error=self.error)
 
         positions = []
         for i in range(len(self.x)):
             positions.append((self.x[i], self.y[i]))
 
         apertures = CircularAperture(positions, r=self.aperture)
-        aper_stats = ApertureStats(self.data, apertures, error=self.error)
+        aper_stats = ApertureStats(image, apertures, error=self.error)
+        flux_err = None if self.error is None else aper_stats.sum_err
 
-        if self.bkg is None:
+        background = None
+        if annulus:
             annulus_apertures = CircularAnnulus(positions, r_in=self.annulus_in, r_out=self.annulus_out)
-            bkg_stats = ApertureStats(self.data, annulus_apertures, error=self.error, sigma_clip=SigmaClip())
+            bkg_stats = ApertureStats(image, annulus_apertures, error=self.error, sigma_clip=SigmaClip())
             background = bkg_stats.median
-            flux = aper_stats.sum - (background * apertures.area)
-        elif self.bkg == 0:
-            flux = aper_stats.sum 
-            background = None 
 
-        if self.error is None:
-            if self.morph_params == True:
-                prop_list, moment_list, self.segm_map = morph_parameters(self.data, self.x, self.y, exptime=self.exptime, nsig=self.nsig, kernel_size=self.kernel_size, median_bkg=background, 
-                    invert=self.invert, deblend=self.deblend, threshold=self.threshold)
-                tbl = make_table(prop_list, moment_list)
-                self.cat = make_dataframe(table=tbl, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag,
-                    flux=flux, median_bkg=background, save=save_file, path=path, filename=filename)
-                return 
-
-            self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag, 
-                flux=flux, median_bkg=background, save=save_file, path=path, filename=filename)
-            return 
-           
-        if self.morph_params == True:
-            try:
-                prop_list, moment_list, self.segm_map = morph_parameters(self.data, self.x, self.y, exptime=self.exptime, nsig=self.nsig, kernel_size=self.kernel_size, median_bkg=background, 
-                        invert=self.invert, deblend=self.deblend, threshold=self.threshold)
-            except AttributeError:
-                raise ValueError(f'Could not compute morphological parameters with nsig={self.nsig}, as no segmentation patch could be generated. Reduce the value of nsig and try again.')
-            
-            tbl = make_table(prop_list, moment_list)
-            self.cat = make_dataframe(table=tbl, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag, 
-                flux=flux, flux_err=aper_stats.sum_err, median_bkg=background, save=save_file, path=path, filename=filename)
-            return 
+        return aper_stats.sum, flux_err, background, apertures.area
+
+    def _morph_catalog(self, data, flux, flux_err=None, median_bkg=None, threshold=10, save_file=True, path=None, filename=None,
+        file_format='csv', checkpoint_interval=300, keep_catalog=True):
+        """
+        Computes the morphological parameters chunk by chunk and appends each chunk
+        of rows to the catalog file as soon as it is complete, see the _write_morph_catalog function.
+        """
+
+        def to_dataframe(tables, start, stop):
+            tbl, mask = tables['features']
+            return make_dataframe(table=tbl, x=_take(self.x, start, stop), y=_take(self.y, start, stop), zp=self.zp, obj_name=_take(self.obj_name, start, stop),
+                field_name=_take(self.field_name, start, stop), flag=_take(self.flag, start, stop), flux=_take(flux, start, stop),
+                flux_err=_take(flux_err, start, stop), median_bkg=_take(median_bkg, start, stop), save=False, mask=mask, zernike_order=self.zernike_order)
+
+        def make_tables(chunk_props, chunk_moments):
+            return {'features': make_table(np.array(chunk_props, dtype=object), chunk_moments, return_mask=True, zernike_order=self.zernike_order)}
+
+        def morph_chunks(done):
+            return iter_morph_parameters(data, _take(self.x, done, None), _take(self.y, done, None), exptime=self.exptime, nsig=self.nsig, 
+                kernel_size=self.kernel_size, median_bkg=_take(median_bkg, done, None), invert=self.invert, deblend=self.deblend, threshold=threshold, 
+                n_jobs=self.n_jobs, field_convolve=self.field_convolve, conv_method=self.conv_method, min_size=self.min_size,
+                noise=self.error if isinstance(self.noise, str) and self.noise == 'error' else self.noise, n_threads=self.n_threads, 
+                counter=self.contour_counts, zernike_order=self.zernike_order)
+
+        _write_morph_catalog(self, morph_chunks, make_tables, to_dataframe, save_file=save_file, path=path, filename=filename, 
+            file_format=file_format, checkpoint_interval=checkpoint_interval, keep_catalog=keep_catalog)
+
+    def spatial_index(self, wcs=None):
+        """
+        Builds a KD-tree index of the positions in the catalog, for cone and box queries,
+        neighbour counts, and cross-matching against other catalogs, see the spatial.SpatialIndex class.
+        The index is also saved as the index attribute.
 
-        self.cat = make_dataframe(table=None, x=self.x, y=self.y, zp=self.zp, obj_name=self.obj_name, field_name=self.field_name, flag=self.flag, flux=flux, 
-            flux_err=aper_stats.sum_err, median_bkg=background, save=save_file, path=path, filename=filename)
-        return 
+        Args:
+            wcs (WCS, optional): The astropy WCS of the data, if input the index is built on the
+                sky coordinates and the distances are in arcseconds. Defaults to None, in which
+                case the pixel positions are used.
+
+        Returns:
+            The SpatialIndex of the catalog rows.
+        """
+
+        return _spatial_index(self, wcs=wcs)
 
     def plot(self, index=None, obj_name=None, name='', pix_conversion=5, size=100):
         """
@@ -308,9 +445,14 @@ class Catalog:
             AxesImage.
         """
             
+        if isinstance(self.bkg, np.ndarray):
+            image, bkg = self.data - self.bkg, 0
+        else:
+            image, bkg = self.data, self.bkg
+
         if index is None and obj_name is None:
-            plot_segm(self.data, nsig=self.nsig, kernel_size=self.kernel_size, invert=self.invert, 
-                median_bkg=self.bkg, deblend=self.deblend, name=name, pix_conversion=pix_conversion,
+            plot_segm(image, nsig=self.nsig, kernel_size=self.kernel_size, invert=self.invert, 
+                median_bkg=bkg, deblend=self.deblend, name=name, pix_conversion=pix_conversion,
                 r_in=self.annulus_in, r_out=self.annulus_out)
         else:
             if len(self.cat.shape) == 2:
@@ -320,13 +462,587 @@ class Catalog:
             else:
                 xpix, ypix = float(self.cat['xpix']), float(self.cat['ypix'])
 
-            plot_segm(self.data, xpix=xpix, ypix=ypix, median_bkg=self.bkg, nsig=self.nsig, 
+            plot_segm(image, xpix=xpix, ypix=ypix, median_bkg=bkg, nsig=self.nsig, 
                 kernel_size=self.kernel_size, invert=self.invert, deblend=self.deblend, name=name,
                 r_in=self.annulus_in, r_out=self.annulus_out, size=100, pix_conversion=pix_conversion)
         return
 
+class MultiBandCatalog:
+    """
+    Creates a catalog object for several bands of the same field, e.g. the paired 
+    filters displayed by the plot_two_filters function. The images are segmented only once, 
+    on a chosen detection band or on a chi-square image stacking all the bands, and the 
+    segment of each source is then reused to measure the morphological parameters in every
+    band, so the measurements of the different bands are those of the same pixels. The aperture
+    photometry is likewise computed at the same positions in every band (forced photometry).
+
+    The output is a single wide catalog, with one row per source. The positions and the 
+    obj_name, field_name, and flag columns are shared, while the photometric and morphological
+    columns of each band are suffixed with the band name, e.g. 'flux_g' and 'area_g'.
+
+    Args:
+        data (dict): Dictionary mapping each band name to its 2D array or the path to its FITS
+            file, see the Catalog class. All the bands must be on the same pixel grid.
+        detection_band (str): The name of the band in which the sources are segmented, or 'chi2', in
+            which case the segmentation is performed on the square root of the sum of the squared
+            signal-to-noise images of the background-subtracted bands (the chi-square image of Szalay et al. 1999),
+            after subtracting its own background. Defaults to 'chi2'.
+        bkg (dict, optional): The bkg argument of each band, see the Catalog class. A single value
+            (None or 0) applies to all the bands. Defaults to None.
+        error (dict, optional): The rms error map of each band, see the Catalog class. Bands without
+            an error map can be omitted. If detection_band='chi2' the error maps are used as the noise 
+            of the signal-to-noise images, otherwise the sigma-clipped standard deviation of the band is used.
+            Defaults to None.
+        zp (float, dict, optional): The zeropoint of each band, or a single zeropoint for all the bands.
+            Defaults to None.
+        noise (str, float, ndarray, optional): The noise model of the detection image, see the Catalog class.
+            If noise='error' the error map of the detection band is used, which is not applicable if 
+            detection_band='chi2'. Defaults to None.
+
+    Note:
+        The remaining arguments are the same as those of the Catalog class and apply to all 
+        the bands. When the segmentation is performed on the stamps of the detection band, only
+        the convolution of the stamps is repeated for every other band, as the convolved data is
+        used to compute the morphological properties, see the SourceCatalog class of photutils.
+        If phot_method='stencil' a single photometry.ApertureMatrix is built for the positions
+        and shared by all the bands.
+
+    Example:
+        >>> catalog = MultiBandCatalog({'g':data_g, 'r':data_r}, detection_band='r', error={'g':rms_g, 'r':rms_r})
+        >>> catalog.create(save_file=False)
+        >>> catalog.cat[['flux_g', 'flux_r', 'area_g', 'area_r']]
+    """
+
+    def __init__(self, data, detection_band='chi2', x=None, y=None, bkg=None, error=None, zp=None, exptime=None, morph_params=True, 
+        nsig=0.7, threshold=10, deblend=False, obj_name=None, field_name=None, flag=None, aperture=15, annulus_in=20, annulus_out=35, 
+        kernel_size=21, invert=False, tile_size=None, tile_overlap=100, n_jobs=1, field_convolve=False, conv_method='auto', ext=0, phot_method='photutils', min_size=None,
+        binning=None, noise=None, n_threads=1, zernike_order=None):
+
+        if not isinstance(data, dict) or len(data) == 0:
+            raise ValueError('The data must be a dictionary mapping each band name to its image.')
+        if detection_band != 'chi2' and detection_band not in data:
+            raise ValueError("Invalid detection_band, options are 'chi2' or one of the bands: {}.".format(', '.join(map(str, data))))
+        if isinstance(noise, str) and noise == 'error' and detection_band == 'chi2':
+            raise ValueError("The noise can not be set to 'error' if detection_band='chi2', use 'global' or 'mesh' instead.")
+
+        def band_value(value, band):
+            return value.get(band) if isinstance(value, dict) else value
+
+        #One Catalog per band holds its data, background, error map, and zeropoint
+        self.catalogs = {}
+        for band in data:
+            self.catalogs[band] = Catalog(data[band], x=x, y=y, bkg=band_value(bkg, band), error=band_value(error, band), zp=band_value(zp, band),
+                exptime=exptime, morph_params=morph_params, nsig=nsig, threshold=threshold, deblend=deblend, obj_name=obj_name, field_name=field_name, 
+                flag=flag, aperture=aperture, annulus_in=annulus_in, annulus_out=annulus_out, kernel_size=kernel_size, invert=invert, tile_size=tile_size, 
+                tile_overlap=tile_overlap, n_jobs=n_jobs, field_convolve=field_convolve, conv_method=conv_method, ext=ext, phot_method=phot_method, min_size=min_size,
+                binning=binning, noise=noise if detection_band == band else None, n_threads=n_threads,
+                zernike_order=zernike_order)
+
+        reference = self.catalogs[next(iter(data))]
+        self.bands = list(data)
+        self.detection_band = detection_band
+        self.x, self.y = reference.x, reference.y
+        self.obj_name, self.field_name, self.flag = reference.obj_name, reference.field_name, reference.flag
+        self.exptime = exptime
+        self.morph_params = morph_params
+        self.nsig = nsig
+        self.threshold = threshold
+        self.deblend = deblend
+        self.aperture = aperture 
+        self.annulus_in = annulus_in
+        self.annulus_out = annulus_out
+        self.kernel_size = kernel_size
+        self.invert = invert 
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.zernike_order = zernike_order
+        self.field_convolve = field_convolve
+        self.conv_method = conv_method
+        self.phot_method = phot_method
+        self.min_size = min_size
+        self.binning = binning
+        self.noise = noise
+        self.cat = None
+
+    def create(self, save_file=True, path=None, filename=None, file_format='csv', checkpoint=None, checkpoint_interval=300, keep_catalog=True):
+        """
+        Creates the multi-band photometric and morphological catalog. If no positions
+        were input the sources are detected in the detection band, see the create
+        method of the Catalog class.
+
+        Args:
+            save_file (bool): If set to False then the catalog will not be saved to the machine. Defaults to True.
+            path (str, optional): By default the catalog will be saved to the local directory, 
+                unless an absolute path to a directory is entered here.
+            filename (str, optional): Name of the output catalog. Default name is 'pyBIA_catalog'.
+            file_format (str): The format of the saved catalog, either 'csv', 'npy', 'parquet', or 'feather'.
+                The rows are appended to the file in chunks as they are processed, see the CatalogWriter class. 
+                Defaults to 'csv'.
+            checkpoint (str, optional): Path to a directory where the progress of the run will be checkpointed, see the 
+                create method of the Catalog class. The checkpoint file is keyed by all the bands, the positions, and the
+                parameters, and holds the background map of each band subtracted before the detection. Defaults to None.
+            checkpoint_interval (float): The minimum number of seconds between checkpoints. Defaults to 300.
+            keep_catalog (bool): If False the rows of the morphological catalog are only written to the file and
+                the cat attribute is set to None, see the create method of the Catalog class. Defaults to True.
+
+        Returns:
+            A pandas dataframe of all the objects, which is also saved as the cat attribute. The background 
+            map subtracted from each band (None if the band was not background-subtracted) is saved in the
+            bkg_map dictionary attribute, the segmentation image of the last stamp as the segm_map attribute, and
+            the number of objects without enough contour points, over all the bands, as the contour_counts attribute.
+        """
+
+        if not keep_catalog and not save_file:
+            raise ValueError('The catalog must be saved (save_file=True) if it is not kept in memory (keep_catalog=False).')
+        if save_file:
+            _check_file_format(file_format)
+        images, bkgs = {}, {}
+        shape = np.shape(self.catalogs[self.bands[0]].data)
+        for band, catalog in self.catalogs.items():
+            if np.shape(catalog.data) != shape:
+                raise ValueError('All the bands must be the same shape, band {} has shape {} instead of {}.'.format(band, np.shape(catalog.data), shape))
+            images[band], bkgs[band] = _band_image(catalog.data, bkg=catalog.bkg, error=catalog.error)
+        self.x, self.y = _check_positions(self)
+
+        #The first band is hashed as the image of the run and the other bands as parameters
+        params = {'bands': [(band, checkpoint_key(images[band])) for band in self.bands[1:]]}
+        for band, catalog in self.catalogs.items():
+            params['bkg_'+str(band)], params['error_'+str(band)] = catalog.bkg, catalog.error
+        _open_checkpoint(self, checkpoint, images[self.bands[0]], detection_band=self.detection_band, **params)
+
+        forced = self.x is not None #Positions input
+        self.bkg_map = {band: self.catalogs[band].bkg if isinstance(self.catalogs[band].bkg, np.ndarray) else None for band in self.bands}
+        subtracted = {} #The background-subtracted bands, only computed when needed
+
+        def background_subtracted(band):
+            if band not in subtracted:
+                if bkgs[band] is None:
+                    if 'bkg_map_'+str(band) in self._checkpoint: #Saved during the interrupted run
+                        self.bkg_map[band] = self._checkpoint['bkg_map_'+str(band)]
+                    else:
+                        self.bkg_map[band] = _background_subtract(images[band], self.annulus_out)[1]
+                    subtracted[band] = images[band] - self.bkg_map[band]
+                else:
+                    subtracted[band] = images[band]
+            return subtracted[band]
+
+        if not forced: #Background subtraction and source detection on the detection band
+            datas = {band: background_subtracted(band) for band in self.bands}
+            detection = datas[self.detection_band] if self.detection_band != 'chi2' else self._chi2_image(datas)
+            if 'x' in self._checkpoint: #Resume with the sources detected during the interrupted run
+                self.x, self.y = self._checkpoint['x'], self._checkpoint['y']
+            else:
+                self.x, self.y = _detect_sources(self, detection, bkg=0)[:2]
+            print('{} sources detected!'.format(len(self.x)))
+            _checkpoint_detection(self, {'bkg_map_'+str(band): self.bkg_map[band] for band in self.bands if bkgs[band] is None})
+            threshold = 10
+        else:
+            datas = images
+            threshold = self.threshold
+
+        #Forced photometry at the same positions in every band
+        if self.phot_method == 'stencil' and len(self.bands) > 1:
+            phot_method = ApertureMatrix(self.x, self.y, shape, aperture=self.aperture, annulus_in=self.annulus_in, annulus_out=self.annulus_out)
+        else:
+            phot_method = self.phot_method
+        fluxes, flux_errs, median_bkgs = {}, {}, {}
+        for band, catalog in self.catalogs.items():
+            catalog.x, catalog.y, catalog.phot_method = self.x, self.y, phot_method
+            if forced and bkgs[band] is None: #The background is the median in the annuli
+                flux, flux_err, background, area = catalog._photometry(images[band], annulus=True)
+                fluxes[band], flux_errs[band], median_bkgs[band] = flux - (background * area), flux_err, background
+            else:
+                fluxes[band], flux_errs[band] = catalog._photometry(images[band], annulus=False)[:2]
+                median_bkgs[band] = None
+
+        def to_dataframe(tables, start, stop):
+            frames = [make_dataframe(table=None, x=_take(self.x, start, stop), y=_take(self.y, start, stop), obj_name=_take(self.obj_name, start, stop),
+                field_name=_take(self.field_name, start, stop), flag=_take(self.flag, start, stop), save=False)]
+            for band, catalog in self.catalogs.items():
+                table, mask = (None, None) if tables is None else tables['features_'+str(band)]
+                df = make_dataframe(table=table, zp=catalog.zp, flux=_take(fluxes[band], start, stop), 
+                    flux_err=_take(flux_errs[band], start, stop), median_bkg=_take(median_bkgs[band], start, stop), save=False, mask=mask,
+                    zernike_order=self.zernike_order)
+                frames.append(df.add_suffix('_'+str(band)))
+            return pd.concat(frames, axis=1)
+
+        if self.morph_params == False:
+            self.cat = to_dataframe(None, 0, len(self.x))
+            if save_file:
+                with CatalogWriter(path=path, filename=filename, file_format=file_format) as writer:
+                    writer.write(self.cat)
+            return self.cat
+
+        #The detection band is segmented and measured, the other bands are only measured
+        noise = self.noise
+        if self.detection_band == 'chi2':
+            if forced:
+                detection = self._chi2_image({band: background_subtracted(band) for band in self.bands})
+            detection_bkg, measured = None, self.bands
+        else:
+            detection, detection_bkg = datas[self.detection_band], median_bkgs[self.detection_band]
+            if isinstance(self.noise, str) and self.noise == 'error':
+                noise = self.catalogs[self.detection_band].error
+            measured = [band for band in self.bands if band != self.detection_band]
+        order = [self.detection_band] + measured
+
+        def make_tables(chunk_props, chunk_moments):
+            tables = {}
+            for j, band in enumerate(order):
+                if band in self.catalogs: #Excludes the chi-square image
+                    tables['features_'+str(band)] = make_table(np.array(chunk_props[j], dtype=object), chunk_moments[j], return_mask=True, 
+                        zernike_order=self.zernike_order)
+            return tables
+
+        def morph_chunks(done):
+            return iter_morph_parameters(detection, _take(self.x, done, None), _take(self.y, done, None), exptime=self.exptime, nsig=self.nsig,
+                kernel_size=self.kernel_size, median_bkg=_take(detection_bkg, done, None), invert=self.invert, deblend=self.deblend, threshold=threshold, 
+                n_jobs=self.n_jobs, field_convolve=self.field_convolve, conv_method=self.conv_method, min_size=self.min_size, 
+                bands=[datas[band] for band in measured], band_bkg=[_take(median_bkgs[band], done, None) for band in measured], noise=noise, 
+                n_threads=self.n_threads, counter=self.contour_counts, zernike_order=self.zernike_order)
+
+        _write_morph_catalog(self, morph_chunks, make_tables, to_dataframe, save_file=save_file, path=path, filename=filename, 
+            file_format=file_format, checkpoint_interval=checkpoint_interval, keep_catalog=keep_catalog)
+
+        return self.cat
+
+    def spatial_index(self, wcs=None):
+        """
+        Builds a KD-tree index of the positions in the multi-band catalog, which are shared by
+        all the bands, see the spatial_index method of the Catalog class.
+        """
+
+        return _spatial_index(self, wcs=wcs)
+
+    def _chi2_image(self, datas):
+        """
+        Stacks the background-subtracted bands into the square root of the sum of their squared 
+        signal-to-noise images. The background of the stacked image, which for pure noise is
+        about the square root of the number of bands, is then subtracted.
+        """
+
+        chi2 = np.zeros(np.shape(datas[self.bands[0]]))
+        for band in self.bands:
+            error = self.catalogs[band].error
+            if error is None:
+                error = sigma_clipped_stats(datas[band])[2]
+            chi2 += (np.asarray(datas[band]) / error)**2
+
+        return _background_subtract(np.sqrt(chi2), self.annulus_out)[0]
+
+def load_fits(path, ext=0):
+    """
+    Opens the image stored in a FITS file with memory mapping. The array is
+    not read into memory, only the sections that are sliced, such as the stamps
+    cropped out around each source, are read from disk when accessed.
+
+    Note:
+        Images that are scaled with the BZERO/BSCALE keywords, as well as compressed 
+        images, cannot be memory-mapped and will be read entirely when accessed.
+
+    Args:
+        path (str): Path to the FITS file.
+        ext (int, str): The extension containing the image. Defaults to 0.
+
+    Returns:
+        The memory-mapped 2D array.
+    """
+
+    with fits.open(path, memmap=True) as hdul:
+        data = hdul[ext].data #The memory map remains open after the file is closed
+
+    if data is None:
+        raise ValueError('No image data found in extension {} of {}'.format(ext, path))
+    if len(data.shape) != 2:
+        raise ValueError('The FITS image must be 2 dimensional.')
+
+    return data
+
+def _take(values, start, stop):
+    #The optional columns may be None or a single value
+    if values is None or np.ndim(values) == 0:
+        return values
+    return np.asarray(values)[start:stop]
+
+def _band_image(data, bkg=None, error=None):
+    """
+    Checks the background and rms error map of an image, as input to the Catalog class.
+
+    Returns:
+        The image to process, background subtracted if bkg is a 2D map, and the 
+        background argument to proceed with, 0 if the map was subtracted.
+    """
+
+    if error is not None and np.shape(data) != np.shape(error):
+        raise ValueError("The rms error map must be the same shape as the data array.")
+    if isinstance(bkg, np.ndarray):
+        if np.shape(data) != bkg.shape:
+            raise ValueError("The background map must be the same shape as the data array.")
+        return data - bkg, 0 #Proceed as if the data were background subtracted
+    if bkg is not None and bkg != 0:
+        raise ValueError('Invalid background input -- if data is background subtracted set bkg=0, otherwise if bkg=None the background will be approximated.')
+
+    return data, bkg
+
+def _check_positions(catalog):
+    """
+    Checks the apertures and the input positions of a Catalog or MultiBandCatalog.
+
+    Returns:
+        The x and y positions, a single position being converted to arrays of unit length.
+    """
+
+    if catalog.aperture > catalog.annulus_in or catalog.annulus_in > catalog.annulus_out:
+        raise ValueError('The radius of the inner and out annuli must be larger than the aperture radius.')
+    x, y = catalog.x, catalog.y
+    if x is not None:
+        try: #If position array is a single number it will be converted to a list of unit length
+            __ = len(x)
+        except:
+            x, y = np.array([x]), np.array([y])
+        if len(x) != len(y):
+            raise ValueError("The two position arrays (x & y) must be the same size.")
+
+    return x, y
+
+def _background_subtract(image, annulus_out):
+    """
+    Subtracts the background of an image prior to the source detection. The sub-array when 
+    padding is a square encapsulating the outer annuli, while the robust median is 
+    taken if the image is smaller than the sub-array.
+
+    Returns:
+        The background-subtracted image and the background map.
+    """
+
+    Ny, Nx = image.shape
+    length = annulus_out*2*2.
+    if Nx < length or Ny < length: #Small image, no need to pad, just take robust median
+        median = sigma_clipped_stats(image)[1]
+        return image - median, np.full(image.shape, median)
+
+    return subtract_background(image, length=length, return_background=True)
+
+def _detect_sources(catalog, image, bkg=None):
+    """
+    Detects the sources with the detection parameters of a Catalog or MultiBandCatalog, 
+    tile by tile if the tile_size attribute is set, in a binned frame (of every tile) if the binning 
+    attribute is set, and otherwise with the segm_find function. If bkg=None the background is first
+    subtracted, see the _background_subtract function.
+
+    Returns:
+        The x and y positions of the sources, the background-subtracted image, and the 
+        subtracted background map (None if bkg is not None).
+    """
+
+    if catalog.nsig < 1 and catalog.deblend == False:
+        warn('Low nsig warning, for proper source detection do an initial run with a higher nsig, or set deblend=True.')
+
+    if catalog.tile_size is not None:
+        x, y, data = tiled_source_detection(image, tile_size=catalog.tile_size, overlap=catalog.tile_overlap, nsig=catalog.nsig, 
+            kernel_size=catalog.kernel_size, deblend=catalog.deblend, bkg=bkg, length=catalog.annulus_out*2*2., n_jobs=catalog.n_jobs, 
+            conv_method=catalog.conv_method, binning=catalog.binning)
+        return x, y, data, image - data if bkg is None else None
+
+    print('Running source detection...')
+    data, bkg_map = _background_subtract(image, catalog.annulus_out) if bkg is None else (image, None)
+    if catalog.binning is not None:
+        x, y = coarse_source_detection(data, binning=catalog.binning, nsig=catalog.nsig, kernel_size=catalog.kernel_size, 
+            deblend=catalog.deblend, conv_method=catalog.conv_method)
+    else:
+        segm, convolved_data = segm_find(data, nsig=catalog.nsig, kernel_size=catalog.kernel_size, deblend=catalog.deblend, conv_method=catalog.conv_method)
+        props = segmentation.SourceCatalog(data, segm, convolved_data=convolved_data)
+        try:
+            x, y = props.centroid[:,0], props.centroid[:,1]
+        except:
+            x, y = props.centroid[0], props.centroid[1]
+
+    return x, y, data, bkg_map
+
+def _open_checkpoint(catalog, checkpoint, data, **params):
+    """
+    Sets the _checkpoint_file and _checkpoint attributes of a Catalog or MultiBandCatalog, the latter
+    holding the state saved by an interrupted run, empty if there is none or if checkpoint is None.
+    The key of the checkpoint file hashes the data, the positions, the detection and segmentation 
+    parameters of the run, and the additional params (e.g. the background and error maps), 
+    see the checkpoint_key function.
+    """
+
+    catalog._checkpoint_file, catalog._checkpoint = None, {}
+    if checkpoint is None:
+        return
+
+    key = checkpoint_key(data, catalog.x, catalog.y, nsig=catalog.nsig, kernel_size=catalog.kernel_size, threshold=catalog.threshold,
+        deblend=catalog.deblend, invert=catalog.invert, exptime=catalog.exptime, min_size=catalog.min_size, binning=catalog.binning, 
+        tile_size=catalog.tile_size, tile_overlap=catalog.tile_overlap, field_convolve=catalog.field_convolve, conv_method=catalog.conv_method, 
+        zernike_order=catalog.zernike_order, noise=catalog.noise, **params)
+    catalog._checkpoint_file = os.path.join(checkpoint, 'pyBIA_checkpoint_'+key+'.npz')
+    catalog._checkpoint = load_checkpoint(catalog._checkpoint_file)
+
+def _checkpoint_detection(catalog, bkg_maps):
+    #Checkpoints the detected positions and the subtracted background maps before the morphological parameters are computed
+    if catalog._checkpoint_file is not None and catalog.morph_params == True and 'x' not in catalog._checkpoint:
+        catalog._checkpoint.update({'x':np.asarray(catalog.x), 'y':np.asarray(catalog.y)}, **bkg_maps)
+        save_checkpoint(catalog._checkpoint_file, catalog._checkpoint)
+
+def _write_morph_catalog(catalog, morph_chunks, make_tables, to_dataframe, save_file=True, path=None, filename=None, 
+    file_format='csv', checkpoint_interval=300, keep_catalog=True):
+    """
+    Computes the morphological parameters of a Catalog or MultiBandCatalog chunk by chunk and appends 
+    each chunk of rows to the catalog file as soon as it is complete. Sets the cat, segm_map, and contour_counts
+    attributes. If a checkpoint file was set the features are checkpointed every checkpoint_interval seconds,
+    and the sources already in the checkpoint are skipped. If keep_catalog=False the rows are only written 
+    to the file, and only the features are held in memory if checkpointing.
+
+    Args:
+        catalog (Catalog, MultiBandCatalog): The catalog being created.
+        morph_chunks (callable): Returns the iter_morph_parameters generator of the sources from the given index onwards.
+        make_tables (callable): Returns the dictionary of the (table, mask) tuples of the chunk properties and moments,
+            keyed by the name under which the features are checkpointed, which starts with 'features'.
+        to_dataframe (callable): Returns the rows from start to stop given the dictionary of the (table, mask) tuples, 
+            in which the mask is None for the features read from the checkpoint.
+    """
+
+    #The sources are processed in order, so the checkpoint holds the features of the first done sources
+    names = [name for name in catalog._checkpoint if name.startswith('features')]
+    tables, done, catalog.segm_map, catalog.contour_counts = {}, 0, None, Counter()
+    if len(names) > 0:
+        tables = {name: [catalog._checkpoint[name]] for name in names}
+        done, catalog.segm_map = len(catalog._checkpoint[names[0]]), catalog._checkpoint.get('segm_map')
+        print('Resuming from checkpoint, {} out of {} sources already processed.'.format(done, len(catalog.x)))
+
+    frames = []
+    print('Writing catalog...')
+    writer = CatalogWriter(path=path, filename=filename, file_format=file_format) if save_file else None
+    try:
+        if done > 0:
+            df = to_dataframe({name: (tables[name][0], None) for name in names}, 0, done)
+            if writer is not None:
+                writer.write(df)
+            if keep_catalog:
+                frames.append(df)
+        last_checkpoint = time.time()
+        if done < len(catalog.x):
+            for start, chunk_props, chunk_moments, segm in morph_chunks(done):
+                chunk_tables = make_tables(chunk_props, chunk_moments)
+                start += done
+                stop = start + len(next(iter(chunk_tables.values()))[0])
+                df = to_dataframe(chunk_tables, start, stop)
+                if writer is not None:
+                    writer.write(df)
+                if keep_catalog:
+                    frames.append(df)
+                if segm is not None: #None if the last source in the chunk was not detected
+                    catalog.segm_map = segm.data
+                if catalog._checkpoint_file is not None: #The features are checkpointed
+                    for name, (tbl, mask) in chunk_tables.items():
+                        tables.setdefault(name, []).append(tbl)
+                    if time.time() - last_checkpoint > checkpoint_interval and stop < len(catalog.x):
+                        catalog._checkpoint.update({name: np.concatenate(tables[name]) for name in tables})
+                        if catalog.segm_map is not None:
+                            catalog._checkpoint['segm_map'] = catalog.segm_map
+                        save_checkpoint(catalog._checkpoint_file, catalog._checkpoint)
+                        last_checkpoint = time.time()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    catalog.cat = pd.concat(frames, ignore_index=True) if keep_catalog else None
+    _report_contours(catalog.contour_counts)
+    if catalog._checkpoint_file is not None and os.path.exists(catalog._checkpoint_file): #The run is complete
+        os.remove(catalog._checkpoint_file)
+
+def _spatial_index(catalog, wcs=None):
+    #Builds the SpatialIndex of the cat attribute of a Catalog or MultiBandCatalog and saves it as the index attribute
+    if catalog.cat is None:
+        raise ValueError('The catalog has not been created, run the create method first.')
+    catalog.index = SpatialIndex.from_catalog(catalog.cat, wcs=wcs)
+
+    return catalog.index
+
+def _report_contours(counter):
+    #Prints the number of objects whose Fourier descriptors were set to zero
+    if counter['no_contour'] > 0 or counter['short_contour'] > 0:
+        print('NOTE: {} segmented objects had no contour and {} had fewer than 3 contour points, their missing Fourier descriptors '
+            'were set to zero (see the contour_counts attribute).'.format(counter['no_contour'], counter['short_contour']))
+
+def checkpoint_key(data, x=None, y=None, **params):
+    """
+    Computes the key that identifies the checkpoint of a Catalog run,
+    a SHA-1 hash of the image, the positions (if any), and the parameters.
+
+    Args:
+        data (ndarray): 2D array. Memory-mapped data is hashed in bands of rows.
+        x (ndarray, optional): 1D array containing the x-pixel positions. Defaults to None.
+        y (ndarray, optional): 1D array containing the y-pixel positions. Defaults to None.
+        **params: The parameters of the run, e.g. nsig, kernel_size, threshold, and deblend. Array
+            parameters, e.g. a background or noise map, are hashed by their contents, and None is
+            distinguished from 0.
+
+    Returns:
+        The hexadecimal key.
+    """
+
+    sha = hashlib.sha1()
+    _hash_array(sha, data)
+    for positions in (x, y):
+        if positions is not None:
+            sha.update(np.asarray(positions, dtype=float).tobytes())
+    for name, value in sorted(params.items()):
+        if isinstance(value, np.ndarray):
+            sha.update(name.encode())
+            _hash_array(sha, value)
+            params[name] = 'array'
+    sha.update(repr(sorted(params.items())).encode())
+
+    return sha.hexdigest()
+
+def _hash_array(sha, data):
+    #Updates the hash with the shape, dtype, and contents of an array, memory-mapped data in bands of rows
+    sha.update(str((data.shape, data.dtype.str)).encode())
+    if data.ndim < 2:
+        sha.update(np.ascontiguousarray(data).tobytes())
+        return
+    rows = max(1, 2**25 // max(1, data[0].nbytes)) #~32MB at a time
+    for i in range(0, data.shape[0], rows):
+        sha.update(np.ascontiguousarray(data[i:i+rows]).tobytes())
+
+def save_checkpoint(filename, state):
+    """
+    Saves the checkpoint arrays to an .npz file. The file is first written to a
+    temporary file which then replaces the previous checkpoint, so that an
+    interruption during the write never corrupts the last checkpoint.
+
+    Args:
+        filename (str): Path of the checkpoint file.
+        state (dict): The arrays to save.
+    """
+
+    tmp_file = filename[:-len('.npz')] + '.tmp.npz' if filename.endswith('.npz') else filename + '.tmp.npz'
+    np.savez(tmp_file, **state)
+    os.replace(tmp_file, filename)
+
+def load_checkpoint(filename):
+    """
+    Loads the arrays saved with the save_checkpoint function.
+
+    Args:
+        filename (str): Path of the checkpoint file.
+
+    Returns:
+        Dictionary of the saved arrays, empty if the file does not exist.
+    """
+
+    if not os.path.exists(filename):
+        return {}
+    with np.load(filename) as state:
+        return {key:state[key] for key in state.files}
+
 def morph_parameters(data, x, y, size=100, nsig=0.6, threshold=10, kernel_size=21, median_bkg=None, 
-    invert=False, deblend=False, exptime=None):
+    invert=False, deblend=False, exptime=None, n_jobs=1, chunk_size=1000, field_convolve=False, conv_method='auto', min_size=None,
+    noise=None, n_threads=1, counter=None, zernike_order=None):
     """
     Applies image segmentation on each object to calculate morphological 
     parameters calculated from the moment-based properties. These parameters 
@@ -354,10 +1070,50 @@ def morph_parameters(data, x, y, size=100, nsig=0.6, threshold=10, kernel_size=2
             map input. Defaults to None, in which case data is assumed to be background-subtracted.
         invert (bool): If True the x & y coordinates will be switched
             when cropping out the object, see Note below. Defaults to False.
-        deblend (bool, optional): If True, the objects are deblended during the segmentation
+        deblend (bool, str, dict, optional): If True, the objects are deblended during the segmentation
             procedure, thus deblending the objects before the morphological features
-            are computed. Defaults to False so as to keep blobs as one segmentation object.
-        exptime (float, optional):
+            are computed. As only the central object of each source is measured, deblend='central'
+            deblends only that segment, while deblend='selective' deblends only the segments that pass
+            area, peak, and flux ratio thresholds, see the deblend_segments function. Defaults to False
+            so as to keep blobs as one segmentation object.
+        exptime (float, optional): Exposure time, if input the cropped data is divided
+            by this value prior to the segmentation. Defaults to None.
+        n_jobs (int): The number of worker processes. If greater than 1 the positions are
+            split into chunks and only the cropped stamps of each chunk are sent to the workers, 
+            the outputs are returned in the input order. Defaults to 1.
+        chunk_size (int): The maximum number of sources cropped out and processed at once. 
+            Defaults to 1000.
+        field_convolve (bool): If True the entire data is convolved and its threshold map computed
+            only once, see the field_segm_maps function, and the segmentation of each source crops 
+            these out instead of convolving every overlapping stamp. Pixels farther than kernel_size/2 
+            from the stamp edge are convolved identically, but the noise is estimated in fixed 
+            (size x size) regions rather than in the stamp centered on the source, so the detection 
+            threshold typically differs by a few percent. Most features then differ by about as much, 
+            but segments near the threshold can merge with or split from their neighbours, in which case
+            their features (e.g. the area and the Fourier descriptors) can differ by far more. Defaults to False.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+        min_size (int, optional): If set the stamps are segmented adaptively, starting with a central crop of 
+            this size that is grown until the central segment is at least kernel_size/2 pixels away from the crop edges, 
+            up to the full size. The pixels of such a segment are convolved as in the full stamp and the noise is 
+            estimated from the full stamp, so the segment and its features are the same as with the full stamp 
+            (barring the rare case of a truncated neighbouring segment being selected as the central object), 
+            while most sources, which are only a few pixels across, are segmented on a fraction of the area. 
+            Not applicable if field_convolve=True. Defaults to None.
+        noise (str, float, ndarray, optional): The noise model of the field, from which the detection threshold
+            of every stamp is read instead of being estimated from the pixels of the stamp, so the thresholds
+            of neighbouring stamps are consistent. Either 'global' for the sigma-clipped standard deviation of
+            the whole data, 'mesh' for that of independent (size x size) regions, a single rms value, or a 2D rms
+            map of the same shape as the data (e.g. the rms error map), see the noise_map function. If field_convolve=True
+            the noise model replaces the mesh of the field_segm_maps function. Defaults to None, in which case the noise
+            is estimated in every stamp.
+        n_threads (int): The number of threads used to extract the contours of the segments, for the
+            Fourier descriptors, see the image_moments.batch_fourier_descriptors function. Defaults to 1.
+        counter (Counter, optional): A collections.Counter in which the objects without a contour ('no_contour') 
+            or with fewer than 3 contour points ('short_contour') are tallied, their missing Fourier descriptors 
+            are set to zero. Defaults to None.
+        zernike_order (int, optional): If set, the magnitudes of the Zernike moments of each segment up to this order 
+            are also computed, see the image_moments.batch_zernike_moments function, and are appended to the moments
+            tables. The make_table function must then be called with the same zernike_order. Defaults to None.
 
     Note:
         This function requires x & y positions as each source 
@@ -378,8 +1134,50 @@ def morph_parameters(data, x, y, size=100, nsig=0.6, threshold=10, kernel_size=2
     Return:
         A catalog of morphological parameters. If multiple positions are input, then the
         output will be a list containing multiple morphological catalogs, one for
-        each position.
+        each position. The third output is the segmentation map of the last stamp, None 
+        if no positions are input or if no object was segmented in that stamp.
+        
+    """
+
+    prop_list, moment_list, segm = [], [], None
+    for start, chunk_props, chunk_moments, segm in iter_morph_parameters(data, x, y, size=size, nsig=nsig, threshold=threshold, 
+        kernel_size=kernel_size, median_bkg=median_bkg, invert=invert, deblend=deblend, exptime=exptime, n_jobs=n_jobs, 
+        chunk_size=chunk_size, field_convolve=field_convolve, conv_method=conv_method, min_size=min_size, noise=noise, 
+        n_threads=n_threads, counter=counter, zernike_order=zernike_order):
+        prop_list.extend(chunk_props), moment_list.extend(chunk_moments)
+
+    #if -999 in prop_list:
+    #    print('NOTE: At least one object could not be detected in segmentation, perhaps the object is too faint. The morphological features have been set to -999.')
+    if len(prop_list) != len(moment_list):
+        raise ValueError('The properties list does not match the image moments list.')
         
+    return np.array(prop_list, dtype=object), moment_list, None if segm is None else segm.data
+
+def iter_morph_parameters(data, x, y, size=100, nsig=0.6, threshold=10, kernel_size=21, median_bkg=None, 
+    invert=False, deblend=False, exptime=None, n_jobs=1, chunk_size=1000, field_convolve=False, conv_method='auto',
+    min_size=None, bands=None, band_bkg=None, noise=None, n_threads=1, counter=None, zernike_order=None):
+    """
+    Generator version of morph_parameters, the arguments are the same. The sources are
+    processed in chunks and each chunk is yielded as soon as it is complete and all the 
+    preceding chunks have been yielded, so the outputs are always in the input order. 
+    This allows the catalog to be written to disk while it is being computed, see the 
+    CatalogWriter class.
+
+    Args:
+        bands (list, optional): 2D arrays of other bands on the same pixel grid as the data. The
+            segmentation is only performed on the data, and the central segment of each source is
+            then measured in every band, see the MultiBandCatalog class. Defaults to None.
+        band_bkg (list, optional): The median_bkg of each band, the entries can be None if the
+            band is background-subtracted. Defaults to None.
+        counter (Counter, optional): The counter of the objects without enough contour points, see
+            the morph_parameters function. If bands are input the objects of every band are tallied.
+            The counter is updated as the chunks are completed. Defaults to None.
+
+    Yields:
+        The index of the first source in the chunk, the properties list, the moments list, 
+        and the segmentation image of the last stamp in the chunk. If bands are input the
+        properties and moments are lists with one entry per band, the data first followed
+        by the bands in order.
     """
 
     if data.shape[0] < 100:
@@ -389,133 +1187,376 @@ def morph_parameters(data, x, y, size=100, nsig=0.6, threshold=10, kernel_size=2
     except:
         x, y = [x], [y]
 
+    if bands is not None and any(np.shape(band) != data.shape for band in bands):
+        raise ValueError("The bands must be the same shape as the data array.")
+
     size = size if data.shape[0] > size and data.shape[1] > size else min(data.shape[0],data.shape[1])
 
-    prop_list, moment_list = [], []
     progess_bar = bar.FillingSquaresBar('Applying image segmentation...', max=len(x))
 
-    for i in range(len(x)):
-        new_data = data_processing.crop_image(data, int(x[i]), int(y[i]), size, invert=invert)
+    threshold_field = None
+    if noise is not None: #The thresholds are read off the noise model
+        threshold_field = nsig * noise_map(data, noise=noise, length=size)
+    if field_convolve: #Convolve and threshold the whole frame only once
+        if threshold_field is None:
+            convolved_field, threshold_field = field_segm_maps(data, nsig=nsig, kernel_size=kernel_size, length=size, conv_method=conv_method)
+        else:
+            convolved_field = convolve_data(data, kernel_size=kernel_size, method=conv_method)
+
+    def crop_chunk(start):
+        #The stamps are cropped out in chunks to avoid copying the full frame
+        stamps = data_processing.extract_stamps(data, x[start:start+chunk_size], y[start:start+chunk_size], size, invert=invert)
+        bkg = None if median_bkg is None else median_bkg[start:start+chunk_size]
+        convolved_stamps = threshold_stamps = band_stamps = band_bkgs = None
+        if field_convolve:
+            convolved_stamps = data_processing.extract_stamps(convolved_field, x[start:start+chunk_size], y[start:start+chunk_size], size, invert=invert)
+        if threshold_field is not None:
+            if np.ndim(threshold_field) == 0: #A single threshold for all the stamps
+                threshold_stamps = [threshold_field] * len(stamps)
+            else:
+                threshold_stamps = data_processing.extract_stamps(threshold_field, x[start:start+chunk_size], y[start:start+chunk_size], size, invert=invert)
+        if bands is not None:
+            band_stamps = [data_processing.extract_stamps(band, x[start:start+chunk_size], y[start:start+chunk_size], size, invert=invert) for band in bands]
+            if band_bkg is not None:
+                band_bkgs = [None if values is None else values[start:start+chunk_size] for values in band_bkg]
+        return stamps, bkg, convolved_stamps, threshold_stamps, band_stamps, band_bkgs
+
+    kwargs = {'exptime':exptime, 'size':size, 'nsig':nsig, 'threshold':threshold, 'kernel_size':kernel_size, 'deblend':deblend, 'conv_method':conv_method,
+        'min_size':min_size, 'n_threads':n_threads, 'zernike_order':zernike_order}
+    
+    if n_jobs == 1:
+        for start in range(0, len(x), chunk_size):
+            stamps, bkg, convolved_stamps, threshold_stamps, band_stamps, band_bkgs = crop_chunk(start)
+            chunk_props, chunk_moments, segm, chunk_counter = _morph_chunk(stamps, median_bkg=bkg, convolved_stamps=convolved_stamps, 
+                threshold_stamps=threshold_stamps, progess_bar=progess_bar, band_stamps=band_stamps, band_bkg=band_bkgs, **kwargs)
+            if counter is not None:
+                counter.update(chunk_counter)
+            yield start, chunk_props, chunk_moments, segm
+    else:
+        #Keep at most two chunks per worker in flight so only their stamps are held in memory
+        chunk_size = max(1, min(chunk_size, int(np.ceil(len(x) / (4.*n_jobs)))))
+        starts = list(range(0, len(x), chunk_size))
+        results, next_index = {}, 0
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {}
+            for j, start in enumerate(starts):
+                stamps, bkg, convolved_stamps, threshold_stamps, band_stamps, band_bkgs = crop_chunk(start)
+                futures[executor.submit(_morph_chunk, stamps, median_bkg=bkg, convolved_stamps=convolved_stamps, 
+                    threshold_stamps=threshold_stamps, band_stamps=band_stamps, band_bkg=band_bkgs, **kwargs)] = j
+                while len(futures) >= 2*n_jobs or (j == len(starts)-1 and len(futures) > 0):
+                    done, __ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = futures.pop(future)
+                        results[index] = future.result()
+                        progess_bar.next(min(chunk_size, len(x)-starts[index]))
+                    while next_index in results: #Release the completed chunks in order
+                        chunk_props, chunk_moments, segm, chunk_counter = results.pop(next_index)
+                        if counter is not None: #The workers return their own counts
+                            counter.update(chunk_counter)
+                        yield starts[next_index], chunk_props, chunk_moments, segm
+                        next_index += 1
+    progess_bar.finish()
+
+def _morph_chunk(stamps, median_bkg=None, exptime=None, convolved_stamps=None, threshold_stamps=None, progess_bar=None, 
+    band_stamps=None, band_bkg=None, n_threads=1, zernike_order=None, **kwargs):
+    """
+    Applies the segmentation to a chunk of stamps that have already been cropped out 
+    of the data, this is the unit of work sent to each worker when n_jobs > 1.
+
+    The image moments of all the central objects in the chunk are computed 
+    at once, see the batch_moments function.
+
+    Returns:
+        The properties list, the moments list, the segmentation image of the last stamp, and
+        the Counter of the objects without enough contour points for the Fourier descriptors.
+        If band_stamps are input the first two outputs are lists with one entry per band,
+        the stamps first followed by the bands in order.
+    """
+
+    counter = Counter()
+    nbands = 1 if band_stamps is None else len(band_stamps)+1
+    prop_lists, cutout_lists = [[] for i in range(nbands)], [[] for i in range(nbands)]
+    for i in range(len(stamps)):
+        new_data = stamps[i]
+        convolved_data = None if convolved_stamps is None else convolved_stamps[i]
+        threshold_map = None if threshold_stamps is None else threshold_stamps[i]
         if median_bkg is not None:
             new_data -= median_bkg[i] 
+            if convolved_data is not None:
+                convolved_data -= median_bkg[i] #The kernel is normalized so the convolution of a constant is the constant
         if exptime is not None:
             new_data /= exptime
-       
-        segm, convolved_data = segm_find(new_data, nsig=nsig, kernel_size=kernel_size, deblend=deblend)
-        try:
-            props = segmentation.SourceCatalog(new_data, segm, convolved_data=convolved_data)
-        except:
-            prop_list.append(-999), moment_list.append(-999) #If there are no segmented objects in the image
+            if convolved_data is not None:
+                convolved_data /= exptime
+            if threshold_map is not None:
+                threshold_map = threshold_map / exptime
+
+        bands = None
+        if band_stamps is not None:
+            bands = [band_stamps[j][i] for j in range(len(band_stamps))]
+            for j in range(len(bands)):
+                if band_bkg is not None and band_bkg[j] is not None:
+                    bands[j] -= band_bkg[j][i]
+                if exptime is not None:
+                    bands[j] /= exptime
+
+        props, cutout, segm = _morph_stamp(new_data, convolved_data=convolved_data, threshold_map=threshold_map, bands=bands, **kwargs)
+        if bands is None:
+            props, cutout = [props], [cutout]
+        for j in range(nbands):
+            prop_lists[j].append(props[j]), cutout_lists[j].append(cutout[j])
+        if progess_bar is not None:
             progess_bar.next()
-            continue
 
-        # Mask a circular area at the center of the image, using radius=threshold
-        # Flag if there is no segmented object within the circular mask 
-        x_pos, y_pos = np.ogrid[:new_data.shape[0],:new_data.shape[1]]
-        cx = cy = int(size/2)
-        tmin, tmax = np.deg2rad((0,360))
-        r2 = (x_pos-cx)*(x_pos-cx) + (y_pos-cy)*(y_pos-cy)
-        theta = np.arctan2(x_pos-cx,y_pos-cy) - tmin
-        theta %= (2*np.pi)
-        circmask = r2 <= threshold*threshold
-        anglemask = theta <= (tmax-tmin)
-        mask = circmask*anglemask
-        if np.count_nonzero(segm.data[mask]) == 0: 
-            prop_list.append(-999), moment_list.append(-999)
-            progess_bar.next()
-            continue
+    ##### Image Moments #####
+    moment_lists = []
+    for cutouts in cutout_lists:
+        detected = [i for i in range(len(cutouts)) if not np.isscalar(cutouts[i])]
+        moment_list = [-999] * len(cutouts)
+        if len(detected) > 0:
+            moments = batch_moments([cutouts[i][0] for i in detected], origins=[cutouts[i][1] for i in detected], 
+                centers=[cutouts[i][2] for i in detected], zernike_order=zernike_order, n_threads=n_threads, counter=counter)
+            for j, i in enumerate(detected):
+                moment_list[i] = moments[j]
+        moment_lists.append(moment_list)
+
+    if band_stamps is None:
+        return prop_lists[0], moment_lists[0], segm, counter
+
+    return prop_lists, moment_lists, segm, counter
+
+def _morph_stamp(new_data, size=100, nsig=0.6, threshold=10, kernel_size=21, deblend=False, convolved_data=None, threshold_map=None, conv_method='auto', 
+    min_size=None, bands=None):
+    """
+    Segments a single background-subtracted stamp and computes the properties
+    and image moments of the segmentation object closest to the center.
 
-        sep_list=[]
-        for xx in range(len(props)): #This is to select the segmented object closest to the center, (x,y)=(size/2, size/2)
-            xcen = float(props[xx].centroid[0])
-            ycen = float(props[xx].centroid[1])
-            sep_list.append(np.sqrt((xcen-(size/2))**2 + (ycen-(size/2))**2))
+    The central object is selected straight from the segmentation map, the
+    properties are built for that label only, and the image moments are computed
+    on its bounding box, so the cost scales with the area of the segment.
 
-        inx = np.where(sep_list == np.min(sep_list))[0]
-        if len(inx) > 1: #In case objects can't be deblended
-            inx = inx[0] 
+    If the stamps of other bands are input, the same segment is measured in each of
+    them, so only the convolution is repeated per band, see the MultiBandCatalog class.
 
-        ##### Image Moments #####
-        new_data[segm.data != props[inx].label] = 0
-        moments_table = make_moments_table(new_data)
-        
-        prop_list.append(props[inx]), moment_list.append(moments_table)
-        progess_bar.next()
-    progess_bar.finish()
+    Returns:
+        The source properties and a tuple containing the cutout of the object, the (x, y)
+        position of its first pixel, and the center of the stamp, both set to -999 if 
+        the object is not detected, followed by the segmentation image. If bands are input
+        the first two outputs are lists, with the stamp first followed by the bands in order.
+    """
 
-    #if -999 in prop_list:
-    #    print('NOTE: At least one object could not be detected in segmentation, perhaps the object is too faint. The morphological features have been set to -999.')
-    if len(prop_list) != len(moment_list):
-        raise ValueError('The properties list does not match the image moments list.')
-        
-    return np.array(prop_list, dtype=object), moment_list, segm.data
+    def measure(image, convolved):
+        try:
+            props = segmentation.SourceCatalog(image, segm, convolved_data=convolved).get_labels([label])
+        except:
+            return -999, -999
+        cutout = np.where(segm.data[ymin:ymax, xmin:xmax] == label, image[ymin:ymax, xmin:xmax], 0)
+        return props, (cutout, (xmin, ymin), center)
+
+    nondetection = -999 if bands is None else [-999] * (len(bands)+1)
+
+    window = (slice(None), slice(None)) #The region of the stamp that was convolved
+    if min_size is not None and convolved_data is None:
+        segm, convolved_data, window = _adaptive_segm(new_data, size=size, min_size=min_size, nsig=nsig, threshold=threshold,
+            kernel_size=kernel_size, deblend=deblend, threshold_map=threshold_map, conv_method=conv_method)
+    else:
+        segm, convolved_data = segm_find(new_data, nsig=nsig, kernel_size=kernel_size, deblend=deblend, 
+            convolved_data=convolved_data, threshold_map=threshold_map, conv_method=conv_method, center=(size/2, size/2))
+    if segm is None:
+        return nondetection, nondetection, segm #If there are no segmented objects in the image
+
+    # Flag if there is no segmented object within the circular mask at the center
+    mask = _central_mask(new_data.shape, size, threshold)
+    if np.count_nonzero(segm.data[mask]) == 0: 
+        return nondetection, nondetection, segm
+
+    #This is to select the segmented object closest to the center, (x,y)=(size/2, size/2)
+    label = _central_label(segm, convolved_data, (size/2, size/2))
+
+    ##### Image Moments #####
+    #Bounding box of the segment padded by one pixel so that the contour is the same as in the full stamp,
+    #the moments are computed for the whole chunk in the _morph_chunk function
+    slices = segm.slices[segm.get_index(label)]
+    ymin, ymax = max(slices[0].start-1, 0), min(slices[0].stop+1, new_data.shape[0])
+    xmin, xmax = max(slices[1].start-1, 0), min(slices[1].stop+1, new_data.shape[1])
+    center = ((new_data.shape[1]-1)/2., (new_data.shape[0]-1)/2.)
+
+    props, cutout = measure(new_data, convolved_data)
+    if bands is None:
+        return props, cutout, segm
+
+    if np.isscalar(props): #Not measured in the other bands either
+        return nondetection, nondetection, segm
+
+    prop_list, cutout_list = [props], [cutout]
+    for band in bands:
+        convolved_band = np.zeros(band.shape)
+        convolved_band[window] = convolve_data(band[window], kernel_size=kernel_size, method=conv_method)
+        props, cutout = measure(band, convolved_band)
+        prop_list.append(props), cutout_list.append(cutout)
+
+    return prop_list, cutout_list, segm
+
+def _adaptive_segm(new_data, size=100, min_size=40, nsig=0.6, threshold=10, kernel_size=21, deblend=False, threshold_map=None, conv_method='auto'):
+    """
+    Segments a central crop of the stamp, which is grown until the central segment is at least
+    kernel_size/2 pixels away from its edges or covers the whole stamp. The detection threshold is
+    that of the whole stamp, see the segm_find function, or the threshold_map if input, so the central 
+    segment is the same as if the whole stamp was segmented. See the morph_parameters function.
 
-def make_table(props, moments):
+    Returns:
+        The segmentation image and the convolved data, zero-padded outside the crop to the size of
+        the stamp, and the slices of the crop within the stamp.
+    """
+
+    if threshold_map is None:
+        threshold_level = nsig * sigma_clipped_stats(new_data, sigma=3.0, maxiters=10)[2] #The noise of the whole stamp
+    else:
+        threshold_level = threshold_map
+    margin = kernel_size // 2 + 1 #Pixels closer to the edge are not convolved as in the whole stamp
+    center = int(size/2)
+    mask = _central_mask(new_data.shape, size, threshold)
+    crop = max(int(min_size), 2*(threshold+margin)+1) #The central mask is always within the crop
+
+    while crop < min(new_data.shape):
+        start = center - crop//2
+        window = (slice(start, start+crop), slice(start, start+crop))
+        crop_threshold = threshold_level if np.ndim(threshold_level) == 0 else threshold_level[window]
+        segm, convolved_data = segm_find(new_data[window], kernel_size=kernel_size, threshold_map=crop_threshold, conv_method=conv_method)
+        if segm is None or np.count_nonzero(segm.data[mask[window]]) == 0: #Not detected in the whole stamp either
+            break
+        slices = segm.slices[segm.get_index(_central_label(segm, convolved_data, (size/2-start, size/2-start)))]
+        if min(slices[0].start, slices[1].start) >= margin and max(slices[0].stop, slices[1].stop) <= crop - margin:
+            break
+        crop = int(1.5*crop) if 1.5*crop < 0.8*min(new_data.shape) else min(new_data.shape) #Nearly the whole stamp is segmented at once
+    else:
+        return segm_find(new_data, kernel_size=kernel_size, deblend=deblend, threshold_map=threshold_level, conv_method=conv_method, 
+            center=(size/2, size/2)) + ((slice(None), slice(None)),)
+
+    if segm is None:
+        return segm, convolved_data, window
+    if deblend is not False and deblend is not None: #The central segment is deblended as in the whole stamp
+        segm = deblend_segments(convolved_data, segm, crop_threshold, deblend=deblend, center=(size/2-start, size/2-start))
+
+    padded_segm, padded_convolved = np.zeros(new_data.shape, dtype=segm.data.dtype), np.zeros(new_data.shape)
+    padded_segm[window], padded_convolved[window] = segm.data, convolved_data
+
+    return segmentation.SegmentationImage(padded_segm), padded_convolved, window
+
+def make_table(props, moments, dtype=np.float64, return_mask=False, zernike_order=None):
     """
     Returns the morphological parameters calculated from the sementation image.
     A list of the parameters and their function is available in the Photutils
     Source Catalog documentation: https://photutils.readthedocs.io/en/stable/api/photutils.segmentation.SourceCatalog.html
-    
+
+    The table is filled column by column directly from the source properties,
+    the columns are in the order of the feature_names function. Objects that were
+    not detected during the segmentation have all their features set to NaN.
+
     Args:
         Props (source catalog): A source catalog containing the segmentation parameters.
-        
-    Returns:
-        Array containing the morphological features. 
+        moments (list): The image moments table of each object, as output by the morph_parameters function.
+        dtype (dtype): The data type of the output array, either np.float64 or np.float32. Defaults to np.float64.
+        return_mask (bool): If True a boolean mask flagging the non-detections will also be returned. Defaults to False.
+        zernike_order (int, optional): The order of the Zernike moments in the moments tables, which
+            are appended as the last columns. Defaults to None.
 
+    Returns:
+        Array containing the morphological features. If return_mask=True, the second output is the
+        1D boolean array that is True for the objects that were not detected.
     """
 
-    moment_list = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',             
+    moment_list = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',
         'mu10', 'mu01', 'mu20','mu11','mu02','mu30','mu21','mu12','mu03', 'hu1','hu2',
-        'hu3','hu4','hu5','hu6','hu7', 'fourier_1','fourier_2','fourier_3',             
+        'hu3','hu4','hu5','hu6','hu7', 'fourier_1','fourier_2','fourier_3',
         'legendre_1','legendre_2','legendre_3','legendre_4','legendre_5','legendre_6',
         'legendre_7','legendre_8','legendre_9','legendre_10'] #Removes mu00
 
-    prop_list = ['area', 'covar_sigx2', 'covar_sigy2', 'covar_sigxy', 'covariance_eigvals', 
-        'cxx', 'cxy', 'cyy', 'eccentricity', 'ellipticity', 'elongation', 'equivalent_radius', 
+    prop_list = ['area', 'covar_sigx2', 'covar_sigy2', 'covar_sigxy', 'covariance_eigvals',
+        'cxx', 'cxy', 'cyy', 'eccentricity', 'ellipticity', 'elongation', 'equivalent_radius',
         'fwhm', 'gini', 'orientation', 'perimeter', 'semimajor_sigma', 'semiminor_sigma', #\\
-        'isscalar', 'bbox_xmax', 'bbox_xmin', 'bbox_ymax', 'bbox_ymin', 'max_value', 'maxval_xindex', 
+        'isscalar', 'bbox_xmax', 'bbox_xmin', 'bbox_ymax', 'bbox_ymin', 'max_value', 'maxval_xindex',
         'maxval_yindex', 'min_value', 'minval_xindex', 'minval_yindex', 'moments', 'moments_central']
-    
-    table = []
-    print('Writing catalog...')
-    for i in range(len(props)):
 
-        morph_feats = []
+    table = np.full((len(props), len(feature_names(zernike_order))), np.nan, dtype=dtype)
+    mask = np.ones(len(props), dtype=bool)
 
+    sources = []
+    for i in range(len(props)):
         try:
-            props[i][0].area #To avoid when this is None
-            for moment in moment_list:
-                morph_feats.append(float(moments[i][moment]))
+            source = props[i]
+            if isinstance(source, np.ndarray) or not source.isscalar: #To avoid when this is -999
+                source = source[0] #The source catalog of length one
+            moments[i][moment_list[0]]
         except:
-            for j in range(len(prop_list+moment_list)+31): #+1 because covariance eigenvalue param is actually 2 params, and +30 for the 2 4x4 moment matrices 
-                morph_feats.append(-999)
-            table.append(morph_feats)
             continue
+        sources.append(source)
+        mask[i] = False
+
+    if len(sources) == 0:
+        return (table, mask) if return_mask else table
+
+    detected = [i for i in range(len(props)) if not mask[i]]
+
+    #The image moments (one-row tables) occupy the first columns
+    columns = [np.array([np.ravel(moments[i][moment])[0] for i in detected], dtype=float) for moment in moment_list]
+
+    for param in prop_list:
+        if param == 'moments' or param == 'moments_central': #To 3rd order photutils outputs a 4x4 matrix (obselete?)
+            matrix = np.array([np.ravel(getattr(source, param)) for source in sources], dtype=float)
+            columns.extend(matrix.T)
+        elif param == 'covariance_eigvals':
+            eigvals = np.array([np.ravel(getattr(source, param).value) for source in sources], dtype=float)
+            columns.append(eigvals[:,1]), columns.append(eigvals[:,0]) #The second eigval is stored first
+        elif param == 'isscalar': #Checks whether it's a single source, 1 for true, 0 for false
+            columns.append(np.array([source.isscalar for source in sources], dtype=float))
+        else:
+            values = [getattr(source, param) for source in sources]
+            columns.append(np.array([getattr(value, 'value', value) for value in values], dtype=float)) #Removes the units
 
-        QTable = props[i][0].to_table(columns=prop_list)
-        for param in prop_list:
-            if param == 'moments' or param == 'moments_central': #To 3rd order photutils outputs a 4x4 matrix (obselete?)
-                for moment in np.ravel(QTable[param]):
-                    morph_feats.append(moment)
-            elif param == 'covariance_eigvals': 
-                morph_feats.append(np.ravel(QTable[param])[1].value)
-                morph_feats.append(np.ravel(QTable[param])[0].value) #This is the second eigval
-            elif param == 'isscalar':
-                if QTable[param] == True: #Checks whether it's a single source, 1 for true, 0 for false
-                    morph_feats.append(1)
-                else:
-                    morph_feats.append(0)
-            elif param == 'bbox': #Calculate area of bounding box
-                morph_feats.append(props[i][0].bbox.shape[0] * props[i][0].bbox.shape[1])
-            else:
-                morph_feats.append(QTable[param].value[0])
+    if zernike_order is not None:
+        for moment in moment_names(zernike_order)[len(moment_names()):]:
+            columns.append(np.array([np.ravel(moments[i][moment])[0] for i in detected], dtype=float))
+
+    table[detected] = np.column_stack(columns)
+
+    return (table, mask) if return_mask else table
+
+def feature_names(zernike_order=None):
+    """
+    Returns the names of the morphological feature columns, in the order
+    of the columns of the table output by the make_table function.
+
+    Args:
+        zernike_order (int, optional): If set, the names of the Zernike moments up to this order 
+            are appended, as zernike_n_m, see the image_moments.moment_names function. Defaults to None.
+
+    Returns:
+        List of the column names.
+    """
+
+    prop_list = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',             
+        'mu10', 'mu01', 'mu20','mu11','mu02','mu30','mu21','mu12','mu03', 
+        'hu1','hu2', 'hu3','hu4','hu5','hu6','hu7', 'fourier_1','fourier_2','fourier_3',             
+        'legendre_1','legendre_2','legendre_3','legendre_4','legendre_5','legendre_6',
+        'legendre_7','legendre_8','legendre_9','legendre_10', 'area', 'covar_sigx2', 
+        'covar_sigy2', 'covar_sigxy', 'covariance_eigval1', 'covariance_eigval2', 
+        'cxx', 'cxy', 'cyy', 'eccentricity', 'ellipticity', 'elongation', 'equivalent_radius', 
+        'fwhm', 'gini', 'orientation', 'perimeter', 'semimajor_sigma', 'semiminor_sigma', #\\
+        'isscalar', 'bbox_xmax', 'bbox_xmin', 'bbox_ymax', 'bbox_ymin', 'max_value', 'maxval_xindex', 
+        'maxval_yindex', 'min_value', 'minval_xindex', 'minval_yindex']
 
-        table.append(morph_feats)
+    for i in range(16): #Photutils API returns 4x4 matrix
+        prop_list = prop_list + ['moments_'+str(i)]
+    for i in range(16):
+        prop_list = prop_list + ['moments_central_'+str(i)]
+    if zernike_order is not None:
+        prop_list = prop_list + moment_names(zernike_order)[len(moment_names()):]
 
-    return np.array(table, dtype=object)
+    return prop_list
 
 def make_dataframe(table=None, x=None, y=None, zp=None, flux=None, flux_err=None, median_bkg=None, 
-    obj_name=None, field_name=None, flag=None, save=True, path=None, filename=None):
+    obj_name=None, field_name=None, flag=None, save=True, path=None, filename=None, file_format='csv', mask=None, zernike_order=None):
     """
     This function takes as input the catalog of morphological features
     and other metrics and compiles the data as a Pandas dataframe. 
@@ -545,9 +1586,18 @@ def make_dataframe(table=None, x=None, y=None, zp=None, flux=None, flux_err=None
         path (str, optional): Absolute path where CSV file should be saved, if save=True. If 
             path is not set, the file will be saved to the local directory.
         filename(str, optional): Name of the output catalog. Default name is 'pyBIA_catalog'.
+        file_format (str): The format of the saved catalog, either 'csv', 'npy', 'parquet', 
+            or 'feather', see the CatalogWriter class. Defaults to 'csv'.
+        mask (ndarray, optional): 1D boolean array that is True for the objects that were not detected
+            during the segmentation, as output by the make_table function with return_mask=True. Defaults
+            to None, in which case the objects whose features are all NaN are the non-detections.
+        zernike_order (int, optional): The order of the Zernike moments in the table, see the 
+            make_table function. Defaults to None.
 
     Note:
-        These features can be used to create a machine learning model. 
+        These features can be used to create a machine learning model. If a table is input
+        the dataframe contains a boolean 'detected' column, as the features of the objects 
+        that were not detected during the segmentation are NaN.
 
     Example:
 
@@ -562,24 +1612,7 @@ def make_dataframe(table=None, x=None, y=None, zp=None, flux=None, flux_err=None
 
     """
 
-    if filename is None:
-        filename = 'pyBIA_catalog'
-
-    prop_list = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',             
-        'mu10', 'mu01', 'mu20','mu11','mu02','mu30','mu21','mu12','mu03', 
-        'hu1','hu2', 'hu3','hu4','hu5','hu6','hu7', 'fourier_1','fourier_2','fourier_3',             
-        'legendre_1','legendre_2','legendre_3','legendre_4','legendre_5','legendre_6',
-        'legendre_7','legendre_8','legendre_9','legendre_10', 'area', 'covar_sigx2', 
-        'covar_sigy2', 'covar_sigxy', 'covariance_eigval1', 'covariance_eigval2', 
-        'cxx', 'cxy', 'cyy', 'eccentricity', 'ellipticity', 'elongation', 'equivalent_radius', 
-        'fwhm', 'gini', 'orientation', 'perimeter', 'semimajor_sigma', 'semiminor_sigma', #\\
-        'isscalar', 'bbox_xmax', 'bbox_xmin', 'bbox_ymax', 'bbox_ymin', 'max_value', 'maxval_xindex', 
-        'maxval_yindex', 'min_value', 'minval_xindex', 'minval_yindex']
-
-    for i in range(16): #Photutils API returns 4x4 matrix
-        prop_list = prop_list + ['moments_'+str(i)]
-    for i in range(16):
-        prop_list = prop_list + ['moments_central_'+str(i)]
+    prop_list = feature_names(zernike_order)
 
     data_dict = {}
 
@@ -608,32 +1641,201 @@ def make_dataframe(table=None, x=None, y=None, zp=None, flux=None, flux_err=None
             data_dict['flux_err'] = flux_err
             data_dict['mag_err'] = (2.5/np.log(10))*(np.array(flux_err)/np.array(flux))
     
-    if table is None:
-        df = pd.DataFrame(data_dict)
-        if save == True:
-            if path is None:
-                print("No path specified, saving catalog to local home directory.")
-                path = str(Path.home())+'/'
-            df.to_csv(path+filename, index=False) 
-            return df
-        return df
-
-    try:
-        __ = len(table)
-    except: #TypeError
-        table = [table]
+    if table is not None:
+        try:
+            __ = len(table)
+        except: #TypeError
+            table = [table]
 
-    for i in range(len(prop_list)):
-        data_dict[prop_list[i]] = table[:,i]
+        table = np.asarray(table, dtype=float) #Typed columns instead of object arrays
+        data_dict['detected'] = ~np.asarray(mask, dtype=bool) if mask is not None else ~np.all(np.isnan(table), axis=1)
+        for i in range(len(prop_list)):
+            data_dict[prop_list[i]] = table[:,i]
 
     df = pd.DataFrame(data_dict)
     if save == True:
+        with CatalogWriter(path=path, filename=filename, file_format=file_format) as writer:
+            writer.write(df)
+    return df    
+
+def _check_file_format(file_format):
+    #Validates the output format, and that pyarrow is installed for Parquet and Feather, before a run starts
+    if file_format not in ('csv', 'npy', 'parquet', 'feather'):
+        raise ValueError("Invalid file_format, options are 'csv', 'npy', 'parquet', or 'feather'.")
+    if file_format in ('parquet', 'feather'):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The pyarrow package is required to write {} files, install with: pip install pyarrow".format(file_format))
+
+class CatalogWriter:
+    """
+    Writes a catalog to disk in chunks, so that the rows can be appended as they
+    are computed rather than holding the entire catalog in memory until the end.
+    Every chunk leaves the output readable, therefore the sources processed before 
+    a crash are not lost.
+
+    The columns are typed and fixed by the first chunk, the following chunks must contain 
+    the same columns. The supported formats are 'csv', 'npy' (NumPy structured array), 
+    'parquet', and 'feather'; the latter two require the pyarrow package. 
+
+    Note:
+        The rows of a CSV file are flushed after every chunk, and the header of a .npy
+        file is rewritten with the number of rows written so far. Parquet and Feather files
+        are only readable once their footer is written, so each chunk is written to its own
+        part file (part-00000.parquet, part-00001.parquet, ...) within a directory named after
+        the catalog, which can be read with the load_catalog function (or pandas' read_parquet 
+        for Parquet). String columns of .npy files are stored with a fixed length of at least 
+        64 characters, set by the longest entry in the first chunk.
+
+    Args:
+        path (str, optional): Absolute path of the directory where the catalog will be saved.
+            If None the catalog is saved to the local home directory.
+        filename (str, optional): Name of the output catalog. Default name is 'pyBIA_catalog'.
+            The format extension is appended if not included, except for CSV files.
+        file_format (str): The output format, either 'csv', 'npy', 'parquet', or 'feather'.
+            Defaults to 'csv'.
+
+    Example:
+        >>> with CatalogWriter(path='/Users/daniel/', file_format='parquet') as writer:
+        >>>     for dataframe in chunks:
+        >>>         writer.write(dataframe)
+    """
+
+    def __init__(self, path=None, filename=None, file_format='csv'):
+
+        _check_file_format(file_format)
         if path is None:
             print("No path specified, saving catalog to local home directory.")
             path = str(Path.home())+'/'
-        df.to_csv(path+filename, index=False) 
-        return df
-    return df    
+        if filename is None:
+            filename = 'pyBIA_catalog'
+        if file_format != 'csv' and not filename.endswith('.'+file_format):
+            filename += '.'+file_format
+
+        self.filename = str(path)+filename
+        self.file_format = file_format
+        self.nrows = 0
+        self.nparts = 0
+        self._file = None 
+
+    def write(self, df):
+        """
+        Appends the rows of the dataframe to the catalog file.
+
+        Args:
+            df (DataFrame): Pandas dataframe, such as the output of the make_dataframe function.
+        """
+
+        if self.file_format == 'csv':
+            if self._file is None:
+                self._file = open(self.filename, 'w', newline='')
+                df.to_csv(self._file, index=False)
+            else:
+                df.to_csv(self._file, index=False, header=False)
+            self._file.flush()
+
+        elif self.file_format == 'npy':
+            if self._file is None:
+                self._open_npy(df)
+            array = np.empty(len(df), dtype=self._dtype)
+            for name in self._dtype.names:
+                values = df[name].to_numpy()
+                if self._dtype[name].kind == 'U' and len(values) > 0 and max(len(str(value)) for value in values) > self._dtype[name].itemsize // 4:
+                    raise ValueError('The {} column has entries longer than the {} characters set by the first chunk.'.format(name, self._dtype[name].itemsize // 4))
+                array[name] = values
+            self._file.write(array.tobytes())
+            self._file.seek(0) #The header always holds the number of rows on disk
+            self._file.write(self._npy_header(self.nrows + len(df)))
+            self._file.seek(0, os.SEEK_END)
+            self._file.flush()
+
+        else:
+            import pyarrow as pa 
+            if self.nparts == 0:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self._schema = table.schema
+                os.makedirs(self.filename, exist_ok=True)
+                for name in os.listdir(self.filename): #The parts of a previous catalog with the same name
+                    if name.startswith('part-'):
+                        os.remove(os.path.join(self.filename, name))
+            else:
+                table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            part = os.path.join(self.filename, 'part-{:05d}.{}'.format(self.nparts, self.file_format))
+            if self.file_format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, part+'.tmp')
+            else:
+                import pyarrow.feather as feather
+                feather.write_feather(table, part+'.tmp')
+            os.replace(part+'.tmp', part) #Only complete parts are ever visible
+            self.nparts += 1
+
+        self.nrows += len(df)
+
+    def close(self):
+        """
+        Finalizes and closes the catalog file.
+        """
+
+        if self._file is not None:
+            self._file.close()
+        self._file = None 
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open_npy(self, df):
+        #The column types are fixed by the first chunk
+        dtype = []
+        for name in df.columns:
+            values = df[name].to_numpy()
+            if values.dtype.kind in 'biuf':
+                dtype.append((name, values.dtype))
+            else:
+                length = max([64] + [len(str(value)) for value in values])
+                dtype.append((name, 'U{}'.format(length)))
+        self._dtype = np.dtype(dtype)
+        self._descr = np.lib.format.dtype_to_descr(self._dtype)
+
+        #Reserve enough header space for any number of rows (version 2.0 format)
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (self._descr, 10**19)
+        self._header_len = len(header) + 1 + (-(len(header) + 1 + 12) % 64) #Data aligned to 64 bytes
+        self._file = open(self.filename, 'wb')
+        self._file.write(self._npy_header(0))
+
+    def _npy_header(self, nrows):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (self._descr, nrows)
+        header = header.ljust(self._header_len - 1) + '\n'
+        return b'\x93NUMPY\x02\x00' + np.uint32(self._header_len).astype('<u4').tobytes() + header.encode('latin1')
+
+def load_catalog(filename):
+    """
+    Loads a catalog saved with the CatalogWriter class (or make_dataframe function), 
+    the format is determined by the file extension. Parquet and Feather catalogs are
+    directories of part files, which are concatenated in order.
+
+    Args:
+        filename (str): Path to the catalog file.
+
+    Returns:
+        Pandas dataframe of the catalog.
+    """
+
+    filename = str(filename)
+    if filename.endswith('.npy'):
+        return pd.DataFrame(np.load(filename))
+    if filename.endswith(('.parquet', '.feather')):
+        reader = pd.read_parquet if filename.endswith('.parquet') else pd.read_feather
+        if not os.path.isdir(filename):
+            return reader(filename)
+        parts = sorted(name for name in os.listdir(filename) if name.startswith('part-') and not name.endswith('.tmp'))
+        return pd.concat([reader(os.path.join(filename, name)) for name in parts], ignore_index=True)
+
+    return pd.read_csv(filename)
 
 def DAO_find(data, fwhm):
     """
@@ -663,7 +1865,7 @@ def DAO_find(data, fwhm):
     
     return x, y
 
-def segm_find(data, nsig=0.6, kernel_size=21, deblend=False):
+def segm_find(data, nsig=0.6, kernel_size=21, deblend=False, convolved_data=None, threshold_map=None, conv_method='auto', center=None):
     """
     Finds objects using the segmentation detection threshold. 
     
@@ -676,9 +1878,19 @@ def segm_find(data, nsig=0.6, kernel_size=21, deblend=False):
             deviations from the background will be detected during segmentation. Defaults to 0.6.
         kernel_size (int): The size lenght of the square Gaussian filter kernel used to convolve 
             the data. This length must be odd. Defaults to 21.
-        deblend (bool, optional): If True, the objects are deblended during the segmentation
+        deblend (bool, str, dict, optional): If True, the objects are deblended during the segmentation
             procedure, thus deblending the objects before the morphological features
-            are computed. Defaults to False so as to keep blobs as one segmentation object.
+            are computed. Can also be 'central' or 'selective' (or a dictionary of thresholds)
+            to only deblend some of the segments, see the deblend_segments function. Defaults to False 
+            so as to keep blobs as one segmentation object.
+        convolved_data (ndarray, optional): The data already convolved with the Gaussian kernel, 
+            in which case the convolution is skipped. Defaults to None.
+        threshold_map (ndarray, optional): The detection threshold of each pixel, in which case
+            the threshold is not estimated from the data. Defaults to None.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+        center (tuple, optional): The (x, y) position of the object of interest, whose segment is 
+            the only one deblended if deblend='central'. Defaults to None, in which case 'central'
+            deblending (e.g. of a whole field) falls back to 'selective'.
 
     Returns:
         First output is the segmentation image object, the second output is the convolved data
@@ -686,63 +1898,681 @@ def segm_find(data, nsig=0.6, kernel_size=21, deblend=False):
 
     """
 
-    threshold = detect_threshold(data, nsigma=nsig, background=0.0)
-    sigma = 9.0 * gaussian_fwhm_to_sigma   # FWHM = 9. smooth the data with a 2D circular Gaussian kernel with a FWHM of 3 pixels to filter the image prior to thresholding:
-    kernel = Gaussian2DKernel(sigma, x_size=kernel_size, y_size=kernel_size, mode='center')
-    convolved_data = convolve(data, kernel, normalize_kernel=True, preserve_nan=True)
+    if threshold_map is None: #Same as photutils' detect_threshold with a zero background
+        threshold = nsig * sigma_clipped_stats(data, sigma=3.0, maxiters=10)[2]
+    else:
+        threshold = threshold_map
+    if convolved_data is None:
+        convolved_data = convolve_data(data, kernel_size=kernel_size, method=conv_method)
     segm = detect_sources(convolved_data, threshold, npixels=9, connectivity=8)
-    if deblend is True:
-        segm = deblend_sources(convolved_data, segm, npixels=5)
+    if deblend is not False and deblend is not None and segm is not None: #None if no sources were detected
+        segm = deblend_segments(convolved_data, segm, threshold, deblend=deblend, center=center)
     
     return segm, convolved_data 
 
-def subtract_background(data, length=150):
+def deblend_segments(convolved_data, segm, threshold, deblend=True, center=None):
+    """
+    Deblends the segmentation image, either every segment or only the segments selected by
+    the deblend argument, so that the cost of the multi-thresholding of photutils' deblend_sources
+    is only paid for the segments that are likely blended or that are used.
+
+    Args:
+        convolved_data (ndarray): The convolved data that was segmented.
+        segm (SegmentationImage): The segmentation image.
+        threshold (float, ndarray): The detection threshold, a single value or a 2D map.
+        deblend (bool, str, dict): If True every segment is deblended. If 'central' only the segment closest
+            to the center is deblended, which is the only segment measured by the morph_parameters function.
+            If 'selective' only the segments that can be blended objects are deblended, those with an area of 
+            at least 'area' pixels, a peak at least 'peak' times the detection threshold, and a secondary 
+            local maximum whose height above the threshold is at least 'ratio' times that of the highest maximum.
+            A dictionary with any of these three keys selects the segments with these thresholds instead of the
+            defaults of 'selective', which are area=10 (the smallest area that can be split into two objects of 5 
+            pixels), peak=2, and ratio=0.05. Defaults to True.
+        center (tuple, optional): The (x, y) position of the object of interest, if deblend='central'.
+            Defaults to None, in which case 'central' falls back to 'selective'.
+
+    Returns:
+        The deblended segmentation image.
+    """
+
+    if deblend is True:
+        return deblend_sources(convolved_data, segm, npixels=5)
+
+    if isinstance(deblend, dict):
+        invalid = set(deblend) - {'area', 'peak', 'ratio'}
+        if invalid:
+            raise ValueError("Invalid deblend thresholds {}, the options are 'area', 'peak', and 'ratio'.".format(sorted(invalid)))
+        labels = _blended_labels(convolved_data, segm, threshold, **deblend)
+    elif deblend == 'central' and center is not None:
+        labels = [_central_label(segm, convolved_data, center)]
+    elif deblend == 'central' or deblend == 'selective':
+        labels = _blended_labels(convolved_data, segm, threshold)
+    else:
+        raise ValueError("Invalid deblend option, options are True, False, 'central', 'selective', or a dictionary of thresholds.")
+
+    if len(labels) == 0:
+        return segm
+
+    return deblend_sources(convolved_data, segm, npixels=5, labels=labels)
+
+def _blended_labels(convolved_data, segm, threshold, area=10, peak=2., ratio=0.05):
+    #The labels of the segments that pass the area, peak, and secondary peak ratio thresholds
+    labels = segm.labels
+    height = convolved_data - threshold #The height above the detection threshold
+    peaks = np.atleast_1d(ndimage.maximum(convolved_data / threshold, segm.data, labels))
+    candidates = labels[(segm.areas >= area) & (peaks >= peak)]
+    if len(candidates) == 0:
+        return candidates
+
+    #The local maxima of each candidate, the highest two are compared
+    local = (convolved_data == ndimage.maximum_filter(convolved_data, size=3)) & np.isin(segm.data, candidates)
+    local_labels, local_heights = segm.data[local], height[local]
+    order = np.lexsort((-local_heights, local_labels))
+    local_labels, local_heights = local_labels[order], local_heights[order]
+    first = np.flatnonzero(np.r_[True, local_labels[1:] != local_labels[:-1]]) #The highest maximum of each label
+    has_second = (first + 1 < len(local_labels)) & (local_labels[np.minimum(first+1, len(local_labels)-1)] == local_labels[first])
+    second = np.where(has_second, local_heights[np.minimum(first+1, len(local_labels)-1)], 0)
+
+    return local_labels[first][has_second & (second >= ratio * local_heights[first])]
+
+def _central_label(segm, convolved_data, center):
+    #The label of the segment whose centroid is closest to the (x, y) center. The centroids of all segments
+    #are computed at once, weighted by the convolved data as done in the SourceCatalog
+    weights = np.where(np.isfinite(convolved_data) & (convolved_data > 0), convolved_data, 0)
+    centroids = np.array(center_of_mass(weights, segm.data, segm.labels)).reshape(-1, 2) #(y, x)
+    sep_list = np.sqrt((centroids[:,1]-center[0])**2 + (centroids[:,0]-center[1])**2)
+
+    return segm.labels[np.nanargmin(sep_list)] #The first in case objects can't be deblended
+
+def segm_sweep(data, nsig, kernel_size=21, threshold=10, deblend=False, convolved_data=None, conv_method='auto', return_segm=True):
+    """
+    Segments a single stamp at several nsig levels from one convolution, and flags
+    at which levels the central object is detected, as done by the morph_parameters
+    function (a segment within the circular mask of radius threshold at the center).
+
+    The pixels above a threshold are a subset of the pixels above any lower threshold, 
+    so a segment at a given level is contained within a segment at every lower level, 
+    and if the central object is detected at a level it is also detected at all the lower 
+    levels. The highest detected level is therefore found by a binary search, labeling 
+    the thresholded image only log2(len(nsig)) times.
+
+    Note:
+        Data must be background subtracted. The detection flags do not depend on
+        the deblending, as the deblended segments cover the same pixels.
+
+    Args:
+        data (ndarray): 2D array of a single stamp.
+        nsig (ndarray): 1D array of the sigma detection limits, see the segm_find function.
+        kernel_size (int): The size length of the square Gaussian filter kernel used to convolve 
+            the data. This length must be odd. Defaults to 21.
+        threshold (int): The radius of the circular mask at the center of the stamp within 
+            which the object must be segmented to be detected. Defaults to 10 pixels.
+        deblend (bool, str, dict, optional): If set, the returned segmentation images are deblended, 
+            see the deblend_segments function. Defaults to False.
+        convolved_data (ndarray, optional): The data already convolved with the Gaussian kernel, 
+            in which case the convolution is skipped. Defaults to None.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+        return_segm (bool): If False only the detection flags are computed. Defaults to True.
+
+    Returns:
+        1D boolean array flagging the nsig levels at which the central object is detected, in the input
+        order. If return_segm=True the second output is the list of the segmentation images at each level,
+        which are None where no objects were segmented.
+    """
+
+    nsig = np.atleast_1d(np.asarray(nsig, dtype=float))
+    std = sigma_clipped_stats(data, sigma=3.0, maxiters=10)[2] #Same noise as in the segm_find function
+    if convolved_data is None:
+        convolved_data = convolve_data(data, kernel_size=kernel_size, method=conv_method)
+    mask = _central_mask(data.shape, data.shape[0], threshold)
+    structure = np.ones((3,3), dtype=bool) #8-connectivity
+
+    def detected(level):
+        #Whether a segment of at least 9 pixels (the npixels of segm_find) is within the central mask
+        labels = ndimage.label(convolved_data > level*std, structure=structure)[0]
+        central = np.unique(labels[mask])
+        central = central[central > 0]
+        if len(central) == 0:
+            return False
+        return np.any(np.bincount(labels.ravel())[central] >= 9)
+
+    order = np.argsort(nsig)
+    low, high = 0, len(nsig) #The number of detected levels, in increasing order
+    while low < high:
+        middle = (low + high) // 2
+        if detected(nsig[order[middle]]):
+            low = middle + 1
+        else:
+            high = middle
+    flags = np.zeros(len(nsig), dtype=bool)
+    flags[order[:low]] = True
+
+    if not return_segm:
+        return flags
+
+    segms = []
+    for level in nsig:
+        segm = detect_sources(convolved_data, level*std, npixels=9, connectivity=8)
+        if deblend is not False and deblend is not None and segm is not None:
+            segm = deblend_segments(convolved_data, segm, level*std, deblend=deblend, center=(data.shape[1]/2, data.shape[0]/2))
+        segms.append(segm)
+
+    return flags, segms
+
+def nsig_sweep(data, x, y, nsig, size=100, kernel_size=21, threshold=10, median_bkg=None, invert=False, chunk_size=1000, conv_method='auto'):
+    """
+    Finds the nsig levels at which each source is detected, with a single convolution
+    per source, see the segm_sweep function. This replaces running the segmentation 
+    of every source once per nsig level, e.g. to find the fraction of non-detections
+    as a function of nsig.
+
+    Args:
+        data (ndarray): 2D array.
+        x (ndarray): 1D array or list containing the x-pixel position.
+        y (ndarray): 1D array or list containing the y-pixel position.
+        nsig (ndarray): 1D array of the sigma detection limits.
+        size (int, optional): The size of the stamp cropped out around each source. Defaults to 100.
+        kernel_size (int): The size length of the square Gaussian filter kernel. Defaults to 21.
+        threshold (int): The radius of the central mask within which the object must be segmented
+            to be detected, see the morph_parameters function. Defaults to 10 pixels.
+        median_bkg (ndarray, optional): 1D array containing the median background around each source,
+            see the morph_parameters function. Defaults to None, in which case data is assumed to be
+            background-subtracted.
+        invert (bool): If True the x & y coordinates will be switched when cropping out the object,
+            see the morph_parameters function. Defaults to False.
+        chunk_size (int): The maximum number of stamps cropped out at once. Defaults to 1000.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+
+    Returns:
+        2D boolean array of shape (number of sources, number of nsig levels) flagging the levels at which each
+        source is detected, and 1D array of the highest nsig at which each source is detected (NaN if it is not
+        detected at any level).
+    """
+
+    x, y, nsig = np.atleast_1d(x), np.atleast_1d(y), np.atleast_1d(np.asarray(nsig, dtype=float))
+    if len(x) != len(y):
+        raise ValueError("The two position arrays (x & y) must be the same size.")
+    size = size if data.shape[0] > size and data.shape[1] > size else min(data.shape[0],data.shape[1])
+
+    progess_bar = bar.FillingSquaresBar('Sweeping the detection thresholds...', max=len(x))
+    flags = np.zeros((len(x), len(nsig)), dtype=bool)
+    for start in range(0, len(x), chunk_size):
+        stamps = data_processing.extract_stamps(data, x[start:start+chunk_size], y[start:start+chunk_size], size, invert=invert)
+        for i in range(len(stamps)):
+            if median_bkg is not None:
+                stamps[i] -= median_bkg[start+i]
+            flags[start+i] = segm_sweep(stamps[i], nsig, kernel_size=kernel_size, threshold=threshold, conv_method=conv_method, return_segm=False)
+            progess_bar.next()
+    progess_bar.finish()
+
+    levels = np.where(flags, nsig, -np.inf).max(axis=1)
+
+    return flags, np.where(np.isfinite(levels), levels, np.nan)
+
+def _central_mask(shape, size, threshold):
+    #Circular mask of radius threshold centered on the (size/2, size/2) pixel
+    x_pos, y_pos = np.ogrid[:shape[0],:shape[1]]
+    cx = cy = int(size/2)
+    r2 = (x_pos-cx)*(x_pos-cx) + (y_pos-cy)*(y_pos-cy)
+
+    return r2 <= threshold*threshold
+
+def convolve_data(data, kernel_size=21, fwhm=9.0, method='auto'):
+    """
+    Convolves the data with the normalized 2D circular Gaussian kernel used 
+    to smooth the data prior to thresholding. NaN pixels are interpolated over 
+    during the convolution and preserved in the output, and zeros are assumed 
+    beyond the image boundary, as with astropy's convolve.
+
+    Three equivalent backends are available (they agree to machine precision):
+
+    - 'separable': Two 1D Gaussian passes, one along each axis. 
+    - 'fft': FFT convolution with NaN interpolation, whose cost is independent of the kernel size.
+    - 'direct': The direct 2D convolution of astropy.
+
+    Args:
+        data (ndarray): 2D array of a single image.
+        kernel_size (int): The size length of the square Gaussian filter kernel.
+            This length must be odd. Defaults to 21.
+        fwhm (float): The full width at half maximum of the Gaussian kernel, in pixels.
+            Defaults to 9.
+        method (str): The convolution backend, either 'separable', 'fft', 'direct', or 'auto', 
+            in which case 'direct' is used if the image is smaller than the kernel, 'fft' 
+            if both the image and the kernel are large (kernel_size > 63 and more than 512x512 pixels), 
+            otherwise 'separable'. Defaults to 'auto'.
+
+    Returns:
+        The convolved data, float32 input is returned as float32.
+    """
+
+    if method == 'auto':
+        if min(data.shape) < kernel_size:
+            method = 'direct'
+        elif kernel_size > 63 and data.size > 512**2:
+            method = 'fft'
+        else:
+            method = 'separable'
+
+    dtype = data.dtype if data.dtype == np.float32 else np.float64
+
+    if method == 'separable':
+        kernel = _gaussian_kernel_1d(kernel_size, fwhm).astype(dtype)
+        data = np.asarray(data, dtype=dtype)
+        mask = np.isfinite(data)
+        convolved_data = convolve1d(convolve1d(np.where(mask, data, 0), kernel, axis=0, mode='constant', cval=0.), kernel, axis=1, mode='constant', cval=0.)
+        if not mask.all(): #Renormalize by the kernel weight of the finite pixels, the region beyond the boundary counts as zeros
+            weights = convolve1d(convolve1d(mask.astype(dtype), kernel, axis=0, mode='constant', cval=1.), kernel, axis=1, mode='constant', cval=1.)
+            convolved_data /= weights
+            convolved_data[~mask] = np.nan
+        return convolved_data
+    elif method == 'fft':
+        convolved_data = convolve_fft(data, _gaussian_kernel(kernel_size, fwhm), normalize_kernel=True, nan_treatment='interpolate', preserve_nan=True)
+    elif method == 'direct':
+        convolved_data = convolve(data, _gaussian_kernel(kernel_size, fwhm), normalize_kernel=True, preserve_nan=True)
+    else:
+        raise ValueError("Invalid method input, options are 'auto', 'separable', 'fft', or 'direct'.")
+
+    return convolved_data.astype(dtype, copy=False)
+
+@lru_cache(maxsize=16)
+def _gaussian_kernel(kernel_size=21, fwhm=9.0):
+    """
+    Returns the 2D circular Gaussian kernel used to smooth the data prior to thresholding,
+    cached by (kernel_size, fwhm).
+    """
+
+    sigma = fwhm * gaussian_fwhm_to_sigma   # FWHM = 9. smooth the data with a 2D circular Gaussian kernel with a FWHM of 3 pixels to filter the image prior to thresholding:
+    
+    return Gaussian2DKernel(sigma, x_size=kernel_size, y_size=kernel_size, mode='center')
+
+@lru_cache(maxsize=16)
+def _gaussian_kernel_1d(kernel_size=21, fwhm=9.0):
+    """
+    Returns the normalized 1D Gaussian whose outer product is the 2D
+    kernel of _gaussian_kernel, cached by (kernel_size, fwhm).
+    """
+
+    kernel = Gaussian1DKernel(fwhm * gaussian_fwhm_to_sigma, x_size=kernel_size, mode='center').array
+    kernel = kernel / np.sum(kernel)
+    kernel.setflags(write=False)
+
+    return kernel
+
+def field_segm_maps(data, nsig=0.6, kernel_size=21, length=100, conv_method='auto'):
+    """
+    Convolves the entire frame and computes the corresponding map of detection 
+    thresholds, so that the segmentation of each individual source can crop these
+    out instead of convolving and thresholding every stamp, see morph_parameters.
+
+    The threshold is nsig times the sigma-clipped standard deviation of the
+    data, estimated in independent (length x length) regions, which by default
+    matches the area that is used for the noise estimate of a 100x100 stamp.
+
+    Args:
+        data (ndarray): 2D array of a single image, must be background subtracted.
+        nsig (float): The sigma detection limit. Defaults to 0.6.
+        kernel_size (int): The size length of the square Gaussian filter kernel used to convolve 
+            the data. This length must be odd. Defaults to 21.
+        length (int): The length of the local regions in which the noise is estimated. 
+            Defaults to 100.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+
+    Returns:
+        First output is the convolved data, the second output is the threshold map.
+    """
+
+    convolved_data = convolve_data(data, kernel_size=kernel_size, method=conv_method)
+    
+    return convolved_data, nsig * background_rms(data, length=length)
+
+def background_rms(data, length=100):
+    """
+    Estimates the noise as the sigma-clipped standard deviation of the pixels 
+    in independent (length x length) regions of the data. 
+
+    Args:
+        data (ndarray): 2D array of a single image.
+        length (int): The length of the local regions. Defaults to 100.
+
+    Returns:
+        2D array of the same shape as the data containing the local rms.
+    """
+
+    length = int(length)
+    Ny, Nx = data.shape
+    pad_y, pad_x = -Ny % length, -Nx % length
+    if pad_y or pad_x: #The incomplete regions at the edges are padded with NaN, which are ignored
+        data = np.pad(data.astype(np.float64), [(0, pad_y), (0, pad_x)], mode='constant', constant_values=np.nan)
+
+    stds = block_background(data, length=length, sigma=3.0, maxiters=10)[1]
+
+    return np.repeat(np.repeat(stds, length, axis=0)[:Ny], length, axis=1)[:, :Nx]
+
+def noise_map(data, noise='global', length=100):
+    """
+    Computes the noise model of a field, from which the segmentation thresholds of
+    the stamps are read so that the noise is not re-estimated in every stamp,
+    see the morph_parameters function.
+
+    Args:
+        data (ndarray): 2D array of a single image.
+        noise (str, float, ndarray): Either 'global', in which case the noise is the sigma-clipped 
+            standard deviation of the whole data, 'mesh', in which case it is estimated in independent 
+            (length x length) regions, see the background_rms function, a single rms value, or a 2D rms
+            map of the same shape as the data, e.g. the rms error map. Defaults to 'global'.
+        length (int): The length of the regions if noise='mesh'. Defaults to 100.
+
+    Returns:
+        The rms, a float if the noise is the same for the whole data, otherwise a 2D array of the
+        same shape as the data.
+    """
+
+    if isinstance(noise, str):
+        if noise == 'global': #Same clipping as in the segm_find function
+            return sigma_clipped_stats(data, sigma=3.0, maxiters=10)[2]
+        if noise == 'mesh':
+            return background_rms(data, length=length)
+        raise ValueError("Invalid noise, options are 'global', 'mesh', a single rms value, or a 2D rms map.")
+
+    if np.ndim(noise) == 0:
+        return float(noise)
+    if np.shape(noise) != np.shape(data):
+        raise ValueError("The rms noise map must be the same shape as the data array.")
+
+    return noise
+
+def tiled_source_detection(data, tile_size=2048, overlap=100, nsig=0.6, kernel_size=21, deblend=False, 
+    bkg=None, length=150, n_jobs=1, conv_method='auto', binning=None):
+    """
+    Runs the background subtraction and the image segmentation on overlapping
+    square tiles instead of on the entire frame, so that large survey fields can 
+    be processed in parallel without holding the whole convolved copy in memory.
+
+    The frame is partitioned into non-overlapping cores of size (tile_size x tile_size),
+    each of which is expanded by the overlap on every side to form the tile that is
+    actually segmented. A source is kept only by the tile whose core contains its centroid,
+    which is the deterministic rule used to remove the duplicates detected at the seams.
+
+    Note:
+        The overlap should be larger than both the kernel_size and the extent of the 
+        largest expected object, otherwise sources crossing the tile edges will 
+        be split into separate segmentation patches.
+
+    Args:
+        data (ndarray): 2D array of a single image.
+        tile_size (int): The length of the square tile cores. Defaults to 2048.
+        overlap (int): The number of pixels by which the tiles overlap. Defaults to 100.
+        nsig (float): The sigma detection limit. Objects brighter than nsig standard 
+            deviations from the background will be detected during segmentation. Defaults to 0.6.
+        kernel_size (int): The size length of the square Gaussian filter kernel used to convolve 
+            the data. This length must be odd. Defaults to 21.
+        deblend (bool, optional): If True, the objects are deblended during the segmentation
+            procedure. Defaults to False so as to keep blobs as one segmentation object.
+        bkg (None, optional): If bkg=0 the data is assumed to be background-subtracted, 
+            otherwise if None the background of each tile is subtracted using the 
+            subtract_background function. Defaults to None.
+        length (int): The length of the local background regions, only applicable
+            if bkg=None. Defaults to 150.
+        n_jobs (int): The number of worker processes. Defaults to 1, in which case the
+            tiles are processed serially.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+        binning (int, optional): If set each tile is segmented in a frame block-binned by this factor, 
+            see the coarse_source_detection function. Defaults to None.
+
+    Returns:
+        First output is the x-pixel array, second output is the y-pixel array, and the third output
+        is the background-subtracted data array stitched together from the tile cores.
+    """
+
+    Ny, Nx = data.shape
+    tiles = []
+    for row0 in range(0, Ny, tile_size):
+        for col0 in range(0, Nx, tile_size):
+            row1, col1 = min(row0+tile_size, Ny), min(col0+tile_size, Nx)
+            tiles.append(((row0, row1, col0, col1), (max(row0-overlap, 0), min(row1+overlap, Ny), max(col0-overlap, 0), min(col1+overlap, Nx))))
+
+    subtracted = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float32))
+    x, y = [None]*len(tiles), [None]*len(tiles)
+    progess_bar = bar.FillingSquaresBar('Running tiled source detection...', max=len(tiles))
+
+    def store(i, result):
+        #The core of each tile is stitched as soon as it is done so that only the positions are kept
+        core = tiles[i][0]
+        x[i], y[i], subtracted[core[0]:core[1], core[2]:core[3]] = result
+        progess_bar.next()
+
+    if n_jobs == 1:
+        for i, (core, bounds) in enumerate(tiles):
+            store(i, _detect_tile(np.array(data[bounds[0]:bounds[1], bounds[2]:bounds[3]]), core, bounds, nsig, kernel_size, deblend, bkg, length, 
+                conv_method, binning))
+    else:
+        #Keep at most two tiles per worker in flight so only their copies are held in memory
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {}
+            for i, (core, bounds) in enumerate(tiles):
+                futures[executor.submit(_detect_tile, np.array(data[bounds[0]:bounds[1], bounds[2]:bounds[3]]), core, bounds, nsig, 
+                    kernel_size, deblend, bkg, length, conv_method, binning)] = i
+                while len(futures) >= 2*n_jobs or (i == len(tiles)-1 and len(futures) > 0):
+                    done, __ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(futures.pop(future), future.result())
+    progess_bar.finish()
+
+    return np.concatenate(x), np.concatenate(y), subtracted
+
+def coarse_source_detection(data, binning=2, nsig=0.6, kernel_size=21, deblend=False, conv_method='auto'):
+    """
+    Coarse-to-fine source detection for extended, low surface brightness objects such
+    as Lyman-alpha nebulae. The background-subtracted frame is block-binned by the binning
+    factor and segmented with a kernel of the same physical width, which is binning^2 times
+    cheaper and less noisy for extended emission. Each segment of the binned frame is then 
+    refined by segmenting only the region around it at full resolution, with the detection 
+    threshold of the whole frame, to measure the centroids of the objects it contains.
+
+    A full-resolution object is assigned to the binned segment in which its centroid falls, 
+    so the objects in overlapping regions are only kept once. If none of the full-resolution 
+    objects falls within a binned segment, as is the case for the faint extended emission that 
+    is only detected after binning, the centroid of the binned segment is returned instead.
+
+    Note:
+        The binned segments must contain at least 9 binned pixels, so compact objects 
+        that are only detected at full resolution are not returned. The centroids of the 
+        objects only detected in the binned frame are less precise, by up to binning/2 pixels. The noise is estimated
+        from every binning-th pixel of the frame, which for uncorrelated noise has the 
+        same standard deviation as the whole frame.
+
+    Args:
+        data (ndarray): 2D array of a single background-subtracted image.
+        binning (int): The block size of the binning, e.g. 2 or 4. Defaults to 2.
+        nsig (float): The sigma detection limit, applied to both the binned and the full 
+            resolution segmentation. Defaults to 0.6.
+        kernel_size (int): The size length of the square Gaussian filter kernel used to convolve 
+            the full-resolution data, the binned data is convolved with a kernel binning 
+            times smaller. Defaults to 21.
+        deblend (bool, str, dict, optional): The deblending of the full-resolution segments, 
+            see the segm_find function. Defaults to False.
+        conv_method (str): The convolution backend, see the convolve_data function. Defaults to 'auto'.
+
+    Returns:
+        First output is the x-pixel array and the second output is the y-pixel array
+        of the detected objects.
+    """
+
+    binning = int(binning)
+    if binning < 1:
+        raise ValueError('The binning factor must be a positive integer.')
+
+    Ny, Nx = data.shape
+    ny, nx = Ny // binning, Nx // binning
+    binned = np.nanmean(np.asarray(data[:ny*binning, :nx*binning], dtype=float).reshape(ny, binning, nx, binning), axis=(1,3))
+    coarse_kernel = max(3, (kernel_size // binning) | 1) #Odd length
+    convolved_binned = convolve_data(binned, kernel_size=coarse_kernel, fwhm=9.0*coarse_kernel/kernel_size, method=conv_method)
+    segm = segm_find(binned, nsig=nsig, kernel_size=coarse_kernel, convolved_data=convolved_binned)[0]
+    if segm is None:
+        return np.array([]), np.array([])
+    #The centroids of the binned segments, in full-resolution pixels, used if the refinement finds nothing
+    coarse_centroid = np.atleast_2d(segmentation.SourceCatalog(binned, segm, convolved_data=convolved_binned).centroid) * binning + (binning - 1) / 2.
+
+    threshold = nsig * sigma_clipped_stats(data[::binning, ::binning], sigma=3.0, maxiters=10)[2] #Same as in segm_find
+    margin = kernel_size #The objects within the regions are convolved as in the whole frame
+
+    x, y = [], []
+    progess_bar = bar.FillingSquaresBar('Refining the candidates...', max=segm.nlabels)
+    for index, (label, slices) in enumerate(zip(segm.labels, segm.slices)):
+        row0, row1 = max(slices[0].start*binning - margin, 0), min(slices[0].stop*binning + margin, Ny)
+        col0, col1 = max(slices[1].start*binning - margin, 0), min(slices[1].stop*binning + margin, Nx)
+        region = np.asarray(data[row0:row1, col0:col1], dtype=float)
+        region_segm, convolved_data = segm_find(region, kernel_size=kernel_size, deblend=deblend, threshold_map=threshold, conv_method=conv_method)
+        progess_bar.next()
+        keep = []
+        if region_segm is not None:
+            centroid = np.atleast_2d(segmentation.SourceCatalog(region, region_segm, convolved_data=convolved_data).centroid)
+            region_x, region_y = centroid[:,0] + col0, centroid[:,1] + row0
+            finite = np.isfinite(region_x) & np.isfinite(region_y)
+            rows = np.clip(np.floor(np.where(finite, region_y, 0) / binning).astype(int), 0, ny-1)
+            cols = np.clip(np.floor(np.where(finite, region_x, 0) / binning).astype(int), 0, nx-1)
+            keep = finite & (segm.data[rows, cols] == label)
+        if np.any(keep):
+            x.append(region_x[keep]), y.append(region_y[keep])
+        else: #Only detected in the binned frame
+            x.append(coarse_centroid[index, :1]), y.append(coarse_centroid[index, 1:])
+    progess_bar.finish()
+
+    return np.concatenate(x), np.concatenate(y)
+
+def _detect_tile(tile, core, bounds, nsig, kernel_size, deblend, bkg, length, conv_method, binning=None):
+    """
+    Worker used by tiled_source_detection, segments one tile and keeps only the 
+    sources whose centroid falls within the tile core.
+
+    Returns:
+        The x and y positions of the kept sources relative to the entire frame,
+        and the background-subtracted core of the tile.
+    """
+
+    if bkg is None:
+        if tile.shape[0] < length or tile.shape[1] < length:
+            tile = tile - sigma_clipped_stats(tile)[1] 
+        else:
+            tile = subtract_background(tile, length=length)
+
+    row_offset, col_offset = bounds[0], bounds[2]
+    tile_core = tile[core[0]-row_offset:core[1]-row_offset, core[2]-col_offset:core[3]-col_offset]
+
+    if binning is not None:
+        x, y = coarse_source_detection(tile, binning=binning, nsig=nsig, kernel_size=kernel_size, deblend=deblend, conv_method=conv_method)
+    else:
+        segm, convolved_data = segm_find(tile, nsig=nsig, kernel_size=kernel_size, deblend=deblend, conv_method=conv_method)
+        if segm is None: #No sources detected in this tile
+            return np.array([]), np.array([]), tile_core
+        centroid = np.atleast_2d(segmentation.SourceCatalog(tile, segm, convolved_data=convolved_data).centroid)
+        x, y = centroid[:,0], centroid[:,1]
+    x, y = x + col_offset, y + row_offset
+    index = np.where((x >= core[2]) & (x < core[3]) & (y >= core[0]) & (y < core[1]))[0]
+
+    return x[index], y[index], tile_core
+
+def subtract_background(data, length=150, interpolate=False, return_background=False):
     """
     Removes the background by subtracting the local median pixel value 
     in sub-regions of size (length x length). The data matrix will be 
     padded accordingly usying symmetrical boundary conditions to ensure
     the local regions can expand evenly.
 
+    The sigma-clipped medians of all the regions are computed at once by 
+    viewing the padded data as a stack of (length x length) blocks, see the 
+    block_background function.
+
     Args:
         data (ndarray): 2D array of a single image.
         length (int): The length of the rectangular local regions. Default
             is 150 pixels, thus the local background is subtracted by calculating
             a robust median in 150x150 regions.
+        interpolate (bool): If True the background map is a smooth mesh, bilinearly
+            interpolated between the centers of the regions, instead of being constant
+            within each region. Defaults to False.
+        return_background (bool): If True the background map is also returned, so that it 
+            can be saved and input as the bkg argument of later Catalog runs on the same field. 
+            Defaults to False.
 
     Returns:
-        The background subtracted data array.
+        The background subtracted data array, and the background map if return_background=True.
     """
 
     Nx, Ny = data.shape[1], data.shape[0]
     if Nx < length or Ny < length: #Small image, no need to pad, just take robust median
         background  = sigma_clipped_stats(data)[1] #Sigma clipped median
         data -= background
+        if return_background:
+            return data, np.full(data.shape, background)
         return data
 
+    length = int(length)
     pad_x = length - (Nx % length) 
     pad_y = length - (Ny % length) 
     padded_matrix = np.pad(data, [(0, int(pad_y)), (0, int(pad_x))], mode='symmetric')
    
-    x_increments = int(padded_matrix.shape[1] / length)
-    y_increments = int(padded_matrix.shape[0] / length)
+    medians = block_background(padded_matrix, length=length)[0]
 
-    initial_x, initial_y = int(length/2), int(length/2)
-    x_range = [initial_x+length*n for n in range(x_increments)]
-    y_range = [initial_y+length*n for n in range(y_increments)]
+    if interpolate:
+        background = _interpolation_matrix(Ny, length, medians.shape[0]) @ medians @ _interpolation_matrix(Nx, length, medians.shape[1]).T
+    else:
+        background = np.repeat(np.repeat(medians, length, axis=0)[:Ny], length, axis=1)[:, :Nx]
 
-    positions=[]
-    for xp in x_range:
-        for yp in y_range:
-            positions.append((xp, yp))
+    data = data - background
 
-    for i in range(len(positions)):
-        x,y = positions[i][0], positions[i][1]
-        background  = sigma_clipped_stats(padded_matrix[int(y)-initial_y:int(y)+initial_y,int(x)-initial_x:int(x)+initial_x])[1] #Sigma clipped median                        
-        padded_matrix[int(y)-initial_y:int(y)+initial_y,int(x)-initial_x:int(x)+initial_x] -= background
+    if return_background:
+        return data, background
+    return data
 
-    data = padded_matrix[:-int(pad_y),:-int(pad_x)] #Slice away the padding 
+def block_background(data, length=150, sigma=3.0, maxiters=5):
+    """
+    Computes the sigma-clipped median and standard deviation of every independent 
+    (length x length) block of the data. The data is reshaped into a block view and 
+    all the blocks in a band of block rows are clipped at once, with the same clipping 
+    rule as astropy's sigma_clipped_stats, see the stats.sigma_clipped_stats function.
 
-    return data
+    Args:
+        data (ndarray): 2D array whose dimensions are multiples of the length.
+        length (int): The length of the square blocks. Defaults to 150.
+        sigma (float): The number of standard deviations used as the clipping limit. Defaults to 3.
+        maxiters (int): The maximum number of clipping iterations. Defaults to 5.
+
+    Returns:
+        First output is the 2D array of block medians, the second is the 2D array of block standard deviations.
+    """
+
+    length = int(length)
+    ny, nx = data.shape[0] // length, data.shape[1] // length
+    if ny*length != data.shape[0] or nx*length != data.shape[1]:
+        raise ValueError('The dimensions of the data must be multiples of the block length.')
+
+    medians, stds = np.empty((ny, nx)), np.empty((ny, nx))
+    rows_per_band = max(1, int(2**22 // (nx*length*length))) #Limits the copy to ~32 MB at a time
+    for row in range(0, ny, rows_per_band):
+        band = data[row*length:(row+rows_per_band)*length]
+        blocks = band.reshape(-1, length, nx, length).swapaxes(1, 2).reshape(-1, nx, length*length)
+        medians[row:row+rows_per_band], stds[row:row+rows_per_band] = sigma_clipped_stats(blocks, sigma=sigma, maxiters=maxiters, axis=-1, method='sort')[1:]
+
+    return medians, stds
+
+def _interpolation_matrix(npix, length, nblocks):
+    """
+    Returns the (npix x nblocks) matrix that linearly interpolates values 
+    defined at the centers of consecutive blocks of the given length onto every 
+    pixel, values beyond the outermost centers are held constant.
+    """
+
+    coords = np.clip((np.arange(npix) - (length-1)/2.) / length, 0, nblocks-1)
+    lower = np.floor(coords).astype(int)
+    upper = np.minimum(lower+1, nblocks-1)
+    weights = coords - lower
+
+    matrix = np.zeros((npix, nblocks))
+    matrix[np.arange(npix), lower] = 1 - weights
+    matrix[np.arange(npix), upper] += weights
+
+    return matrix
 
 def align_error_array(data, error, data_coords, error_coords):
     """
@@ -898,11 +2728,14 @@ def plot_segm(data, xpix=None, ypix=None, size=100, median_bkg=None, nsig=0.7, k
         if median_bkg is not None:
             median_bkg = [median_bkg]
         
+    if size != data.shape[1]:
+        stamps = data_processing.extract_stamps(data, xpix, ypix, size, invert=invert)
+
     for i in range(len(xpix)):
         if size == data.shape[1]:
             new_data = data
         else: 
-            new_data = data_processing.crop_image(data, int(xpix[i]), int(ypix[i]), size, invert=invert)
+            new_data = stamps[i]
 
         if median_bkg is None: #Hard coding annuli size, inner:25 -> outer:35
             print("Subtracting background...")
@@ -1107,11 +2940,14 @@ def plot_three_segm(data, xpix=None, ypix=None, size=100, median_bkg=None, nsig=
         if median_bkg is not None:
             median_bkg = [median_bkg]
 
+    if size != data.shape[1]:
+        stamps = data_processing.extract_stamps(data, xpix, ypix, size, invert=invert)
+
     for i in range(len(xpix)):
         if size == data.shape[1]:
             new_data = data
         else: 
-            new_data = data_processing.crop_image(data, int(xpix[i]), int(ypix[i]), size, invert=invert)
+            new_data = stamps[i]
 
         if median_bkg is None: #Hard coding annuli size, inner:25 -> outer:35
             print("Subtracting background...")
@@ -1127,9 +2963,7 @@ def plot_three_segm(data, xpix=None, ypix=None, size=100, median_bkg=None, nsig=
         else:
             new_data -= median_bkg[i]
 
-        segm1, convolved_data1 = segm_find(new_data, nsig=nsig[0], kernel_size=kernel_size, deblend=deblend)
-        segm2, convolved_data2 = segm_find(new_data, nsig=nsig[1], kernel_size=kernel_size, deblend=deblend)
-        segm3, convolved_data3 = segm_find(new_data, nsig=nsig[2], kernel_size=kernel_size, deblend=deblend)
+        segm1, segm2, segm3 = segm_sweep(new_data, nsig[:3], kernel_size=kernel_size, deblend=deblend)[1] #A single convolution
 
         plt.rcParams["mathtext.fontset"] = "stix"
         plt.rcParams["font.family"] = "STIXGeneral"
@@ -1385,13 +3219,17 @@ def plot_two_filters(data1, data2, xpix=None, ypix=None, size=100, median_bkg1=0
         if median_bkg2 is not None:
             median_bkg2 = [median_bkg2]
    
+    if size != data1.shape[1]:
+        stamps1 = data_processing.extract_stamps(data1, xpix, ypix, size, invert=invert)
+        stamps2 = data_processing.extract_stamps(data2, xpix, ypix, size, invert=invert)
+
     for i in range(len(xpix)):
         if size == data1.shape[1]:
             new_data1 = data1
             new_data2 = data2
         else: 
-            new_data1 = data_processing.crop_image(data1, int(xpix[i]), int(ypix[i]), size, invert=invert)
-            new_data2 = data_processing.crop_image(data2, int(xpix[i]), int(ypix[i]), size, invert=invert)
+            new_data1 = stamps1[i]
+            new_data2 = stamps2[i]
 
         if median_bkg1 is None: #Hard coding annuli size, inner:25 -> outer:35
             print("Subtracting background...")
@@ -83,20 +83,68 @@ def crop_image(data, x, y, size=50, invert=False):
         If your image is 200x200, then x, y = (100,100), and so on.
     """
 
+    return extract_stamps(data, x, y, size=size, invert=invert)[0]
+
+def extract_stamps(data, x, y, size=50, invert=False):
+    """
+    Batch version of crop_image. Crops out a sub-array of length = size
+    around every (x, y) position and returns them stacked as a 3D cube.
+
+    The full frame is never copied: stamps that lie entirely within the data
+    are gathered in one fancy-index over a strided window view, and only the
+    stamps that overlap the edge of the frame are filled individually and
+    padded with NaN. The cropping convention is the same as crop_image.
+
+    Note:
+        The output will hold N x size x size pixels, when cropping out a very
+        large number of sources it is best to pass the positions in chunks.
+
+    Args:
+        data (array): 2D array.
+        x (ndarray): 1D array or list containing the central x-position of each sub-array,
+            relative to the entire data. Can also be a single position.
+        y (ndarray): 1D array or list containing the central y-position of each sub-array,
+            relative to the entire data. Can also be a single position.
+        size (int): length/width of the output arrays. Defaults to 50.
+        invert (bool): If True the x & y coordinates will be switched
+            when cropping out the object, see the Note in crop_image. Defaults to False.
+
+    Returns:
+        3D array of shape (N, size, size), one stamp per position.
+
+    Example:
+        >>> from pyBIA import data_processing
+        >>> stamps = data_processing.extract_stamps(data, x=xpix, y=ypix, size=100, invert=True)
+    """
+
     if invert:
         x, y = y, x
-        
-    data_copy = copy.deepcopy(data)
 
-    o, r = np.divmod(size, 2)
-    l = (int(x)-(o+r-1)).clip(0)
-    u = (int(y)-(o+r-1)).clip(0)
-    array = data_copy[l: int(x)+o+1, u:int(y)+o+1]
-    
-    out = np.full((size, size), np.nan, dtype=data_copy.dtype)
-    out[:array.shape[0], :array.shape[1]] = array
+    x, y = np.atleast_1d(np.asarray(x)).astype(int), np.atleast_1d(np.asarray(y)).astype(int)
+    if len(x) != len(y):
+        raise ValueError("The two position arrays (x & y) must be the same size.")
+
+    size = int(size)
+    o, r = divmod(size, 2)
+    rows, cols = data.shape
+    row_start, col_start = x - (o+r-1), y - (o+r-1)
+
+    dtype = data.dtype.newbyteorder('=') if np.issubdtype(data.dtype, np.floating) else np.float64 #FITS data is big-endian
+    stamps = np.full((len(x), size, size), np.nan, dtype=dtype)
+
+    #Stamps fully within the frame, gathered at once from a view of the data
+    inside = (row_start >= 0) & (col_start >= 0) & (row_start+size <= rows) & (col_start+size <= cols)
+    if np.any(inside) and rows >= size and cols >= size:
+        windows = np.lib.stride_tricks.sliding_window_view(data, (size, size))
+        stamps[inside] = windows[row_start[inside], col_start[inside]]
+
+    #Edge stamps are clipped and padded with NaN
+    for i in np.where(~inside)[0]:
+        l, u = max(row_start[i], 0), max(col_start[i], 0)
+        array = data[l:x[i]+o+1, u:y[i]+o+1]
+        stamps[i, :array.shape[0], :array.shape[1]] = array
 
-    return out
+    return stamps
 
 def concat_channels(channel1, channel2, channel3=None):
     """
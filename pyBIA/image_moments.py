@@ -1,75 +1,512 @@
 from astropy.table import Table
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
+import math
 import cv2
 
-def make_moments_table(image):
+def make_moments_table(image, origin=(0, 0), center=None, zernike_order=None):
 	"""
-	This function takes a 2D image array as input and 
-	calculates the image moments, central moments, Hu moments, 
+	This function takes a 2D image array as input and
+	calculates the image moments, central moments, Hu moments,
 	and legendre moments to third order. The fourier descriptors
 	are also computed but only the first ten are kept.
 	These 47 features are concatenated and then saved in an astropy Table.
 
+	The image can be a cutout of a larger frame (e.g. the bounding box of a
+	segmentation object), in which case the origin and center arguments place the
+	cutout within the frame so that the features are the same as those computed
+	on the full frame, while the cost only scales with the area of the cutout.
+
+	Note:
+		To compute the features of many images at once use the batch_moments function,
+		which returns a structured array instead of an astropy Table.
+
 	Args:
 		image (ndarray): A 2D array representing an image.
+		origin (tuple): The (x, y) position of the first pixel of the image within the frame.
+			Defaults to (0, 0).
+		center (tuple, optional): The (x, y) position of the center of the frame, about which the
+			Legendre moments are calculated. Defaults to None, in which case the center of the image is used.
+		zernike_order (int, optional): If set, the magnitudes of the Zernike moments up to this order
+			are appended to the table, see the batch_zernike_moments function. Defaults to None.
 
 	Returns:
 		A astropy table with 40 columns, one for each moment or descriptor."
-    """
+	"""
 
 	if len(image.shape) != 2:
 		raise ValueError("Input image must be 2D.")
-  
-	moments, central_moments, hu_moments = calculate_moments(image), calculate_central_moments(image), calculate_hu_moments(image)
-	legendre_moments, fourier_descriptors = calculate_legendre_moments(image), calculate_fourier_descriptors(image, k=3)
-	
-	features = moments + central_moments + hu_moments + fourier_descriptors + legendre_moments
-	col_names = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',
+
+	features = batch_moments(image[np.newaxis], origins=[origin], centers=None if center is None else [center], zernike_order=zernike_order)
+	features_table = Table(features)
+
+	return features_table
+
+def moment_names(zernike_order=None):
+	"""
+	Returns the names of the 40 features output by the make_moments_table
+	and batch_moments functions, in order.
+
+	Args:
+		zernike_order (int, optional): If set, the names of the Zernike moments up to
+			this order are appended, as zernike_n_m. Defaults to None.
+
+	Returns:
+		List of the feature names.
+	"""
+
+	names = ['m00','m10','m01','m20','m11','m02','m30','m21','m12','m03',
 		'mu00','mu10','mu01','mu20','mu11','mu02','mu30','mu21','mu12','mu03',
 		'hu1','hu2','hu3','hu4','hu5','hu6','hu7', 'fourier_1','fourier_2','fourier_3',
 		'legendre_1','legendre_2','legendre_3','legendre_4','legendre_5','legendre_6',
 		'legendre_7','legendre_8','legendre_9','legendre_10']
+	if zernike_order is not None:
+		names += ['zernike_{}_{}'.format(n, m) for n, m in _zernike_indices(zernike_order)]
 
-	features, col_names = np.array(features), np.array(col_names)
-	dtype = ('f8',) * len(col_names)
-	features_table = Table(data=features, names=col_names, dtype=dtype)
-	
-	return features_table
+	return names
+
+def batch_moments(images, origins=None, centers=None, zernike_order=None, n_threads=1, counter=None):
+	"""
+	Calculates the image moments, central moments, Hu moments, Legendre moments,
+	and Fourier descriptors of a batch of images at once.
+
+	The raw moments of all the images are computed in two matrix products against
+	monomial bases of the pixel coordinates, which are cached for each image shape.
+	The central and Legendre moments are then derived from these by the binomial
+	expansion of the shifted coordinates, and the Hu moments from the central moments,
+	so the pixels of each image are only summed over once.
+
+	Args:
+		images (ndarray, list): 3D array of shape (N, H, W), or a list of 2D arrays that can
+			differ in shape, in which case they are zero-padded to a common shape.
+		origins (ndarray, optional): The (x, y) position of the first pixel of each image within
+			its frame, see the make_moments_table function. Defaults to None, in which case
+			the origins are (0, 0).
+		centers (ndarray, optional): The (x, y) position about which the Legendre moments of each
+			image are calculated. Defaults to None, in which case the center of each image is used.
+		zernike_order (int, optional): If set, the magnitudes of the Zernike moments up to this order
+			are also calculated, see the batch_zernike_moments function. Defaults to None.
+		n_threads (int): The number of threads used to extract the contours, see the
+			batch_fourier_descriptors function. Defaults to 1.
+		counter (Counter, optional): Counter in which the images without enough contour points
+			for the Fourier descriptors are tallied. Defaults to None.
+
+	Returns:
+		Structured array of length N, with one field for each of the 40 features
+		(plus the Zernike moments, if any), see the moment_names function.
+	"""
+
+	cube, shapes = _stack_images(images)
+	origins = np.zeros((len(cube), 2)) if origins is None else np.asarray(origins, dtype=float).reshape(len(cube), 2)
+	if centers is None: #The center of each image (before padding)
+		centers = origins + (np.array(shapes, dtype=float)[:,::-1] - 1) / 2.
+	centers = np.asarray(centers, dtype=float).reshape(len(cube), 2)
+
+	moments, central_moments, hu_moments, legendre_moments = _moment_features(cube, origins, centers)
+
+	fourier_descriptors = batch_fourier_descriptors([cube[i, :shapes[i][0], :shapes[i][1]] for i in range(len(cube))],
+		k=3, origins=origins, n_threads=n_threads, counter=counter)
+
+	features = [moments, central_moments, hu_moments, fourier_descriptors, legendre_moments]
+	if zernike_order is not None: #The unit disk depends on the shape, so the images are grouped by shape
+		zernike = np.zeros((len(cube), len(_zernike_indices(zernike_order))))
+		for shape in set(shapes):
+			index = [i for i in range(len(cube)) if shapes[i] == shape]
+			zernike[index] = batch_zernike_moments(cube[index, :shape[0], :shape[1]], order=zernike_order)
+		features.append(zernike)
+
+	features = np.column_stack(features)
+	dtype = np.dtype([(name, 'f8') for name in moment_names(zernike_order)])
+
+	return np.ascontiguousarray(features).view(dtype).reshape(len(cube))
+
+def _stack_images(images):
+	#Stacks the images into a float64 cube, padding the smaller images with zeros
+	if isinstance(images, np.ndarray) and images.ndim == 3:
+		return np.asarray(images, dtype=np.float64), [images.shape[1:]] * len(images)
+
+	shapes = [np.shape(image) for image in images]
+	if any(len(shape) != 2 for shape in shapes):
+		raise ValueError("Input images must be 2D.")
+	cube = np.zeros((len(images), max(shape[0] for shape in shapes), max(shape[1] for shape in shapes)))
+	for i in range(len(images)):
+		cube[i, :shapes[i][0], :shapes[i][1]] = images[i]
+
+	return cube, shapes
+
+def _moment_features(cube, origins, centers, order=3):
+	#Raw moments (in the frame), central moments, Hu moments, and Legendre moments of every image
+	moments = _raw_moments(cube, order=order)
+	offsets = origins + (np.array(cube.shape[:0:-1]) - 1) / 2. #The center of the cube within each frame
+
+	return _features_from_moments(moments, offsets, centers, order=order)
+
+def _features_from_moments(moments, offsets, centers, order=3):
+	#The features from the moment matrices about a reference pixel, located at the offsets within each frame
+	raw = _shift_moments(moments, offsets)
+	centroids = np.stack((raw[:,0,1], raw[:,1,0]), axis=1) / raw[:,0,0][:,np.newaxis]
+	central = _shift_moments(moments, offsets - centroids)
+	legendre = _shift_moments(moments, offsets - centers)
+
+	#Ordered as [1, x, y, x^2, xy, y^2, x^3, x^2y, xy^2, y^3]
+	q = [j for i in range(order+1) for j in range(i+1)]
+	p = [i-j for i in range(order+1) for j in range(i+1)]
+
+	mu20, mu11, mu02 = central[:,0,2], central[:,1,1], central[:,2,0]
+	mu30, mu21, mu12, mu03 = central[:,0,3], central[:,1,2], central[:,2,1], central[:,3,0]
+	s = np.sqrt(mu20 + mu02)
+
+	hu1 = mu20 + mu02
+	hu2 = (mu20 - mu02)**2 + 4*mu11**2
+	hu3 = (mu30 - 3*mu12)**2 + (3*mu21 - mu03)**2
+	hu4 = (mu30 + mu12)**2 + (mu21 + mu03)**2
+	hu5 = (mu30 - 3*mu12)*(mu30 + mu12)*((mu30 + mu12)**2 - 3*(mu21 + mu03)**2) + (3*mu21 - mu03)*(mu21 + mu03)*(3*(mu30 + mu12)**2 - (mu21 + mu03)**2)
+	hu6 = (mu20 - mu02)*((mu30 + mu12)**2 - (mu21 + mu03)**2) + 4*mu11*(mu30 + mu12)*(mu21 + mu03)
+	hu7 = (3*mu21 - mu03)*(mu30 + mu12)*((mu30 + mu12)**2 - 3*(mu21 + mu03)**2) - (mu30 - 3*mu12)*(mu21 + mu03)*(3*(mu30 + mu12)**2 - (mu21 + mu03)**2)
+
+	# Normalize the moments by dividing them by s^(p+q+2) where p and q are the order of x and y in the moment respectively
+	hu_moments = np.column_stack((hu1 / s**2, hu2 / s**4, hu3 / s**6, hu4 / s**6, hu5 / s**8, hu6 / s**8, hu7 / s**8))
+
+	return raw[:,q,p], central[:,q,p], hu_moments, legendre[:,q,p]
+
+@lru_cache(maxsize=None)
+def _monomial_basis(length, order=3):
+	#Powers of the pixel coordinates, centered on the middle pixel to limit the round-off
+	coords = np.arange(length) - (length - 1) / 2.
+	basis = coords[:,np.newaxis] ** np.arange(order+1)
+	basis.setflags(write=False)
+
+	return basis
+
+def _raw_moments(cube, order=3):
+	#Moments about the center of the cube, moments[n,q,p] = sum(y^q * x^p * image[n])
+	basis_x, basis_y = _monomial_basis(cube.shape[2], order), _monomial_basis(cube.shape[1], order)
+
+	return np.matmul(basis_y.T, np.matmul(cube, basis_x))
+
+def _shift_moments(moments, shifts):
+	#The moments in the coordinates translated by the (dx, dy) shifts, from the binomial expansion of (x+dx)^p (y+dy)^q
+	order = moments.shape[-1] - 1
+	powers = np.arange(order+1)[:,np.newaxis] - np.arange(order+1)
+	binomial = _binomial_matrix(order)
+	shift_x = binomial * shifts[:,0,np.newaxis,np.newaxis] ** np.maximum(powers, 0)
+	shift_y = binomial * shifts[:,1,np.newaxis,np.newaxis] ** np.maximum(powers, 0)
+
+	return np.matmul(np.matmul(shift_y, moments), np.swapaxes(shift_x, 1, 2))
+
+@lru_cache(maxsize=None)
+def _binomial_matrix(order=3):
+	#Lower triangular matrix of the binomial coefficients C(n, k)
+	binomial = np.array([[comb(n, k) if k <= n else 0 for k in range(order+1)] for n in range(order+1)], dtype=float)
+	binomial.setflags(write=False)
+
+	return binomial
+
+def batch_legendre_moments(images, order=3):
+	"""
+	Calculates the orthogonal Legendre moments of a batch of images, using the
+	Legendre polynomials of the pixel coordinates mapped onto [-1, 1]. The bases
+	are cached for each image shape and order, so all the images are projected
+	in two matrix products.
+
+	Note:
+		Unlike the Legendre moments of the make_moments_table function, which are
+		moments of the plain monomials kept for compatibility with existing catalogs,
+		these are the coefficients of the Legendre expansion of the image,
+		lambda_pq = (2p+1)(2q+1)/(W*H) * sum(P_p(x) * P_q(y) * image).
+
+	Args:
+		images (ndarray): 2D array of a single image, or 3D array of shape (N, H, W).
+		order (int): The maximum order p+q of the moments. Defaults to 3.
+
+	Returns:
+		2D array of shape (N, (order+1)*(order+2)/2), ordered as [1, x, y, x^2, xy, y^2, ...].
+	"""
+
+	cube = _image_cube(images)
+	if not isinstance(order, int) or order < 0:
+		raise ValueError("Order must be a non-negative integer.")
+
+	basis_x, basis_y = _legendre_basis(cube.shape[2], order), _legendre_basis(cube.shape[1], order)
+	moments = np.matmul(basis_y.T, np.matmul(cube, basis_x))
+	q = [j for i in range(order+1) for j in range(i+1)]
+	p = [i-j for i in range(order+1) for j in range(i+1)]
+
+	return moments[:,q,p]
+
+def batch_zernike_moments(images, order=3, magnitude=True):
+	"""
+	Calculates the Zernike moments of a batch of images, on the unit disk inscribed
+	in the images (pixels outside the disk are ignored). The Zernike polynomials are
+	cached for each image shape and order, so all the images are projected with
+	a single matrix product.
+
+	Only the moments with m >= 0 are returned, as Z_{n,-m} is the complex conjugate of Z_{n,m}.
+
+	Args:
+		images (ndarray): 2D array of a single image, or 3D array of shape (N, H, W).
+		order (int): The maximum radial order n of the moments. Defaults to 3.
+		magnitude (bool): If True the rotation invariant magnitudes |Z_nm| are returned,
+			otherwise the complex moments. Defaults to True.
+
+	Returns:
+		2D array of shape (N, K), in the (n, m) order of the zernike_n_m names
+		of the moment_names function.
+	"""
+
+	cube = _image_cube(images)
+	if not isinstance(order, int) or order < 0:
+		raise ValueError("Order must be a non-negative integer.")
+
+	basis = _zernike_basis(cube.shape[1:], order)
+	moments = np.matmul(cube.reshape(len(cube), -1), basis) #Real and imaginary parts
+	nterms = basis.shape[1] // 2
+	moments = moments[:,:nterms] + 1j * moments[:,nterms:]
+
+	return np.abs(moments) if magnitude else moments
+
+def clear_basis_cache():
+	"""
+	Clears the cached polynomial bases. The Zernike bases hold K*H*W values for each
+	image shape, so this can be used to free the memory after processing large stamps.
+	"""
+
+	for cached in (_monomial_basis, _binomial_matrix, _legendre_basis, _zernike_basis):
+		cached.cache_clear()
+
+def _image_cube(images):
+	#The images as a float64 (N, H, W) cube
+	cube = np.asarray(images, dtype=np.float64)
+	if cube.ndim == 2:
+		cube = cube[np.newaxis]
+	if cube.ndim != 3:
+		raise ValueError("Input images must be 2D or 3D.")
+
+	return cube
+
+def _zernike_indices(order):
+	#The (n, m) indices with 0 <= m <= n and n-m even
+	return [(n, m) for n in range(order+1) for m in range(n % 2, n+1, 2)]
+
+@lru_cache(maxsize=128)
+def _legendre_basis(length, order=3):
+	#Legendre polynomials at the pixel centers mapped onto [-1, 1], normalized by (2n+1)/length
+	coords = (2 * np.arange(length) + 1) / length - 1
+	basis = np.polynomial.legendre.legvander(coords, order) * (2 * np.arange(order+1) + 1) / length
+	basis.setflags(write=False)
+
+	return basis
+
+@lru_cache(maxsize=16)
+def _zernike_basis(shape, order=3):
+	#Conjugate Zernike polynomials on the inscribed unit disk, normalized by (n+1)/pi times the pixel area, as a (H*W, 2K) matrix of the real and imaginary parts
+	rows, cols = shape
+	radius = min(rows, cols) / 2.
+	y, x = np.mgrid[:rows, :cols]
+	x, y = (x - (cols - 1) / 2.) / radius, (y - (rows - 1) / 2.) / radius
+	rho, theta = np.hypot(x, y).ravel(), np.arctan2(y, x).ravel()
+	disk = rho <= 1
+
+	indices = _zernike_indices(order)
+	basis = np.zeros((rows * cols, 2 * len(indices)))
+	for i, (n, m) in enumerate(indices):
+		weight = np.where(disk, zernike_radial(n, m, rho), 0) * (n + 1) / np.pi / radius**2
+		basis[:,i], basis[:,len(indices)+i] = weight * np.cos(m * theta), -weight * np.sin(m * theta)
+	basis.setflags(write=False)
+
+	return basis
+
+class IntegralMoments:
+	"""
+	Summed-area (integral image) tables of the stamps, from which the image moments
+	and intensity statistics of any centered crop can be read in constant time, without
+	re-cropping and re-summing the stamps at every crop size.
+
+	A table of the cumulative sums of x^p y^q I is built for every moment to third order,
+	as well as of the first four powers of the intensity. The crops follow the convention of
+	the data_processing.crop_image function as used by the data_augmentation.resize function,
+	so the features at a given size are those of resize(images, size).
+
+	Note:
+		The tables hold 14 floats per pixel, e.g. 1000 stamps of 250x250 pixels require 7 GB,
+		so very large batches should be split. Crops that include non-finite pixels return NaN.
+		The sums are differences of cumulative sums, which are accurate to about 1e-8 relative
+		for 250x250 stamps.
+
+	Args:
+		images (ndarray): 2D array of a single stamp, 3D array of shape (N, H, W), or
+			4D array of shape (N, H, W, C) for multiple channels, as input to the
+			data_augmentation.resize function.
+
+	Example:
+		>>> from pyBIA.image_moments import IntegralMoments
+		>>> integral = IntegralMoments(images)
+		>>> for size in np.arange(50, 251, 5):
+		>>>     stats, moments = integral.statistics(size), integral.moments(size)
+	"""
+
+	def __init__(self, images):
+
+		images = np.asarray(images, dtype=np.float64)
+		if images.ndim == 2:
+			images = images[np.newaxis]
+		if images.ndim == 4: #Channels are treated as separate stamps
+			self.channels = images.shape[3]
+			images = np.moveaxis(images, 3, 1).reshape(-1, images.shape[1], images.shape[2])
+		elif images.ndim == 3:
+			self.channels = None
+		else:
+			raise ValueError("Input images must be 2D, 3D, or 4D.")
+
+		self.nstamps, self.height, self.width = images.shape
+		self.center = (self.height // 2, self.width // 2) #Central (row, column) as used when cropping
+
+		finite = np.isfinite(images)
+		images = np.where(finite, images, 0)
+		#The statistics are shift-invariant, the mean is subtracted to limit the round-off of the power sums
+		self._reference = images.sum(axis=(1,2)) / np.maximum(finite.sum(axis=(1,2)), 1)
+		residuals = np.where(finite, images - self._reference[:,np.newaxis,np.newaxis], 0)
+
+		#Powers of the pixel coordinates relative to the central pixel
+		basis_x = (np.arange(self.width) - self.center[1])[:,np.newaxis] ** np.arange(4)
+		basis_y = (np.arange(self.height) - self.center[0])[:,np.newaxis] ** np.arange(4)
+		self._powers = [(q, p) for q in range(4) for p in range(4) if p + q <= 3]
+
+		#The tables are zero-padded on the first row and column, so that table[r,c] is the sum over image[:r,:c]
+		self._tables = np.zeros((len(self._powers)+4, self.nstamps, self.height+1, self.width+1))
+		for i, (q, p) in enumerate(self._powers):
+			plane = images * basis_y[:,q][:,np.newaxis] * basis_x[:,p]
+			np.cumsum(np.cumsum(plane, axis=1), axis=2, out=self._tables[i,:,1:,1:])
+		for i, plane in enumerate((residuals**2, residuals**3, residuals**4, (~finite).astype(np.float64))):
+			np.cumsum(np.cumsum(plane, axis=1), axis=2, out=self._tables[len(self._powers)+i,:,1:,1:])
+
+	def window(self, size):
+		"""
+		Returns the pixel range of the centered crop of the given size.
+
+		Args:
+			size (int): The length/width of the crop.
+
+		Returns:
+			The first and last (exclusive) row, followed by the first and last column.
+		"""
+
+		size = int(size)
+		if size < 1 or size > min(self.height, self.width):
+			raise ValueError('The size must be between 1 and {}.'.format(min(self.height, self.width)))
+		if size == self.height and size == self.width: #No resizing necessary
+			return 0, self.height, 0, self.width
+
+		o, r = divmod(size, 2)
+		row_start, col_start = self.center[0] - (o+r-1), self.center[1] - (o+r-1)
+
+		return row_start, row_start + size, col_start, col_start + size
+
+	def sums(self, size):
+		"""
+		Returns the sums over the centered crop of every table,
+		in constant time per stamp.
+
+		Args:
+			size (int): The length/width of the crop.
+
+		Returns:
+			2D array of shape (14, N).
+		"""
+
+		r0, r1, c0, c1 = self.window(size)
+		tables = self._tables
+
+		return tables[:,:,r1,c1] - tables[:,:,r0,c1] - tables[:,:,r1,c0] + tables[:,:,r0,c0]
+
+	def statistics(self, size):
+		"""
+		Calculates the mean, standard deviation, skewness, and (Fisher) kurtosis of
+		the pixels in the centered crop of every stamp.
+
+		Args:
+			size (int): The length/width of the crop.
+
+		Returns:
+			2D array of shape (N, 4), or (N, C*4) if the images have multiple channels,
+			in the same order as the outlier_detection.extract_statistical_features function.
+		"""
+
+		sums = self.sums(size)
+		n = float(size * size)
+		mean = (sums[0] / n) - self._reference #The first table holds the sum of the pixels
+		s2, s3, s4 = sums[-4] / n, sums[-3] / n, sums[-2] / n #Moments about the reference
+		variance = s2 - mean**2
+		skewness = (s3 - 3*mean*s2 + 2*mean**3) / variance**1.5
+		kurtosis = (s4 - 4*mean*s3 + 6*mean**2*s2 - 3*mean**4) / variance**2 - 3
+
+		statistics = np.column_stack((mean + self._reference, np.sqrt(variance), skewness, kurtosis))
+		statistics[sums[-1] > 0] = np.nan #Crops with non-finite pixels
+
+		return statistics if self.channels is None else statistics.reshape(-1, self.channels*4)
+
+	def moments(self, size):
+		"""
+		Calculates the image moments, central moments, Hu moments, and Legendre
+		moments of the centered crop of every stamp, the same as those computed
+		by the make_moments_table function on the cropped stamps.
+
+		Note:
+			The Fourier descriptors require the contour of the object and
+			are therefore not included.
+
+		Args:
+			size (int): The length/width of the crop.
+
+		Returns:
+			Structured array of length N, or of shape (N, C) if the images have multiple channels,
+			with one field per feature, see the moment_names function.
+		"""
+
+		r0, r1, c0, c1 = self.window(size)
+		sums = self.sums(size)
+
+		moments = np.zeros((self.nstamps, 4, 4))
+		for i, (q, p) in enumerate(self._powers):
+			moments[:,q,p] = sums[i]
+
+		offsets = np.tile([self.center[1] - c0, self.center[0] - r0], (self.nstamps, 1)).astype(float) #The center within the crop
+		centers = np.tile([(c1 - c0 - 1) / 2., (r1 - r0 - 1) / 2.], (self.nstamps, 1))
+		features = np.column_stack(_features_from_moments(moments, offsets, centers))
+		features[sums[-1] > 0] = np.nan #Crops with non-finite pixels
+
+		names = [name for name in moment_names() if not name.startswith('fourier')]
+		dtype = np.dtype([(name, 'f8') for name in names])
+		features = np.ascontiguousarray(features).view(dtype).reshape(self.nstamps)
+
+		return features if self.channels is None else features.reshape(-1, self.channels)
 
-def calculate_moments(image):
+def calculate_moments(image, origin=(0, 0)):
 	"""
-	This function takes a 2D image array as input 
+	This function takes a 2D image array as input
 	and calculates the image moments to third order.
 
 	Args:
 		image (ndarray): A 2D array representing an image.
+		origin (tuple): The (x, y) position of the first pixel, if the image
+			is a cutout of a larger frame. Defaults to (0, 0).
 
-	Returns: 
+	Returns:
 		A tuple of 10 values representing the calculated image moments (m00, m10, m01, m20, m11, m02, m30, m21, m12, m03)
 	"""
 
 	if len(image.shape) != 2:
 		raise ValueError("Input image must be 2D.")
-    
-	rows, cols = image.shape
-	x, y = np.meshgrid(np.arange(cols), np.arange(rows))
-
-	m00 = np.sum(image)
-	m10 = np.sum(x * image)
-	m01 = np.sum(y * image)
-	m20 = np.sum((x**2) * image)
-	m11 = np.sum(x * y * image)
-	m02 = np.sum((y**2) * image)
-	m30 = np.sum((x**3) * image)
-	m21 = np.sum((x**2 * y) * image)
-	m12 = np.sum((x * y**2) * image)
-	m03 = np.sum((y**3) * image)
-
-	return [m00, m10, m01, m20, m11, m02, m30, m21, m12, m03]
+
+	origins = np.array([origin], dtype=float)
+	moments = _moment_features(np.asarray(image, dtype=np.float64)[np.newaxis], origins, origins)[0]
+
+	return list(moments[0])
 
 def calculate_central_moments(image):
 	"""
-	This function takes a 2D image array as input and 
+	This function takes a 2D image array as input and
 	calculates the central moments to third order.
 
 	Args:
@@ -81,30 +518,15 @@ def calculate_central_moments(image):
 
 	if len(image.shape) != 2:
 		raise ValueError("Input image must be 2D.")
-    
-	rows, cols = image.shape
-	x, y = np.meshgrid(np.arange(cols), np.arange(rows))
-
-	m00 = np.sum(image)
-	x_bar = np.sum(x * image) / m00
-	y_bar = np.sum(y * image) / m00
-
-	mu00 = m00
-	mu10 = np.sum((x - x_bar) * image)
-	mu01 = np.sum((y - y_bar) * image)
-	mu20 = np.sum((x - x_bar)**2 * image)
-	mu11 = np.sum((x - x_bar) * (y - y_bar) * image)
-	mu02 = np.sum((y - y_bar)**2 * image)
-	mu30 = np.sum((x - x_bar)**3 * image)
-	mu21 = np.sum((x - x_bar)**2 * (y - y_bar) * image)
-	mu12 = np.sum((x - x_bar) * (y - y_bar)**2 * image)
-	mu03 = np.sum((y - y_bar)**3 * image)
-
-	return [mu00, mu10, mu01, mu20, mu11, mu02, mu30, mu21, mu12, mu03]
+
+	origins = np.zeros((1, 2))
+	central_moments = _moment_features(np.asarray(image, dtype=np.float64)[np.newaxis], origins, origins)[1]
+
+	return list(central_moments[0])
 
 def calculate_hu_moments(image):
 	"""
-	This function takes a 2D image array as 
+	This function takes a 2D image array as
 	input and calculates the 7 Hu moments.
 
 	Args:
@@ -117,29 +539,12 @@ def calculate_hu_moments(image):
 	if len(image.shape) != 2:
 		raise ValueError("Input image must be 2D.")
 
-	mu00, mu10, mu01, mu20, mu11, mu02, mu30, mu21, mu12, mu03 = calculate_central_moments(image)
-	s = np.sqrt(mu20 + mu02)
+	origins = np.zeros((1, 2))
+	hu_moments = _moment_features(np.asarray(image, dtype=np.float64)[np.newaxis], origins, origins)[2]
 
-	hu1 = mu20 + mu02
-	hu2 = (mu20 - mu02)**2 + 4*mu11**2
-	hu3 = (mu30 - 3*mu12)**2 + (3*mu21 - mu03)**2
-	hu4 = (mu30 + mu12)**2 + (mu21 + mu03)**2
-	hu5 = (mu30 - 3*mu12)*(mu30 + mu12)*((mu30 + mu12)**2 - 3*(mu21 + mu03)**2) + (3*mu21 - mu03)*(mu21 + mu03)*(3*(mu30 + mu12)**2 - (mu21 + mu03)**2)
-	hu6 = (mu20 - mu02)*((mu30 + mu12)**2 - (mu21 + mu03)**2) + 4*mu11*(mu30 + mu12)*(mu21 + mu03)
-	hu7 = (3*mu21 - mu03)*(mu30 + mu12)*((mu30 + mu12)**2 - 3*(mu21 + mu03)**2) - (mu30 - 3*mu12)*(mu21 + mu03)*(3*(mu30 + mu12)**2 - (mu21 + mu03)**2)
-
-	# Normalize the moments by dividing them by s^(p+q+2) where p and q are the order of x and y in the moment respectively
-	hu1 = hu1 / s**2
-	hu2 = hu2 / s**4
-	hu3 = hu3 / s**6
-	hu4 = hu4 / s**6
-	hu5 = hu5 / s**8
-	hu6 = hu6 / s**8
-	hu7 = hu7 / s**8
-
-	return [hu1, hu2, hu3, hu4, hu5, hu6, hu7]
+	return list(hu_moments[0])
 
-def calculate_legendre_moments(image, order=3):
+def calculate_legendre_moments(image, order=3, origin=(0, 0), center=None):
 	"""
 	This function takes a 2D image array and calculates the Legendre moments of the input image.
 
@@ -154,6 +559,10 @@ def calculate_legendre_moments(image, order=3):
 	Args:
 	    image (ndarray): A 2D array representing an image.
 	    order (int, optional): The order of the Legendre moments to calculate. Must be a non-negative integer.
+	    origin (tuple): The (x, y) position of the first pixel, if the image is a cutout of a larger frame. 
+	    	Defaults to (0, 0).
+	    center (tuple, optional): The (x, y) position about which the moments are calculated. Defaults
+	    	to None, in which case the center of the image is used.
 
 	Returns:
 	    A list of Legendre moments.
@@ -164,19 +573,17 @@ def calculate_legendre_moments(image, order=3):
 	if not isinstance(order, int) or order < 0:
 		raise ValueError("Order must be a non-negative integer.")
 
-	x, y = np.meshgrid(np.arange(image.shape[1]), np.arange(image.shape[0]))
-	x = x - np.mean(x)
-	y = y - np.mean(y)
-	moments = []
-	for i in range(order+1):
-		for j in range(i+1):
-			moment = np.sum(np.power(x, i-j) * np.power(y, j) * image)
-			moments.append(moment)
+	image = np.asarray(image, dtype=np.float64)[np.newaxis]
+	offset = np.array([origin], dtype=float) + (np.array(image.shape[:0:-1]) - 1) / 2. #The center of the image within the frame
+	if center is None:
+		center = offset[0]
+	moments = _shift_moments(_raw_moments(image, order=order), offset - np.array([center], dtype=float))
+	moments = [moments[0, j, i-j] for i in range(order+1) for j in range(i+1)]
 
 	return moments
 
 
-def calculate_fourier_descriptors(image, k=3):
+def calculate_fourier_descriptors(image, k=3, origin=(0, 0)):
 	"""
 	Calculates the Fourier Descriptors which are a set of complex 
 	numbers that represent the shape of an object, which are calculated 
@@ -199,6 +606,9 @@ def calculate_fourier_descriptors(image, k=3):
 	Args:
 		image (ndarray): A 2D array representing an image.
 		k (int): Number of Fourier Descriptors to keep. Defaults to 3.
+		origin (tuple): The (x, y) position of the first pixel, if the image is a cutout
+			of a larger frame. The contour is shifted to the frame as the descriptor of the 
+			zero frequency depends on the position. Defaults to (0, 0).
 
 	Returns:
 		The fourier descriptors.
@@ -209,32 +619,95 @@ def calculate_fourier_descriptors(image, k=3):
 	if not isinstance(k, int) or k < 0:
 		raise ValueError("Order must be a non-negative integer.")
 
-	rows, cols = image.shape
-	# Create a grid of x and y coordinates
-	x, y = np.meshgrid(np.arange(cols), np.arange(rows))
+	fourier_descriptors, status = _fourier_descriptors(image, k=k, origin=origin)
+	if status == 'no_contour':
+		print('No contours detected, returning zeros...')
+	elif status == 'short_contour':
+		print('Only {} fourier descriptors could be calculated for this object, returning zeros...'.format(np.count_nonzero(fourier_descriptors)))
+
+	return list(fourier_descriptors)
+
+def batch_fourier_descriptors(images, k=3, origins=None, n_threads=1, counter=None):
+	"""
+	Calculates the Fourier descriptors of a batch of images, see the calculate_fourier_descriptors function.
+
+	The contours are only extracted within the bounding box of the positive pixels of each image,
+	and the k largest magnitudes are selected with a partial sort. Since cv2 releases the GIL
+	the images can be processed in a thread pool. Instead of printing a message, the images without
+	a contour or with fewer than k contour points are tallied in the counter, under the 'no_contour'
+	and 'short_contour' keys, respectively.
+
+	Args:
+		images (ndarray, list): 3D array of shape (N, H, W), or a list of 2D arrays.
+		k (int): Number of Fourier Descriptors to keep. Defaults to 3.
+		origins (ndarray, optional): The (x, y) position of the first pixel of each image within
+			its frame. Defaults to None, in which case the origins are (0, 0).
+		n_threads (int): The number of threads. Defaults to 1.
+		counter (Counter, optional): Counter to update with the number of images without enough
+			contour points, the missing descriptors are set to zero. Defaults to None.
+
+	Returns:
+		2D array of shape (N, k).
+
+	Example:
+		>>> from collections import Counter
+		>>> counter = Counter()
+		>>> descriptors = batch_fourier_descriptors(images, n_threads=8, counter=counter)
+		>>> print('{} objects had no contour'.format(counter['no_contour']))
+	"""
+
+	if not isinstance(k, int) or k < 0:
+		raise ValueError("Order must be a non-negative integer.")
+	origins = np.zeros((len(images), 2)) if origins is None else np.asarray(origins, dtype=float).reshape(len(images), 2)
+
+	def process(i):
+		return _fourier_descriptors(images[i], k=k, origin=origins[i], bbox=True)
+
+	if n_threads is not None and n_threads > 1:
+		with ThreadPoolExecutor(max_workers=n_threads) as executor:
+			results = list(executor.map(process, range(len(images)), chunksize=1))
+	else:
+		results = [process(i) for i in range(len(images))]
+
+	if counter is not None:
+		counter.update(status for _, status in results if status is not None)
+
+	return np.array([descriptors for descriptors, _ in results], dtype=float).reshape(len(images), k)
+
+def _fourier_descriptors(image, k=3, origin=(0, 0), bbox=False):
+	#The k largest Fourier descriptors in ascending order, and None or the reason some are missing
+	image = np.asarray(image)
+	if len(image.shape) != 2:
+		raise ValueError("Input image must be 2D.")
+	if k == 0: #No descriptors are kept
+		return np.zeros(0), None
+
 	# Create binary image
 	binary_image = image > 0
+	if bbox: #Restrict the contour search to the bounding box (padded by one pixel) of the object
+		rows, cols = np.flatnonzero(binary_image.any(axis=1)), np.flatnonzero(binary_image.any(axis=0))
+		if len(rows) == 0:
+			return np.zeros(k), 'no_contour'
+		ymin, xmin = max(rows[0] - 1, 0), max(cols[0] - 1, 0)
+		binary_image = binary_image[ymin:rows[-1] + 2, xmin:cols[-1] + 2]
+		origin = (origin[0] + xmin, origin[1] + ymin)
 	# Find contour of the binary image
 	contours, _ = cv2.findContours(binary_image.astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+	if len(contours) == 0:
+		return np.zeros(k), 'no_contour'
 	# Select the longest contour
-	try:
-		contour = max(contours, key=len)
-	except:
-		print('No contours detected, returning zeros...')
-		return [0]*k
+	contour = max(contours, key=len)
 	# Convert contour to complex number
-	contour_complex = contour[:, 0, 0] + 1j * contour[:, 0, 1]
-	# Apply Fourier Transform
-	fourier_descriptors = np.fft.fft(contour_complex)
-	# Keep k largest magnitude Fourier Descriptors
-	fourier_descriptors = np.abs(fourier_descriptors)
-	fourier_descriptors = [i for i in np.sort(fourier_descriptors)[-k:]]
-	if len(fourier_descriptors) != k:
-		print('Only {} fourier descriptors could be calculated for this object, returning zeros...'.format(len(fourier_descriptors)))
-		for i in range(k-len(fourier_descriptors)):
-			fourier_descriptors = fourier_descriptors + [0]
-
-	return fourier_descriptors
+	contour_complex = (contour[:, 0, 0] + origin[0]) + 1j * (contour[:, 0, 1] + origin[1])
+	# Apply Fourier Transform and keep the k largest magnitudes, without sorting the full array
+	fourier_descriptors = np.abs(np.fft.fft(contour_complex))
+	if len(fourier_descriptors) > k:
+		fourier_descriptors = np.partition(fourier_descriptors, len(fourier_descriptors) - k)[len(fourier_descriptors) - k:]
+	fourier_descriptors = np.sort(fourier_descriptors)
+	if len(fourier_descriptors) < k:
+		return np.concatenate((fourier_descriptors, np.zeros(k - len(fourier_descriptors)))), 'short_contour'
+
+	return fourier_descriptors, None
 
 def zernike_moments(image, r_max=3):
 	"""
@@ -242,22 +715,21 @@ def zernike_moments(image, r_max=3):
 	an integer "r_max" as input and calculates 
 	the Zernike moments up to the order of "r_max".
 
-	If r_max=3, there are 13 Zernike moments. Each Zernike moment 
-	is indexed by two integers n and m, where n is the radial order 
-	and m is the azimuthal order. The radial order must be non-negative 
-	and the azimuthal order must be in the range -n <= m <= n. The total 
-	number of Zernike moments is given by the formula (n+1)^2. Therefore, 
-	if r_max is 3, the highest radial order is 3, and the total number of 
-	Zernike moments is (3+1)^2 = 4^2 = 16. However, since the Zernike moment 
-	Z_{n, m} is equivalent to Z_{n, -m}, only half of them are unique. 
-	Therefore, the number of unique Zernike moments is 16/2 = 8.
+	Each Zernike moment is indexed by two integers n and m, where n is the
+	radial order and m is the azimuthal order, with -n <= m <= n and n-m even.
+	Since the Zernike moment Z_{n,-m} is the complex conjugate of Z_{n,m}, only
+	the moments with m >= 0 are returned, e.g. 6 moments if r_max=3. The moments
+	are calculated on the unit disk inscribed in the image.
+
+	Note:
+		To compute the moments of many images at once use the batch_zernike_moments function.
 
 	Args:
 		image (ndarray): A 2D array representing an image.
 		r_max (int): The maximum order of the Zernike moments to calculate.
 
 	Returns:
-		A tuple of (r_max+1)*(r_max+1) values representing the calculated Zernike moments.
+		A list of the complex Zernike moments, ordered by n and then m.
 	"""
 
 	if len(image.shape) != 2:
@@ -265,31 +737,9 @@ def zernike_moments(image, r_max=3):
 	if not isinstance(r_max, int) or r_max < 0:
 		raise ValueError("r_max must be a non-negative integer.")
 
-	rows, cols = image.shape
-	# Create a grid of x and y coordinates
-	x, y = np.meshgrid(np.arange(cols), np.arange(rows))
-	x = x - np.mean(x)
-	y = y - np.mean(y)
-
-	# Convert x and y coordinates to polar coordinates
-	rho = np.sqrt(x**2 + y**2)
-	theta = np.arctan2(y, x)
-
-	moments = []
-	# Define the range of n and m values
-	n_range = range(r_max + 1)
-	m_range = range(-r_max, r_max + 1, 2)
-	# Calculate the Zernike moments
-	for n in n_range:
-		for m in m_range:
-			if n < m:
-				continue
-			Rnm = zernike_radial(n, m, rho)
-			Znm = Rnm * np.exp(1j * m * theta)
-			moment = np.sum(image * Znm)
-			moments.append(moment)
+	moments = batch_zernike_moments(image, order=r_max, magnitude=False)
 
-	return moments
+	return list(moments[0])
 
 def harris_corner_descriptors(image, block_size=2, ksize=3):
 	"""
@@ -344,14 +794,15 @@ def zernike_radial(n, m, rho):
 		The radial polynomial Zernike moment of order (n, m)
 	"""
 
-	if (n - m) % 2 != 0:
-	    return 0
-	k = (n - m) // 2
-	pre_factor = (-1) ** k * comb(n, k)
-	Rnm = pre_factor * rho ** m
-	for i in range(1, k + 1):
-		pre_factor = -pre_factor * (n - i) / (i * (2 * i + m))
-		Rnm = Rnm * (rho ** 2 - i)
+	m = abs(m)
+	if (n - m) % 2 != 0 or m > n:
+		return np.zeros_like(rho, dtype=float)
+
+	Rnm = np.zeros_like(rho, dtype=float)
+	for k in range((n - m) // 2 + 1):
+		coefficient = (-1) ** k * math.factorial(n - k) / (math.factorial(k) * math.factorial((n + m) // 2 - k) * math.factorial((n - m) // 2 - k))
+		Rnm = Rnm + coefficient * rho ** (n - 2 * k)
+
 	return Rnm
 
 def comb(n, k):
@@ -368,7 +819,7 @@ def comb(n, k):
 		The binomial coefficient of n and k
 	"""
 
-	return np.math.factorial(n) // (np.math.factorial(k) * np.math.factorial(n - k))
+	return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
 
 
 
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Aperture photometry of many sources with fixed radii, using pixel stencils.
+"""
+import numpy as np
+from scipy import sparse
+
+from pyBIA.stats import sigma_clipped_stats
+
+def circular_stencil(r_out, r_in=0):
+    """
+    Returns the integer pixel offsets that can fall within a circle (or annulus)
+    centered anywhere within the central pixel. The stencil is the same for
+    every source, so it is computed once and gathered around the nearest pixel
+    of each position.
+
+    Args:
+        r_out (float): The radius of the circle, or the outer radius of the annulus.
+        r_in (float): The inner radius of the annulus. Defaults to 0.
+
+    Returns:
+        First output is the 1D array of row offsets, the second output is the 1D array of column offsets.
+    """
+
+    size = int(np.ceil(r_out + 1))
+    dy, dx = np.mgrid[-size:size+1, -size:size+1]
+    distance = np.hypot(dx, dy)
+    index = (distance <= r_out + np.sqrt(0.5)) & (distance >= r_in - np.sqrt(0.5)) #The pixel centers may be up to half a diagonal off
+
+    return dy[index], dx[index]
+
+def aperture_photometry(data, x, y, aperture=15, annulus_in=20, annulus_out=35, error=None, sigma=3.0, maxiters=5, chunk_size=None):
+    """
+    Computes the aperture sums of all the sources and the sigma-clipped median
+    of the background annuli, without building a mask for every aperture.
+
+    The aperture and annulus stencils are computed once, and the pixels of all the
+    sources in a chunk are gathered with a single fancy index into an (N, n_pix)
+    matrix, so the sums and the clipped medians are computed along its rows.
+
+    The pixels at the edge of the aperture are weighted by the fraction of the
+    pixel within the aperture, linearly approximated as clip(r - d + 0.5, 0, 1),
+    where d is the distance between the pixel center and the source. The annulus
+    contains the pixels whose centers fall within it, as in photutils' ApertureStats,
+    and its median is clipped with the same rule as photutils' SigmaClip.
+
+    Note:
+        Pixels outside the image and non-finite pixels are ignored.
+
+    Args:
+        data (ndarray): 2D array of a single image.
+        x (ndarray): 1D array containing the x-pixel positions.
+        y (ndarray): 1D array containing the y-pixel positions.
+        aperture (float): The radius of the circular aperture. Defaults to 15.
+        annulus_in (float, optional): The inner radius of the background annulus. Defaults to 20.
+            If None the background is not computed.
+        annulus_out (float): The outer radius of the background annulus. Defaults to 35.
+        error (ndarray, optional): 2D array of the pixel errors, used to propagate the
+            uncertainty of the aperture sums. Defaults to None.
+        sigma (float): The number of standard deviations used as the clipping limit. Defaults to 3.
+        maxiters (int): The maximum number of clipping iterations. Defaults to 5.
+        chunk_size (int, optional): The number of sources gathered at a time. Defaults to None,
+            in which case the gathered matrices hold ~1 million pixels.
+
+    Returns:
+        Four outputs: the aperture sums, their uncertainties (None if no error is input),
+        the median background per pixel (None if annulus_in is None), and the area of the aperture.
+    """
+
+    x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+    if len(x) != len(y):
+        raise ValueError('The x and y positions must have the same length.')
+
+    aper_stencil = _aperture_stencil(aperture)
+    annulus_stencil = None if annulus_in is None else _annulus_stencil(annulus_in, annulus_out)
+    if chunk_size is None:
+        chunk_size = max(1, 2**20 // max(len(aper_stencil[0]), 0 if annulus_in is None else len(annulus_stencil[0])))
+
+    #The sources are processed in order of position so that the gathered pixels are close in memory
+    order = np.lexsort((x, y))
+    flux, flux_err, background = np.zeros(len(x)), None if error is None else np.zeros(len(x)), None if annulus_in is None else np.zeros(len(x))
+
+    for start in range(0, len(x), chunk_size):
+        index = order[start:start+chunk_size]
+        rows, cols, weights = _aperture_pixels(x[index], y[index], aperture, aper_stencil)
+        values = _gather(data, rows, cols)
+        valid = np.isfinite(values)
+        weights[~valid] = 0
+        flux[index] = np.sum(np.where(valid, values, 0) * weights, axis=1)
+        if error is not None:
+            errors = _gather(error, rows, cols)
+            flux_err[index] = np.sqrt(np.sum(np.where(valid, errors**2, 0) * weights, axis=1))
+
+        if annulus_in is not None:
+            rows, cols, member = _annulus_pixels(x[index], y[index], annulus_in, annulus_out, annulus_stencil)
+            values = _gather(data, rows, cols)
+            values[~member] = np.nan
+            background[index] = sigma_clipped_stats(values, sigma=sigma, maxiters=maxiters, axis=1, method='sort')[1]
+
+    return flux, flux_err, background, np.pi * aperture**2
+
+class ApertureMatrix:
+    """
+    The aperture and annulus geometry of a set of sources on a fixed pixel grid, stored as
+    sparse (n_sources x n_pixels) matrices, so that the photometry of every additional image
+    of the same field (e.g. other filters or epochs) costs a sparse matrix-vector product,
+    plus the clipped medians of the annulus pixels. The matrices can be saved and loaded,
+    to be reused across runs on the same field grid.
+
+    The aperture weights and annulus pixels are the same as those of the aperture_photometry
+    function, with which the output agrees to round-off.
+
+    Args:
+        x (ndarray): 1D array containing the x-pixel positions.
+        y (ndarray): 1D array containing the y-pixel positions.
+        shape (tuple): The shape of the images, (Ny, Nx).
+        aperture (float): The radius of the circular aperture. Defaults to 15.
+        annulus_in (float, optional): The inner radius of the background annulus. Defaults to 20.
+            If None the background is not computed.
+        annulus_out (float): The outer radius of the background annulus. Defaults to 35.
+
+    Example:
+        >>> from pyBIA.photometry import ApertureMatrix
+        >>> apertures = ApertureMatrix(x, y, shape=data_bw.shape)
+        >>> apertures.save('field_apertures.npz')
+        >>> flux_r, flux_err_r, background_r, area = apertures.photometry(data_r, error=error_r)
+    """
+
+    def __init__(self, x, y, shape, aperture=15, annulus_in=20, annulus_out=35):
+
+        self.x, self.y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+        if len(self.x) != len(self.y):
+            raise ValueError('The x and y positions must have the same length.')
+        self.shape = tuple(int(length) for length in shape)
+        self.aperture, self.annulus_in, self.annulus_out = aperture, annulus_in, annulus_out
+
+        stencil = _aperture_stencil(aperture)
+        self.aperture_matrix = self._sparse_matrix(lambda x, y: _aperture_pixels(x, y, aperture, stencil), len(stencil[0]))
+        self.annulus_matrix = None
+        if annulus_in is not None:
+            stencil = _annulus_stencil(annulus_in, annulus_out)
+            self.annulus_matrix = self._sparse_matrix(lambda x, y: _annulus_pixels(x, y, annulus_in, annulus_out, stencil), len(stencil[0]), dtype=np.int8) #Only the pattern is used
+
+    def _sparse_matrix(self, pixels, npix, dtype=np.float64):
+        #CSR matrix of the non-zero weights within the image, with the pixels indexed as row*Nx + column, built in chunks of sources
+        chunk_size = max(1, 2**20 // npix)
+        counts, indices, weights = [], [], []
+        for start in range(0, len(self.x), chunk_size):
+            rows, cols, chunk_weights = pixels(self.x[start:start+chunk_size], self.y[start:start+chunk_size])
+            keep = (chunk_weights > 0) & (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+            counts.append(keep.sum(axis=1))
+            indices.append((rows*self.shape[1] + cols)[keep]) #The stencils are in row-major order, so the indices are sorted
+            weights.append(chunk_weights[keep].astype(dtype))
+
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate(counts)) if len(counts) > 0 else []))
+        index_dtype = np.int32 if max(indptr[-1], self.shape[0]*self.shape[1]) < 2**31 else np.int64
+        indices = np.concatenate(indices).astype(index_dtype) if len(indices) > 0 else np.zeros(0, dtype=index_dtype)
+        weights = np.concatenate(weights) if len(weights) > 0 else np.zeros(0, dtype=dtype)
+        matrix = sparse.csr_matrix((weights, indices, indptr.astype(index_dtype)), shape=(len(self.x), self.shape[0]*self.shape[1]))
+        matrix.has_sorted_indices = True
+
+        return matrix
+
+    def flux(self, data, error=None):
+        """
+        Computes the aperture sums of the sources.
+
+        Args:
+            data (ndarray): 2D array of the image, with the shape of the grid.
+            error (ndarray, optional): 2D array of the pixel errors. Defaults to None.
+
+        Returns:
+            First output is the aperture sums, the second output is their uncertainties
+            (None if no error is input).
+        """
+
+        values, valid = self._pixels(data)
+        flux = self.aperture_matrix @ values
+        flux_err = None
+        if error is not None:
+            variance = np.where(valid, self._pixels(error)[0]**2, 0) if valid is not None else self._pixels(error)[0]**2
+            flux_err = np.sqrt(self.aperture_matrix @ variance)
+
+        return flux, flux_err
+
+    def background(self, data, sigma=3.0, maxiters=5, chunk_size=None):
+        """
+        Computes the sigma-clipped median of the annulus pixels of every source,
+        see the aperture_photometry function.
+
+        Args:
+            data (ndarray): 2D array of the image, with the shape of the grid.
+            sigma (float): The number of standard deviations used as the clipping limit. Defaults to 3.
+            maxiters (int): The maximum number of clipping iterations. Defaults to 5.
+            chunk_size (int, optional): The number of sources processed at a time. Defaults to None,
+                in which case the gathered matrices hold ~1 million pixels.
+
+        Returns:
+            1D array of the median background per pixel.
+        """
+
+        if self.annulus_matrix is None:
+            raise ValueError('The matrix was built without a background annulus (annulus_in=None).')
+
+        values, valid = self._pixels(data)
+        if valid is not None: #The non-finite pixels are ignored by the clipping, not counted as zeros
+            values = np.where(valid, values, np.nan)
+        indptr, indices = self.annulus_matrix.indptr, self.annulus_matrix.indices
+        counts = np.diff(indptr)
+        width = max(1, counts.max() if len(counts) > 0 else 1)
+        if chunk_size is None:
+            chunk_size = max(1, 2**20 // width)
+
+        background = np.zeros(len(counts))
+        for start in range(0, len(counts), chunk_size):
+            stop = min(start + chunk_size, len(counts))
+            #The annulus pixels of each source padded with NaN to a common length
+            row = np.repeat(np.arange(stop - start), counts[start:stop])
+            column = np.arange(indptr[start], indptr[stop]) - np.repeat(indptr[start:stop], counts[start:stop])
+            pixels = np.full((stop - start, width), np.nan)
+            pixels[row, column] = values[indices[indptr[start]:indptr[stop]]]
+            background[start:stop] = sigma_clipped_stats(pixels, sigma=sigma, maxiters=maxiters, axis=1, method='sort')[1]
+
+        return background
+
+    def photometry(self, data, error=None, sigma=3.0, maxiters=5):
+        """
+        Computes the aperture sums and the background of the sources, the same outputs
+        as the aperture_photometry function.
+
+        Args:
+            data (ndarray): 2D array of the image, with the shape of the grid.
+            error (ndarray, optional): 2D array of the pixel errors. Defaults to None.
+            sigma (float): The number of standard deviations used as the clipping limit. Defaults to 3.
+            maxiters (int): The maximum number of clipping iterations. Defaults to 5.
+
+        Returns:
+            Four outputs: the aperture sums, their uncertainties (None if no error is input),
+            the median background per pixel (None if there is no annulus), and the area of the aperture.
+        """
+
+        flux, flux_err = self.flux(data, error=error)
+        background = None if self.annulus_matrix is None else self.background(data, sigma=sigma, maxiters=maxiters)
+
+        return flux, flux_err, background, np.pi * self.aperture**2
+
+    def save(self, filename):
+        """
+        Saves the matrices and the geometry to an .npz file.
+
+        Args:
+            filename (str): Path of the output file.
+        """
+
+        state = {'x':self.x, 'y':self.y, 'shape':np.array(self.shape), 'radii':np.array([self.aperture, np.nan if self.annulus_in is None else self.annulus_in, self.annulus_out], dtype=float)}
+        for name in ('aperture', 'annulus'):
+            matrix = getattr(self, name+'_matrix')
+            if matrix is not None:
+                state.update({name+'_data':matrix.data, name+'_indices':matrix.indices, name+'_indptr':matrix.indptr})
+        np.savez(filename, **state)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads the matrices saved with the save method.
+
+        Args:
+            filename (str): Path of the .npz file.
+
+        Returns:
+            The ApertureMatrix.
+        """
+
+        self = cls.__new__(cls)
+        with np.load(filename) as state:
+            self.x, self.y, self.shape = state['x'], state['y'], tuple(int(length) for length in state['shape'])
+            aperture, annulus_in, annulus_out = state['radii']
+            self.aperture, self.annulus_in, self.annulus_out = aperture, None if np.isnan(annulus_in) else annulus_in, annulus_out
+            npix = self.shape[0] * self.shape[1]
+            self.aperture_matrix = sparse.csr_matrix((state['aperture_data'], state['aperture_indices'], state['aperture_indptr']), shape=(len(self.x), npix))
+            self.annulus_matrix = None
+            if 'annulus_data' in state.files:
+                self.annulus_matrix = sparse.csr_matrix((state['annulus_data'], state['annulus_indices'], state['annulus_indptr']), shape=(len(self.x), npix))
+
+        return self
+
+    def _pixels(self, data):
+        #The flattened image with the non-finite pixels set to zero, and the mask of the finite pixels (None if all are finite)
+        if tuple(data.shape) != self.shape:
+            raise ValueError('The image shape {} does not match the shape of the grid {}.'.format(data.shape, self.shape))
+
+        values = np.asarray(data, dtype=np.float64).reshape(-1)
+        valid = np.isfinite(values)
+        if valid.all():
+            return values, None
+
+        return np.where(valid, values, 0), valid
+
+def _aperture_stencil(aperture):
+    #The aperture stencil and the indices of its pixels that can straddle the edge
+    rows, cols = circular_stencil(aperture)
+    edge = np.flatnonzero(np.hypot(rows, cols) > aperture - 0.5 - np.sqrt(0.5))
+
+    return rows, cols, edge
+
+def _annulus_stencil(annulus_in, annulus_out):
+    #The annulus stencil and the indices of its pixels whose center can fall on either side of an edge
+    rows, cols = circular_stencil(annulus_out, r_in=annulus_in)
+    distance = np.hypot(rows, cols)
+    edge = np.flatnonzero((distance < annulus_in + np.sqrt(0.5)) | (distance > annulus_out - np.sqrt(0.5)))
+
+    return rows, cols, edge
+
+def _aperture_pixels(x, y, aperture, stencil):
+    #The pixel indices of the apertures and their weights, only the edge pixels depend on the sub-pixel position
+    stencil_rows, stencil_cols, edge = stencil
+    row, col = np.floor(y + 0.5).astype(int), np.floor(x + 0.5).astype(int) #Pixel centers are at integer coordinates
+    rows, cols = row[:,np.newaxis] + stencil_rows, col[:,np.newaxis] + stencil_cols
+    weights = np.ones(rows.shape)
+    distance = np.hypot(cols[:,edge] - x[:,np.newaxis], rows[:,edge] - y[:,np.newaxis])
+    weights[:,edge] = np.clip(aperture - distance + 0.5, 0, 1)
+
+    return rows, cols, weights
+
+def _annulus_pixels(x, y, annulus_in, annulus_out, stencil):
+    #The pixel indices of the annuli and whether their centers fall within the annulus
+    stencil_rows, stencil_cols, edge = stencil
+    row, col = np.floor(y + 0.5).astype(int), np.floor(x + 0.5).astype(int)
+    rows, cols = row[:,np.newaxis] + stencil_rows, col[:,np.newaxis] + stencil_cols
+    member = np.ones(rows.shape, dtype=bool)
+    distance = np.hypot(cols[:,edge] - x[:,np.newaxis], rows[:,edge] - y[:,np.newaxis])
+    member[:,edge] = (distance >= annulus_in) & (distance < annulus_out)
+
+    return rows, cols, member
+
+def _gather(data, rows, cols):
+    #The pixel values at the given indices, NaN outside the image
+    if rows.min() >= 0 and cols.min() >= 0 and rows.max() < data.shape[0] and cols.max() < data.shape[1]:
+        return data[rows, cols].astype(np.float64)
+
+    inside = (rows >= 0) & (rows < data.shape[0]) & (cols >= 0) & (cols < data.shape[1])
+    values = data[np.clip(rows, 0, data.shape[0]-1), np.clip(cols, 0, data.shape[1]-1)].astype(np.float64)
+    values[~inside] = np.nan
+
+    return values
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+KD-tree index of catalog positions for positional queries and cross-matching.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+class SpatialIndex:
+    """
+    Spatial index of the positions of a catalog, on which cone and box queries,
+    neighbour counts, and nearest-neighbour cross-matches are computed with a KD-tree,
+    so that matching N sources costs O(N log N) instead of a loop over all the pairs.
+
+    The positions can be pixel coordinates, in which case the distances are in pixels,
+    or sky coordinates, in which case the index is built on the unit vectors of the (ra, dec)
+    positions so that the queries are exact on the sphere (and across ra=0), and the distances
+    and radii are in arcseconds.
+
+    Args:
+        x (ndarray): 1D array of the x-pixel positions, or of the right ascensions in degrees if sky=True.
+        y (ndarray): 1D array of the y-pixel positions, or of the declinations in degrees if sky=True.
+        sky (bool): Whether the positions are sky coordinates. Defaults to False.
+
+    Note:
+        Non-finite positions (e.g. of sources that could not be converted to sky coordinates)
+        are kept in the index, in the sense that the row numbers of the catalog are preserved,
+        but are never returned by any query.
+
+    Example:
+        >>> from pyBIA.spatial import SpatialIndex
+        >>> index = SpatialIndex.from_catalog(catalog.cat)
+        >>> inside = index.cone(500, 500, radius=50)
+        >>> crowding = index.count_neighbors(radius=35)
+        >>> matches, distances = index.crossmatch(SpatialIndex.from_catalog(other.cat), max_distance=3)
+    """
+
+    def __init__(self, x, y, sky=False):
+
+        self.x, self.y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+        if self.x.shape != self.y.shape or self.x.ndim != 1:
+            raise ValueError("The two position arrays (x & y) must be 1D and the same size.")
+        self.sky = sky
+
+        finite = np.isfinite(self.x) & np.isfinite(self.y)
+        self._rows = np.flatnonzero(finite) #The catalog row of every point in the tree
+        self.tree = cKDTree(self._points(self.x[finite], self.y[finite]))
+
+    @classmethod
+    def from_catalog(cls, cat, wcs=None):
+        """
+        Builds the index of a pyBIA catalog. If a WCS is input the pixel positions are
+        converted to sky coordinates, otherwise the 'ra' and 'dec' columns are used if present,
+        and if not the 'xpix' and 'ypix' columns.
+
+        Args:
+            cat (DataFrame): The catalog, e.g. the cat attribute of a Catalog.
+            wcs (WCS, optional): The astropy WCS of the image the catalog was made from. The xpix
+                and ypix columns are taken to be the column and row of the image, which is the case
+                for positions detected in arrays loaded from FITS files with invert=True. Defaults to None.
+
+        Returns:
+            The SpatialIndex of the catalog rows, in order.
+        """
+
+        if wcs is not None:
+            ra, dec = wcs.pixel_to_world_values(np.asarray(cat['xpix'], dtype=float), np.asarray(cat['ypix'], dtype=float))
+            return cls(ra, dec, sky=True)
+        if 'ra' in cat and 'dec' in cat:
+            return cls(cat['ra'], cat['dec'], sky=True)
+
+        return cls(cat['xpix'], cat['ypix'], sky=False)
+
+    def __len__(self):
+        return len(self.x)
+
+    def _points(self, x, y):
+        #The coordinates of the tree, the unit vectors on the sphere if sky=True
+        x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+        if not self.sky:
+            return np.column_stack((x, y))
+        ra, dec = np.deg2rad(x), np.deg2rad(y)
+        return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+    def _to_tree(self, distance):
+        #Converts a distance (pixels or arcsec) into the distance in the tree (pixels or chord length)
+        if not self.sky:
+            return distance
+        return 2*np.sin(np.minimum(np.deg2rad(np.asarray(distance, dtype=float)/3600.), np.pi)/2.)
+
+    def _from_tree(self, distance):
+        if not self.sky:
+            return distance
+        return np.rad2deg(2*np.arcsin(np.minimum(np.asarray(distance, dtype=float)/2., 1)))*3600.
+
+    def cone(self, x, y, radius):
+        """
+        Returns the sources within the radius of the given position(s).
+
+        Args:
+            x (float, ndarray): The x-pixel position(s), or right ascension(s) in degrees.
+            y (float, ndarray): The y-pixel position(s), or declination(s) in degrees.
+            radius (float): The radius of the cone, in pixels or in arcseconds if sky=True.
+
+        Returns:
+            Sorted 1D array of the catalog rows within the cone. If multiple positions are input,
+            a list with one array per position.
+        """
+
+        matches = self.tree.query_ball_point(self._points(x, y), self._to_tree(radius))
+        matches = [np.sort(self._rows[np.asarray(match, dtype=int)]) for match in matches]
+
+        return matches[0] if np.ndim(x) == 0 else matches
+
+    def box(self, xmin, xmax, ymin, ymax):
+        """
+        Returns the sources within a box, including its edges. For sky coordinates the box is
+        delimited by the (ra, dec) ranges, and xmin > xmax denotes a box across ra=0.
+
+        Args:
+            xmin, xmax (float): The x-pixel (or right ascension) range.
+            ymin, ymax (float): The y-pixel (or declination) range.
+
+        Returns:
+            Sorted 1D array of the catalog rows within the box.
+        """
+
+        if not self.sky:
+            center, radius = ((xmin+xmax)/2., (ymin+ymax)/2.), np.hypot(xmax-xmin, ymax-ymin)/2.
+            candidates = self.cone(center[0], center[1], radius*(1+1e-9)+1e-9) #The circle circumscribing the box
+            inside = (self.x[candidates] >= xmin) & (self.x[candidates] <= xmax) & (self.y[candidates] >= ymin) & (self.y[candidates] <= ymax)
+            return candidates[inside]
+
+        width = 360. if xmax - xmin >= 360 else (xmax - xmin) % 360.
+        ra_center, dec_center = (xmin + width/2.) % 360., (ymin+ymax)/2.
+        #The farthest point of a box of less than 90 degrees from its center is one of the corners
+        corners = self._points([xmin, xmin, xmax, xmax], [ymin, ymax, ymin, ymax])
+        chord = np.max(np.linalg.norm(corners - self._points(ra_center, dec_center), axis=1))
+        if width < 90 and ymax - ymin < 90:
+            candidates = self._rows[np.asarray(self.tree.query_ball_point(self._points(ra_center, dec_center)[0], chord*(1+1e-9)), dtype=int)]
+        else:
+            candidates = self._rows
+        ra, dec = self.x[candidates], self.y[candidates]
+        inside = ((ra - xmin) % 360. <= width) & (dec >= ymin) & (dec <= ymax)
+
+        return np.sort(candidates[inside])
+
+    def nearest(self, x, y, k=1, max_distance=None):
+        """
+        Finds the k nearest sources to the given position(s).
+
+        Args:
+            x (float, ndarray): The x-pixel position(s), or right ascension(s) in degrees.
+            y (float, ndarray): The y-pixel position(s), or declination(s) in degrees.
+            k (int): The number of neighbours. Defaults to 1.
+            max_distance (float, optional): The maximum distance, neighbours farther than this
+                are not returned. Defaults to None.
+
+        Returns:
+            The catalog rows of the neighbours and their distances, of shape (N,) if k=1 otherwise (N, k).
+            Missing neighbours have a row of -1 and an infinite distance.
+        """
+
+        bound = np.inf if max_distance is None else self._to_tree(max_distance)
+        points = self._points(x, y)
+        finite = np.all(np.isfinite(points), axis=1) #Non-finite positions have no neighbours
+        shape = (len(points),) if k == 1 else (len(points), k)
+        rows, distances = np.full(shape, -1), np.full(shape, np.inf)
+
+        tree_distances, indices = self.tree.query(points[finite], k=k, distance_upper_bound=bound)
+        found = indices < self.tree.n #Missing neighbours have the index n
+        rows[finite] = np.where(found, self._rows[np.where(found, indices, 0)] if self.tree.n > 0 else -1, -1)
+        distances[finite] = np.where(found, self._from_tree(tree_distances), np.inf)
+
+        if np.ndim(x) == 0:
+            return rows[0], distances[0]
+        return rows, distances
+
+    def crossmatch(self, other, max_distance=None):
+        """
+        Matches every source of this index to its nearest source in another index,
+        with a single vectorized query of the other tree, in O(N log N).
+
+        Args:
+            other (SpatialIndex): The index to match against, in the same coordinates.
+            max_distance (float, optional): The maximum separation of a match, in pixels or in
+                arcseconds if sky=True. Defaults to None.
+
+        Note:
+            The matches are not exclusive, two sources can be matched to the same counterpart.
+            To keep only the pairs that are each other's nearest neighbour set mutual=True
+            in the crossmatch function.
+
+        Returns:
+            The rows of the other catalog matched to each source (-1 if there is no match within
+            max_distance) and the separations (infinite if there is no match).
+        """
+
+        if other.sky != self.sky:
+            raise ValueError('Both indices must be in the same coordinates (pixel or sky).')
+
+        return other.nearest(self.x, self.y, max_distance=max_distance)
+
+    def count_neighbors(self, radius, x=None, y=None):
+        """
+        Counts the number of sources within the radius of every source, excluding the source itself,
+        or of the given positions. The counts are computed at once from the tree.
+
+        Args:
+            radius (float): The radius, in pixels or in arcseconds if sky=True.
+            x (ndarray, optional): The x-pixel positions (or right ascensions) at which to count the
+                sources. Defaults to None, in which case the neighbours of the sources are counted.
+            y (ndarray, optional): The y-pixel positions (or declinations). Defaults to None.
+
+        Returns:
+            1D array of the counts. Sources with non-finite positions have a count of 0.
+        """
+
+        if x is None:
+            counts = np.zeros(len(self), dtype=int)
+            counts[self._rows] = self.tree.query_ball_point(self.tree.data, self._to_tree(radius), return_length=True) - 1
+            return counts
+
+        points = self._points(x, y)
+        finite = np.all(np.isfinite(points), axis=1)
+        counts = np.zeros(len(points), dtype=int)
+        counts[finite] = self.tree.query_ball_point(points[finite], self._to_tree(radius), return_length=True)
+
+        return counts
+
+def crossmatch(cat1, cat2, max_distance=None, wcs1=None, wcs2=None, mutual=False, suffixes=('_1', '_2')):
+    """
+    Cross-matches two catalogs, e.g. of different bands or of an external survey, by
+    nearest neighbour, and joins the matched rows. See the SpatialIndex class.
+
+    Args:
+        cat1 (DataFrame): The first catalog, every row of which is kept.
+        cat2 (DataFrame): The catalog to match against.
+        max_distance (float, optional): The maximum separation of a match, in pixels or in arcseconds
+            if the catalogs are matched on the sky. Defaults to None.
+        wcs1 (WCS, optional): The WCS of the first catalog, see the SpatialIndex.from_catalog method.
+            Defaults to None.
+        wcs2 (WCS, optional): The WCS of the second catalog. Defaults to None.
+        mutual (bool): If True only the pairs that are each other's nearest neighbour are matched,
+            so every source of cat2 is matched at most once. Defaults to False.
+        suffixes (tuple): The suffixes of the overlapping column names. Defaults to ('_1', '_2').
+
+    Returns:
+        Pandas dataframe with the rows of cat1, joined with the columns of their match in cat2
+        (NaN if unmatched, e.g. if cat2 is empty), and a 'match_index' column holding the row number of the match in cat2
+        (-1 if unmatched) and a 'match_distance' column.
+    """
+
+    index1, index2 = SpatialIndex.from_catalog(cat1, wcs=wcs1), SpatialIndex.from_catalog(cat2, wcs=wcs2)
+    matches, distances = index1.crossmatch(index2, max_distance=max_distance)
+    if mutual:
+        back = index2.crossmatch(index1, max_distance=max_distance)[0]
+        unique = matches >= 0
+        unique[unique] = back[matches[unique]] == np.flatnonzero(unique)
+        matches, distances = np.where(unique, matches, -1), np.where(unique, distances, np.inf)
+
+    #The unmatched rows (-1), as well as all the rows if cat2 is empty, are NaN
+    matched = cat2.reset_index(drop=True).reindex(matches).reset_index(drop=True)
+    df = cat1.reset_index(drop=True).join(matched, lsuffix=suffixes[0], rsuffix=suffixes[1])
+    df['match_index'], df['match_distance'] = matches, distances
+
+    return df
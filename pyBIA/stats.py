@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Sigma-clipped statistics shared by the background and threshold estimates.
+"""
+import numpy as np
+
+def sigma_clipped_stats(data, sigma=3.0, maxiters=5, axis=None, method='auto'):
+    """
+    Calculates the sigma-clipped mean, median and standard deviation of the data,
+    with the same clipping rule as astropy's sigma_clipped_stats (median center and
+    standard deviation), to which the output agrees to machine precision.
+
+    The statistics can be computed along an axis, in which case every array is clipped
+    independently but all at once. Two methods are available: 'sort' sorts each array
+    once, after which every iteration only updates the bounds of the kept range, which
+    is fastest for many small arrays (e.g. the blocks of a background mesh), while 'partition'
+    finds the medians with partial sorts, which is fastest for a few large arrays (e.g. a field).
+
+    Note:
+        Non-finite values are ignored. Arrays with no finite values return NaN.
+
+    Args:
+        data (ndarray): The data, of any shape.
+        sigma (float): The number of standard deviations used as the clipping limit. Defaults to 3.
+        maxiters (int, optional): The maximum number of clipping iterations. Defaults to 5.
+            If None the clipping is iterated until no more values are rejected.
+        axis (int, tuple, optional): The axis or axes along which the statistics are computed.
+            Defaults to None, in which case the statistics of the flattened data are computed.
+        method (str): The method, either 'sort', 'partition', or 'auto', in which case
+            'partition' is used for arrays longer than 65536 values and 'sort' otherwise.
+            Defaults to 'auto'.
+
+    Returns:
+        The mean, median and standard deviation. These are floats if axis is None,
+        otherwise arrays with the shape of the data without the axis.
+    """
+
+    data = np.asanyarray(data)
+    if axis is None:
+        values = data.reshape(1, -1)
+        shape = ()
+    else:
+        axes = tuple(np.atleast_1d(axis) % data.ndim)
+        shape = tuple(data.shape[i] for i in range(data.ndim) if i not in axes)
+        values = np.moveaxis(data, axes, tuple(range(-len(axes), 0))).reshape(shape + (-1,))
+
+    if method == 'auto':
+        method = 'partition' if values.shape[-1] > 2**16 else 'sort'
+    maxiters = np.inf if maxiters is None else maxiters
+
+    if method == 'sort':
+        mean, median, std = _sigma_clip_sorted(values, sigma=sigma, maxiters=maxiters)
+    elif method == 'partition':
+        flat = values.reshape(-1, values.shape[-1])
+        stats = np.array([_sigma_clip_partition(row, sigma=sigma, maxiters=maxiters) for row in flat])
+        mean, median, std = [stats[:,i].reshape(values.shape[:-1]) for i in range(3)]
+    else:
+        raise ValueError("Invalid method, options are 'sort', 'partition', or 'auto'.")
+
+    if axis is None:
+        return float(mean[0]), float(median[0]), float(std[0])
+
+    return mean.reshape(shape), median.reshape(shape), std.reshape(shape)
+
+def _sigma_clip_sorted(values, sigma=3.0, maxiters=5):
+    """
+    Sigma-clipped mean, median and standard deviation along the last axis.
+
+    Each array is sorted once, after which the clipped values are always its
+    two tails, so every iteration only updates the bounds of the kept range and
+    reads the statistics off the sorted values and their cumulative sums.
+    Non-finite values are ignored.
+
+    Returns:
+        The mean, median and standard deviation, with the shape of values without the last axis.
+    """
+
+    values = np.array(values, dtype=np.float64)
+    values[~np.isfinite(values)] = np.nan
+    values.sort(axis=-1) #NaN are sorted to the end
+
+    hi = np.sum(np.isfinite(values), axis=-1)
+    lo = np.zeros_like(hi)
+
+    def median(lo, hi):
+        n = np.maximum(hi - lo, 1)
+        return 0.5 * (np.take_along_axis(values, (lo+(n-1)//2)[...,None], axis=-1)[...,0] + np.take_along_axis(values, (lo+n//2)[...,None], axis=-1)[...,0])
+
+    #Center on the initial median to avoid precision loss in the cumulative sums
+    reference = np.where(hi > 0, median(lo, np.maximum(hi, 1)), 0.)
+    values -= reference[...,None]
+    finite = np.where(np.isnan(values), 0., values) #The NaN at the end are never within the kept range
+    sum1, sum2 = np.zeros(values.shape[:-1]+(values.shape[-1]+1,)), np.zeros(values.shape[:-1]+(values.shape[-1]+1,))
+    np.cumsum(finite, axis=-1, out=sum1[...,1:])
+    np.cumsum(finite**2, axis=-1, out=sum2[...,1:])
+
+    def stats(lo, hi):
+        n = np.maximum(hi - lo, 1)
+        mean = (np.take_along_axis(sum1, hi[...,None], axis=-1)[...,0] - np.take_along_axis(sum1, lo[...,None], axis=-1)[...,0]) / n
+        var = (np.take_along_axis(sum2, hi[...,None], axis=-1)[...,0] - np.take_along_axis(sum2, lo[...,None], axis=-1)[...,0]) / n - mean**2
+        return mean, median(lo, hi), np.sqrt(np.maximum(var, 0))
+
+    nfinite = hi.copy()
+
+    def count(threshold, inclusive=False):
+        #The number of values below (or equal to) the thresholds, by a binary search of every sorted array
+        if nfinite.size == 1: #A single array, e.g. a stamp
+            finite = values.reshape(-1)[:int(nfinite.item())]
+            return np.searchsorted(finite, np.reshape(threshold, -1), side='right' if inclusive else 'left').reshape(nfinite.shape)
+        left, right = np.zeros_like(nfinite), nfinite.copy()
+        while np.any(left < right):
+            active = left < right
+            middle = (left + right) // 2
+            value = np.take_along_axis(values, np.minimum(middle, values.shape[-1]-1)[...,None], axis=-1)[...,0]
+            below = value <= threshold if inclusive else value < threshold
+            left, right = np.where(active & below, middle+1, left), np.where(active & ~below, middle, right)
+        return left
+
+    i = 0
+    while i < maxiters:
+        mean, med, std = stats(lo, hi)
+        new_lo = np.maximum(lo, count(med - sigma*std))
+        new_hi = np.minimum(hi, count(med + sigma*std, inclusive=True))
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi): #Converged
+            break
+        lo, hi = new_lo, new_hi
+        i += 1
+
+    mean, med, std = stats(lo, hi)
+    empty = hi <= lo
+
+    return np.where(empty, np.nan, mean+reference), np.where(empty, np.nan, med+reference), np.where(empty, np.nan, std)
+
+def _sigma_clip_partition(values, sigma=3.0, maxiters=5):
+    """
+    Sigma-clipped mean, median and standard deviation of a 1D array,
+    the median of every iteration is found with a partial sort.
+
+    Returns:
+        The mean, median and standard deviation.
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)] #A copy, which is partitioned in place
+    if len(values) == 0:
+        return np.nan, np.nan, np.nan
+
+    def stats(values):
+        n = len(values)
+        values.partition(((n-1)//2, n//2)) #The kept values remain close to partitioned, which speeds up the next iterations
+        return np.mean(values), 0.5 * (values[(n-1)//2] + values[n//2]), np.std(values)
+
+    mean, med, std = stats(values)
+    i = 0
+    while i < maxiters:
+        keep = (values >= med - sigma*std) & (values <= med + sigma*std)
+        if keep.all(): #Converged
+            break
+        values = values[keep]
+        if len(values) == 0:
+            return np.nan, np.nan, np.nan
+        mean, med, std = stats(values)
+        i += 1
+
+    return mean, med, std